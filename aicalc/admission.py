@@ -0,0 +1,356 @@
+from aicalc.config import logger
+from aicalc.redis_client import get_redis
+from aicalc.cache import REDIS_RETRY_INTERVAL
+from aicalc.circuit_breaker import CircuitOpenError, is_quota_error
+from aicalc.metrics import ADMISSION_DECISIONS, ADMISSION_LIMIT, ADMISSION_WAITING, observe_stage
+from contextlib import asynccontextmanager, contextmanager
+import asyncio
+import contextvars
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+
+# Admission control in front of the model calls. A token bucket per quota (requests and
+# tokens per minute) is shared by all workers through Redis, so a burst is spread over
+# the provider's real quota instead of ending in 429s and retries. Requests that find
+# the bucket empty, or the worker at its concurrency limit, wait in a priority queue:
+# short text questions first, then longer text and packed batches, then images (cache
+# hits never get here). A request that would wait longer than ADMISSION_MAX_WAIT is
+# turned away at once with a Retry-After. The concurrency limit adapts to provider
+# latency: it grows while latency holds steady and shrinks when latency climbs or the
+# provider reports exhausted quota.
+ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# The primary provider's quota; 0 leaves that dimension unlimited.
+PROVIDER_RPM = float(os.getenv('PROVIDER_RPM', 0))
+PROVIDER_TPM = float(os.getenv('PROVIDER_TPM', 0))
+# Bucket capacity in seconds of quota: how large a burst is let through at once.
+ADMISSION_BURST = float(os.getenv('ADMISSION_BURST', 10))
+ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', 10))
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', 64))
+ADMISSION_MIN_CONCURRENCY = int(os.getenv('ADMISSION_MIN_CONCURRENCY', 1))
+ADMISSION_MAX_CONCURRENCY = int(os.getenv('ADMISSION_MAX_CONCURRENCY', 16))
+# Latency may rise to this multiple of its long-run average before the limit shrinks.
+ADMISSION_LATENCY_TOLERANCE = float(os.getenv('ADMISSION_LATENCY_TOLERANCE', 2.0))
+ADMISSION_SHORT_TEXT = int(os.getenv('ADMISSION_SHORT_TEXT', 200))
+# Token estimate for a call: prompt characters / 4, plus these.
+ADMISSION_IMAGE_TOKENS = int(os.getenv('ADMISSION_IMAGE_TOKENS', 258))
+ADMISSION_COMPLETION_TOKENS = int(os.getenv('ADMISSION_COMPLETION_TOKENS', 800))
+ADMISSION_KEY_PREFIX = 'aicalc:admission:'
+
+PRIORITY_SHORT_TEXT = 0
+PRIORITY_TEXT = 1
+PRIORITY_IMAGE = 2
+PRIORITY_NAMES = {PRIORITY_SHORT_TEXT: 'short_text', PRIORITY_TEXT: 'text', PRIORITY_IMAGE: 'image'}
+
+class AdmissionRejected(CircuitOpenError):
+    """Raised when a model call cannot start within ADMISSION_MAX_WAIT; answered like an open breaker."""
+
+class AdmissionTicket:
+    """A held model call slot. start is when the current provider attempt began."""
+    __slots__ = ('start',)
+
+    def __init__(self):
+        self.start = time.monotonic()
+
+# The ticket held by the model call running in this thread or task, for retry_backoff().
+_current_ticket = contextvars.ContextVar('admission_ticket', default=None)
+
+# Refill every bucket, then take from all of them or from none. KEYS are the buckets;
+# ARGV holds capacity, refill per second and cost for each, then the key TTL. Returns
+# the seconds until every bucket could pay (0 when taken).
+_TAKE_SCRIPT = """
+redis.replicate_commands()
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local capacity, rate, cost = tonumber(ARGV[3 * i - 2]), tonumber(ARGV[3 * i - 1]), tonumber(ARGV[3 * i])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    levels[i] = tokens
+    if tokens < cost then
+        wait = math.max(wait, (cost - tokens) / rate)
+    end
+end
+for i, key in ipairs(KEYS) do
+    local tokens = levels[i]
+    if wait == 0 then
+        tokens = tokens - tonumber(ARGV[3 * i])
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', key, tonumber(ARGV[#ARGV]))
+end
+return tostring(wait)
+"""
+
+class QuotaBuckets:
+    """Requests-per-minute and tokens-per-minute buckets, in Redis when available."""
+
+    def __init__(self, rpm=PROVIDER_RPM, tpm=PROVIDER_TPM, redis_client=None):
+        # (name, capacity, refill per second) for each configured quota.
+        self.buckets = [(name, max(1.0, per_minute * ADMISSION_BURST / 60), per_minute / 60)
+                        for name, per_minute in (('rpm', rpm), ('tpm', tpm)) if per_minute > 0]
+        self.redis = redis_client
+        self._script = redis_client.register_script(_TAKE_SCRIPT) if redis_client is not None and self.buckets else None
+        self._levels = {name: (capacity, time.monotonic()) for name, capacity, _ in self.buckets}
+        self._redis_down_until = 0.0
+        self._lock = threading.Lock()
+
+    def _costs(self, tokens):
+        # A single call can never cost more than a full bucket, or it would wait forever.
+        return [min(capacity, 1 if name == 'rpm' else tokens) for name, capacity, _ in self.buckets]
+
+    def take(self, tokens):
+        """Take one request and tokens from every bucket; returns 0, or the seconds to wait first."""
+        if not self.buckets:
+            return 0.0
+        costs = self._costs(tokens)
+        if self._script is not None and time.monotonic() >= self._redis_down_until:
+            args = []
+            for (_, capacity, rate), cost in zip(self.buckets, costs):
+                args += [capacity, rate, cost]
+            try:
+                return float(self._script(keys=[ADMISSION_KEY_PREFIX + name for name, _, _ in self.buckets],
+                                          args=args + [120]))
+            except Exception as e:
+                self._redis_down_until = time.monotonic() + REDIS_RETRY_INTERVAL
+                logger.warning(f"Admission buckets unavailable in Redis, enforcing the quota per worker: {e}")
+        return self._take_local(costs)
+
+    def _take_local(self, costs):
+        with self._lock:
+            now = time.monotonic()
+            levels = {}
+            wait = 0.0
+            for (name, capacity, rate), cost in zip(self.buckets, costs):
+                tokens, ts = self._levels[name]
+                levels[name] = min(capacity, tokens + (now - ts) * rate)
+                if levels[name] < cost:
+                    wait = max(wait, (cost - levels[name]) / rate)
+            for (name, _, _), cost in zip(self.buckets, costs):
+                self._levels[name] = (levels[name] - (cost if wait == 0 else 0), now)
+            return wait
+
+    @property
+    def shared(self):
+        return self._script is not None
+
+    def request_rate(self):
+        """Requests per second the buckets allow, or None when requests are not limited."""
+        for name, _, rate in self.buckets:
+            if name == 'rpm':
+                return rate
+        return None
+
+class AdmissionController:
+    def __init__(self, buckets, enabled=ADMISSION_ENABLED):
+        self.buckets = buckets
+        self.enabled = enabled
+        self.limit = float(min(max(ADMISSION_MAX_CONCURRENCY // 2, ADMISSION_MIN_CONCURRENCY), ADMISSION_MAX_CONCURRENCY))
+        self.in_flight = 0
+        self.short_latency = None
+        self.long_latency = None
+        self._waiting = []
+        self._seq = itertools.count()
+        self._throttled_until = 0.0
+        # Set while the head of the queue takes from the buckets, outside the lock.
+        self._taking = False
+        self._cond = threading.Condition()
+        self._stats = {'admitted': 0, 'queued': 0, 'shed': 0, 'queue_full': 0, 'timed_out': 0, 'retries_refused': 0}
+        ADMISSION_LIMIT.set(self.limit)
+
+    def _estimate_wait(self, ahead):
+        # Time for the requests ahead to start: by the concurrency limit, and by the request
+        # quota while the bucket is running dry.
+        wait = 0.0
+        if self.in_flight + ahead >= int(self.limit):
+            wait = (ahead + 1) * (self.short_latency or 1.0) / self.limit
+        rate = self.buckets.request_rate()
+        if rate and time.monotonic() < self._throttled_until:
+            wait = max(wait, (self._throttled_until - time.monotonic()) + ahead / rate)
+        return wait
+
+    def _reject(self, priority, reason, wait):
+        self._stats[reason] += 1
+        ADMISSION_DECISIONS.labels(PRIORITY_NAMES[priority], reason).inc()
+        error = AdmissionRejected(f"Model calls are queued beyond {ADMISSION_MAX_WAIT:.0f}s ({reason})",
+                                  retry_after=max(1.0, math.ceil(wait)))
+        logger.warning(f"Admission refused a {PRIORITY_NAMES[priority]} request: {reason}, retry after {error.retry_after:.0f}s")
+        return error
+
+    def _leave(self, entry):
+        self._waiting.remove(entry)
+        heapq.heapify(self._waiting)
+        ADMISSION_WAITING.set(len(self._waiting))
+        # The next in line may be able to go now.
+        self._cond.notify_all()
+
+    def acquire(self, priority, tokens):
+        """Wait for a model call slot; returns a ticket for release(), or raises AdmissionRejected."""
+        if not self.enabled:
+            return None
+        start = time.monotonic()
+        deadline = start + ADMISSION_MAX_WAIT
+        with self._cond:
+            ahead = sum(1 for waiting_priority, _ in self._waiting if waiting_priority <= priority)
+            estimate = self._estimate_wait(ahead)
+            if len(self._waiting) >= ADMISSION_MAX_QUEUE:
+                raise self._reject(priority, 'queue_full', estimate)
+            if estimate > ADMISSION_MAX_WAIT:
+                raise self._reject(priority, 'shed', estimate)
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._waiting, entry)
+            ADMISSION_WAITING.set(len(self._waiting))
+        queued = False
+        while True:
+            with self._cond:
+                while not (self._waiting[0] == entry and not self._taking and self.in_flight < int(self.limit)):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._leave(entry)
+                        raise self._reject(priority, 'timed_out', estimate)
+                    queued = True
+                    self._cond.wait(remaining)
+                self._taking = True
+            # The buckets may be in Redis: take from them outside the lock, so a slow Redis
+            # holds up only this caller and never the others' timeouts or releases.
+            try:
+                wait = self.buckets.take(tokens)
+            except BaseException:
+                with self._cond:
+                    self._taking = False
+                    self._leave(entry)
+                raise
+            with self._cond:
+                self._taking = False
+                self._cond.notify_all()
+                if wait <= 0:
+                    # A request of higher priority may have queued ahead while the tokens
+                    # were taken, so the entry is removed by value.
+                    self._leave(entry)
+                    self.in_flight += 1
+                    self._stats['admitted'] += 1
+                    if queued:
+                        self._stats['queued'] += 1
+                    break
+                self._throttled_until = time.monotonic() + wait
+                if wait > deadline - time.monotonic():
+                    self._leave(entry)
+                    raise self._reject(priority, 'timed_out', wait)
+                queued = True
+                self._cond.wait(wait)
+        ADMISSION_DECISIONS.labels(PRIORITY_NAMES[priority], 'queued' if queued else 'admitted').inc()
+        observe_stage('admission_wait', time.monotonic() - start)
+        return AdmissionTicket()
+
+    def release(self, ticket, error=None):
+        """End a call started with acquire(), adapting the concurrency limit to how it went."""
+        if ticket is None:
+            return
+        latency = time.monotonic() - ticket.start
+        with self._cond:
+            self.in_flight -= 1
+            if error is not None and (is_quota_error(error) or isinstance(error, CircuitOpenError)):
+                self.limit = max(float(ADMISSION_MIN_CONCURRENCY), self.limit / 2)
+            elif error is None:
+                self._adapt(latency)
+            ADMISSION_LIMIT.set(self.limit)
+            self._cond.notify_all()
+
+    def _adapt(self, latency):
+        # Gradient limiter: compare recent latency with its long-run average. While they
+        # agree the limit creeps up by about its square root; when recent latency climbs
+        # past the tolerance, the provider is queueing and the limit backs off.
+        if self.short_latency is None:
+            self.short_latency = self.long_latency = latency
+        self.short_latency = 0.8 * self.short_latency + 0.2 * latency
+        self.long_latency = 0.98 * self.long_latency + 0.02 * latency
+        gradient = max(0.5, min(1.0, ADMISSION_LATENCY_TOLERANCE * self.long_latency / self.short_latency))
+        target = self.limit * gradient + math.sqrt(self.limit)
+        self.limit = min(float(ADMISSION_MAX_CONCURRENCY), max(float(ADMISSION_MIN_CONCURRENCY),
+                                                               0.8 * self.limit + 0.2 * target))
+
+    def allow_retry(self, tokens):
+        """Whether the quota has room for a retry right now; retries never wait in the queue."""
+        if not self.enabled or self.buckets.take(tokens) <= 0:
+            return True
+        with self._cond:
+            self._stats['retries_refused'] += 1
+        return False
+
+    def as_dict(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'enabled': self.enabled,
+                'shared': self.buckets.shared,
+                'quotas': {name: round(rate * 60) for name, _, rate in self.buckets.buckets},
+                'concurrency_limit': round(self.limit, 2),
+                'in_flight': self.in_flight,
+                'waiting': len(self._waiting),
+                'latency_seconds': round(self.short_latency, 3) if self.short_latency is not None else None,
+            })
+        return stats
+
+admission = AdmissionController(QuotaBuckets(redis_client=get_redis()))
+
+def estimate_tokens(prompt, image=None):
+    return len(prompt) // 4 + (ADMISSION_IMAGE_TOKENS if image is not None else 0) + ADMISSION_COMPLETION_TOKENS
+
+def text_priority(question_text):
+    return PRIORITY_SHORT_TEXT if len(question_text) <= ADMISSION_SHORT_TEXT else PRIORITY_TEXT
+
+@contextmanager
+def admitted(priority, prompt, image=None):
+    """Hold a model call slot for the body of the with block."""
+    ticket = admission.acquire(priority, estimate_tokens(prompt, image))
+    # set(), not reset(): a streaming response may leave the block from another context.
+    previous = _current_ticket.get()
+    _current_ticket.set(ticket)
+    try:
+        yield
+    except BaseException as e:
+        admission.release(ticket, e)
+        raise
+    finally:
+        _current_ticket.set(previous)
+    admission.release(ticket)
+
+@asynccontextmanager
+async def aadmitted(priority, prompt, image=None):
+    """admitted() for the event loop; the wait happens on a worker thread."""
+    ticket = await asyncio.to_thread(admission.acquire, priority, estimate_tokens(prompt, image))
+    # set(), not reset(): a streaming response may leave the block from another context.
+    previous = _current_ticket.get()
+    _current_ticket.set(ticket)
+    try:
+        yield
+    except BaseException as e:
+        admission.release(ticket, e)
+        raise
+    finally:
+        _current_ticket.set(previous)
+    admission.release(ticket)
+
+def allow_retry(prompt, image=None):
+    return admission.allow_retry(estimate_tokens(prompt, image))
+
+@contextmanager
+def retry_backoff():
+    """Wrap the sleep before a retry. The latency the limiter learns at release then covers
+    only the last provider attempt, so a retrying provider does not look slow."""
+    try:
+        yield
+    finally:
+        ticket = _current_ticket.get()
+        if ticket is not None:
+            ticket.start = time.monotonic()
+
+def get_admission_stats():
+    return admission.as_dict()
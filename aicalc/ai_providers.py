@@ -1,9 +1,17 @@
 import os
-import google.generativeai as genai
-from openai import OpenAI
+import asyncio
+import importlib
+import importlib.util
+import json
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeout
 from aicalc.config import logger
-from io import BytesIO
-import base64
+from aicalc.circuit_breaker import get_breaker, CircuitOpenError, OPEN
+from aicalc.metrics import PROVIDER_SECONDS, ROUTING_DECISIONS, record_tokens
+from aicalc.admission import allow_retry, retry_backoff
 
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 PROJECT_ID = os.getenv('GOOGLE_CLOUD_PROJECT_ID')
@@ -11,101 +19,802 @@ LOCATION = os.getenv('GOOGLE_CLOUD_LOCATION', 'us-central1')
 OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
 OPENROUTER_BASE_URL = os.getenv('OPENROUTER_BASE_URL', 'https://openrouter.ai/api/v1')
 VISION_MODEL = os.getenv('OPENROUTER_VISION_MODEL', 'qwen/qwen-2.5-72b-instruct')
+# AI_PROVIDER=stub replaces the hosted models with a local stub, for load testing.
+AI_PROVIDER = os.getenv('AI_PROVIDER', '').lower()
+# The provider SDKs take most of the import time, so they are imported on first use.
+# PRELOAD_SDKS=true imports them in initialize_ai_model instead; gunicorn.conf.py sets it
+# with preload_app, so the master loads them once and workers share the pages.
+PRELOAD_SDKS = os.getenv('PRELOAD_SDKS', 'false').lower() in ('1', 'true', 'yes')
+PROBE_INTERVAL = float(os.getenv('PROBE_INTERVAL', 300))
+STUB_LATENCY = float(os.getenv('STUB_LATENCY', 0.5))
+# 'fixed', 'uniform' (0 to twice STUB_LATENCY), 'exponential' or 'lognormal' (median
+# STUB_LATENCY, spread STUB_LATENCY_SIGMA), all with mean or median STUB_LATENCY.
+STUB_LATENCY_DIST = os.getenv('STUB_LATENCY_DIST', 'fixed').lower()
+STUB_LATENCY_SIGMA = float(os.getenv('STUB_LATENCY_SIGMA', 0.5))
+# Fractions of calls that fail, after their latency, with a generic error or a 429.
+STUB_ERROR_RATE = float(os.getenv('STUB_ERROR_RATE', 0))
+STUB_RATE_LIMIT_RATE = float(os.getenv('STUB_RATE_LIMIT_RATE', 0))
+STUB_RESPONSE = os.getenv('STUB_RESPONSE', '<p>Stub solution: \\( x = 1 \\)</p>')
+# A JSON list of replies to pick from at random instead of STUB_RESPONSE.
+STUB_RESPONSES_FILE = os.getenv('STUB_RESPONSES_FILE')
+STUB_SEED = os.getenv('STUB_SEED')
+STUB_CHUNK_SIZE = 16
+PROVIDER_TIMEOUT = float(os.getenv('PROVIDER_TIMEOUT', 30))
+# Overall budget for one request's model calls and retries, sync and async alike.
+REQUEST_DEADLINE = float(os.getenv('REQUEST_DEADLINE', 60))
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 8.0
+# 'fallback' tries OpenRouter only after the primary fails; 'hedge' also starts it when
+# the primary is slower than its recent p95; 'race' starts both at once.
+ROUTING_MODE = os.getenv('ROUTING_MODE', 'fallback').lower()
+HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', 3.0))
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', 0.5))
+HEDGE_MAX_DELAY = float(os.getenv('HEDGE_MAX_DELAY', 10.0))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_BUDGET_PER_MINUTE = int(os.getenv('HEDGE_BUDGET_PER_MINUTE', 30))
+HEDGE_THREADS = 32
+LATENCY_WINDOW = 200
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+# Runs blocking SDK calls that take no timeout of their own (Vertex), so the request can
+# stop waiting; the abandoned call finishes or fails on its own thread.
+_timeout_executor = ThreadPoolExecutor(max_workers=HEDGE_THREADS, thread_name_prefix='ai-timeout')
+
+def _call_with_timeout(name, fn, timeout):
+    future = _timeout_executor.submit(fn)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeout:
+        raise DeadlineExceeded(f"{name} did not answer within {timeout:.1f}s")
+
+def retry_delay(attempt):
+    # Full jitter, so retries from many concurrent requests do not land in lockstep.
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+class GoogleProvider:
+    """Gemini through either the Vertex AI SDK or the google.generativeai SDK.
+
+    The SDK is imported and the model built on the first call, not at startup.
+    """
+
+    def __init__(self, name, load_model):
+        self.name = name
+        self._load_model = load_model
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self._load_model()
+        return self._model
+
+    def probe(self):
+        # count_tokens checks credentials, project and model without generating anything.
+        self.model.count_tokens("Test")
+
+    def _contents(self, prompt, image):
+        # image is a PreparedImage: the PNG was encoded once at ingestion, for every attempt.
+        if self.name == "vertex" and image:
+            from vertexai.generative_models import Part
+            return [prompt, Part.from_data(image.png, mime_type=image.mime_type)]
+        elif image:
+            return [prompt, {'mime_type': image.mime_type, 'data': image.png}]
+        return [prompt]
+
+    def _record_usage(self, response):
+        usage = getattr(response, 'usage_metadata', None)
+        if usage:
+            record_tokens(self.name, usage.prompt_token_count, usage.candidates_token_count)
+
+    def generate(self, prompt, image=None, timeout=PROVIDER_TIMEOUT):
+        contents = self._contents(prompt, image)
+        if self.name == "vertex":
+            response = _call_with_timeout(self.name, lambda: self.model.generate_content(contents), timeout)
+        else:
+            response = self.model.generate_content(contents, request_options={'timeout': timeout})
+        self._record_usage(response)
+        return response.text
+
+    async def agenerate(self, prompt, image=None):
+        response = await self.model.generate_content_async(self._contents(prompt, image))
+        self._record_usage(response)
+        return response.text
+
+    def stream(self, prompt, image=None):
+        chunk = None
+        options = {} if self.name == "vertex" else {'request_options': {'timeout': PROVIDER_TIMEOUT}}
+        for chunk in self.model.generate_content(self._contents(prompt, image), stream=True, **options):
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunks carrying only safety or finish metadata have no text part.
+                continue
+            if text:
+                yield text
+        # Each chunk carries the running totals, so only the last one is counted.
+        if chunk is not None:
+            self._record_usage(chunk)
+
+class OpenRouterProvider:
+    """OpenAI-compatible chat completions on OpenRouter."""
+
+    name = "openrouter"
+
+    def __init__(self, api_key, base_url=OPENROUTER_BASE_URL, model_name=VISION_MODEL):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.model_name = model_name
+        self._client = None
+        self._async_client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import OpenAI
+            # Retries are ours here too; the SDK's would run past the request deadline.
+            self._client = OpenAI(base_url=self.base_url, api_key=self.api_key, max_retries=0)
+        return self._client
+
+    def _messages(self, prompt, image):
+        if not image:
+            return [{"role": "user", "content": prompt}]
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {"type": "image_url", "image_url": {"url": image.data_url}}
+                ]
+            }
+        ]
+
+    def _record_usage(self, completion):
+        if completion.usage:
+            record_tokens(self.name, completion.usage.prompt_tokens, completion.usage.completion_tokens)
+
+    def generate(self, prompt, image=None, timeout=PROVIDER_TIMEOUT):
+        completion = self.client.chat.completions.create(
+            model=self.model_name,
+            messages=self._messages(prompt, image),
+            max_tokens=1024,
+            timeout=timeout
+        )
+        self._record_usage(completion)
+        return completion.choices[0].message.content
+
+    def stream(self, prompt, image=None):
+        completion = self.client.chat.completions.create(
+            model=self.model_name,
+            messages=self._messages(prompt, image),
+            max_tokens=1024,
+            timeout=PROVIDER_TIMEOUT,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        for chunk in completion:
+            if getattr(chunk, 'usage', None):
+                self._record_usage(chunk)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    @property
+    def async_client(self):
+        # One client per process keeps a pooled, keep-alive connection set to OpenRouter;
+        # retries are ours (jittered, deadline-aware), so the SDK's own are disabled.
+        if self._async_client is None:
+            from openai import AsyncOpenAI
+            self._async_client = AsyncOpenAI(base_url=self.base_url, api_key=self.api_key, max_retries=0)
+        return self._async_client
+
+    async def agenerate(self, prompt, image=None):
+        completion = await self.async_client.chat.completions.create(
+            model=self.model_name,
+            messages=self._messages(prompt, image),
+            max_tokens=1024
+        )
+        self._record_usage(completion)
+        return completion.choices[0].message.content
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
+
+class StubProviderError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+class StubProvider:
+    """Local stand-in that answers without calling any API.
+
+    Latency, failures and replies are drawn from the STUB_* settings, so load tests can
+    reproduce slow, flaky or rate-limited providers and replies carrying diagrams.
+    """
+
+    name = "stub"
+
+    def __init__(self, latency=STUB_LATENCY, response=STUB_RESPONSE, responses_file=STUB_RESPONSES_FILE,
+                 latency_dist=STUB_LATENCY_DIST, error_rate=STUB_ERROR_RATE, rate_limit_rate=STUB_RATE_LIMIT_RATE,
+                 seed=STUB_SEED):
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.responses = [response]
+        if responses_file:
+            with open(responses_file, encoding='utf-8') as f:
+                self.responses = json.load(f)
+        self.random = random.Random(seed)
+
+    def _delay(self):
+        if self.latency_dist == 'uniform':
+            return self.random.uniform(0, 2 * self.latency)
+        if self.latency_dist == 'exponential':
+            return self.random.expovariate(1 / self.latency) if self.latency > 0 else 0
+        if self.latency_dist == 'lognormal':
+            return self.random.lognormvariate(0, STUB_LATENCY_SIGMA) * self.latency
+        return self.latency
+
+    def _call(self):
+        """(delay, reply) for one call; the reply is an exception when the call is to fail."""
+        delay = self._delay()
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            return delay, StubProviderError("429 Resource exhausted (simulated quota error)", status_code=429)
+        if roll < self.rate_limit_rate + self.error_rate:
+            return delay, StubProviderError("Simulated provider error", status_code=500)
+        return delay, self.random.choice(self.responses)
+
+    def generate(self, prompt, image=None, timeout=PROVIDER_TIMEOUT):
+        delay, response = self._call()
+        if delay > timeout:
+            time.sleep(timeout)
+            raise DeadlineExceeded(f"{self.name} did not answer within {timeout:.1f}s")
+        time.sleep(delay)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    async def agenerate(self, prompt, image=None):
+        delay, response = self._call()
+        await asyncio.sleep(delay)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def stream(self, prompt, image=None):
+        delay, response = self._call()
+        if isinstance(response, Exception):
+            time.sleep(delay)
+            raise response
+        pieces = [response[i:i + STUB_CHUNK_SIZE] for i in range(0, len(response), STUB_CHUNK_SIZE)]
+        for piece in pieces:
+            time.sleep(delay / len(pieces))
+            yield piece
 
 api_backend = "gemini"
-model = None
-openrouter_client = None
-if OPENROUTER_API_KEY:
-    openrouter_client = OpenAI(base_url=OPENROUTER_BASE_URL, api_key=OPENROUTER_API_KEY)
+primary_provider = None
+openrouter_provider = None
+if OPENROUTER_API_KEY and AI_PROVIDER != "stub":
+    openrouter_provider = OpenRouterProvider(OPENROUTER_API_KEY)
+_probe = {'ok': None, 'error': None, 'checked_at': None}
+_probe_lock = threading.Lock()
+
+def _vertex_model():
+    import vertexai
+    from vertexai.generative_models import GenerativeModel
+    vertexai.init(project=PROJECT_ID, location=LOCATION)
+    return GenerativeModel('gemini-1.5-flash')
+
+def _gemini_model():
+    import google.generativeai as genai
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai.GenerativeModel(model_name='gemini-1.5-flash')
+
+def preload_sdks():
+    """Import the SDKs of the configured providers, without creating any client."""
+    modules = {'vertex': ['vertexai', 'vertexai.generative_models'], 'gemini': ['google.generativeai']}.get(api_backend, [])
+    if openrouter_provider:
+        modules.append('openai')
+    start = time.monotonic()
+    for module in modules:
+        importlib.import_module(module)
+    logger.info(f"Preloaded {', '.join(modules) or 'no'} SDKs in {time.monotonic() - start:.2f}s")
 
 def initialize_ai_model():
-    global model, api_backend
+    global api_backend, primary_provider
     try:
+        if AI_PROVIDER == "stub":
+            primary_provider = StubProvider()
+            api_backend = "stub"
+            logger.info(f"✅ Using stub AI provider (latency {STUB_LATENCY}s {STUB_LATENCY_DIST}, "
+                        f"{STUB_ERROR_RATE:.0%} errors, {STUB_RATE_LIMIT_RATE:.0%} rate limited)")
+            return
+        primary_provider = None
         if PROJECT_ID and os.path.exists(os.getenv('GOOGLE_APPLICATION_CREDENTIALS', '')):
-            try:
-                import vertexai
-                from vertexai.generative_models import GenerativeModel
-                vertexai.init(project=PROJECT_ID, location=LOCATION)
-                model = GenerativeModel('gemini-1.5-flash')
-                test_response = model.generate_content("Test")
+            # No test generation here: the model is built on first use, and /health probes it.
+            if importlib.util.find_spec('vertexai') is not None:
                 api_backend = "vertex"
+                primary_provider = GoogleProvider(api_backend, _vertex_model)
                 logger.info("✅ Using Vertex AI")
-                return
-            except Exception as e:
-                logger.info(f"Vertex AI not available: {e}")
-        if GEMINI_API_KEY:
-            genai.configure(api_key=GEMINI_API_KEY)
-            model = genai.GenerativeModel(model_name='gemini-1.5-flash')
+            else:
+                logger.info("Vertex AI not available: the vertexai package is not installed")
+        if primary_provider is None:
+            if not GEMINI_API_KEY:
+                raise Exception("No AI API configured")
             api_backend = "gemini"
+            primary_provider = GoogleProvider(api_backend, _gemini_model)
             logger.info("✅ Using Gemini API")
-        else:
-            raise Exception("No AI API configured")
+        if PRELOAD_SDKS:
+            preload_sdks()
     except Exception as e:
         logger.error(f"Failed to initialize AI model: {e}")
         raise
 
-def generate_ai_response(prompt, image=None, max_retries=3):
+def _run_probe(probe):
+    try:
+        probe()
+        _probe.update(ok=True, error=None)
+    except Exception as e:
+        logger.warning(f"Probe of {primary_provider.name} failed: {e}")
+        _probe.update(ok=False, error=str(e))
+    finally:
+        _probe['checked_at'] = time.monotonic()
+        _probe_lock.release()
+
+def probe_primary():
+    """Last result of probing the primary provider with a cheap request, refreshed every PROBE_INTERVAL.
+
+    Stands in for the test generation startup used to make. The probe runs in the
+    background, so /health answers at once; 'ok' is None until the first probe finishes.
+    """
+    probe = getattr(primary_provider, 'probe', None)
+    if probe is None:
+        return {'ok': primary_provider is not None}
+    checked_at = _probe['checked_at']
+    if (checked_at is None or time.monotonic() - checked_at >= PROBE_INTERVAL) and _probe_lock.acquire(blocking=False):
+        threading.Thread(target=_run_probe, args=(probe,), daemon=True, name='provider-probe').start()
+    return {'ok': _probe['ok'], 'error': _probe['error']}
+
+class ProviderStats:
+    """Rolling latency window for one provider, used to derive the hedge delay."""
+
+    def __init__(self, name, window=LATENCY_WINDOW):
+        self.name = name
+        self.latencies = deque(maxlen=window)
+        self.successes = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency, ok):
+        PROVIDER_SECONDS.labels(self.name, 'ok' if ok else 'error').observe(latency)
+        with self._lock:
+            if ok:
+                self.successes += 1
+                self.latencies.append(latency)
+            else:
+                self.failures += 1
+
+    def percentile(self, q):
+        with self._lock:
+            samples = sorted(self.latencies)
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def as_dict(self):
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            'successes': self.successes,
+            'failures': self.failures,
+            'p50': round(p50, 3) if p50 is not None else None,
+            'p95': round(p95, 3) if p95 is not None else None,
+        }
+
+class SpendBudget:
+    """Token bucket capping extra (hedged or raced) calls to one provider per minute."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60.0)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+class ProviderStatsTable(dict):
+    def __missing__(self, name):
+        stats = self[name] = ProviderStats(name)
+        return stats
+
+provider_stats = ProviderStatsTable()
+hedge_budgets = {}
+routing_stats = defaultdict(int)
+_hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_THREADS, thread_name_prefix='ai-hedge')
+
+def _decided(decision):
+    routing_stats[decision] += 1
+    ROUTING_DECISIONS.labels(decision).inc()
+
+def _budget(provider):
+    if provider.name not in hedge_budgets:
+        per_minute = int(os.getenv(f'HEDGE_BUDGET_{provider.name.upper()}', HEDGE_BUDGET_PER_MINUTE))
+        hedge_budgets[provider.name] = SpendBudget(per_minute)
+    return hedge_budgets[provider.name]
+
+def hedge_delay(provider):
+    """Seconds to wait on provider before hedging: its recent p95, clamped."""
+    if ROUTING_MODE == 'race':
+        return 0.0
+    p95 = provider_stats[provider.name].percentile(0.95)
+    if p95 is None:
+        return HEDGE_DEFAULT_DELAY
+    return min(max(p95, HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+def _timed_generate(provider, prompt, image, deadline, token):
+    breaker = get_breaker(provider.name)
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        breaker.release(token)
+        raise DeadlineExceeded("Request deadline exceeded before calling the AI provider")
+    start = time.monotonic()
+    try:
+        text = provider.generate(prompt, image, timeout=min(PROVIDER_TIMEOUT, remaining))
+    except Exception as e:
+        provider_stats[provider.name].record(time.monotonic() - start, False)
+        breaker.record(time.monotonic() - start, e, token)
+        raise
+    provider_stats[provider.name].record(time.monotonic() - start, True)
+    breaker.record(time.monotonic() - start, token=token)
+    return text
+
+def _won(trace, provider):
+    trace['provider'] = provider.name
+    _decided(f'won_{provider.name}')
+
+def _provider_chain():
+    return [p for p in (primary_provider, openrouter_provider) if p is not None]
+
+def _admit(provider, trace):
+    """Check the provider's circuit breaker: its call token, or None (noted in the trace) when skipped."""
+    token = get_breaker(provider.name).allow()
+    if token is not None:
+        return token
+    trace.setdefault('skipped', []).append(provider.name)
+    _decided(f'skipped_open_{provider.name}')
+    return None
+
+def _all_open():
+    return all(get_breaker(p.name).state() == OPEN for p in _provider_chain())
+
+def _circuit_open_error():
+    retry_after = min(get_breaker(p.name).retry_after() for p in _provider_chain())
+    return CircuitOpenError("All AI providers are temporarily unavailable", retry_after=retry_after)
+
+def _hedge_admitted(secondary, trace):
+    token = _admit(secondary, trace)
+    if token is None:
+        return None
+    if _budget(secondary).take():
+        return token
+    get_breaker(secondary.name).release(token)
+    trace['hedge_skipped'] = 'budget'
+    _decided('hedges_skipped_budget')
+    return None
+
+def _fallback_generate(prompt, image, trace, deadline, providers):
+    error = None
+    for provider in providers:
+        token = _admit(provider, trace)
+        if token is None:
+            continue
+        if provider is not primary_provider:
+            trace['fallback'] = True
+            _decided('fallbacks')
+        try:
+            text = _timed_generate(provider, prompt, image, deadline, token)
+            _won(trace, provider)
+            return text
+        except Exception as e:
+            error = e
+            logger.warning(f"{provider.name} failed: {e}")
+    if error is None:
+        raise _circuit_open_error()
+    raise error
+
+def _hedged_generate(prompt, image, trace, deadline, primary_token):
+    primary, secondary = primary_provider, openrouter_provider
+    delay = hedge_delay(primary)
+    trace['hedge_delay'] = round(delay, 3)
+    primary_future = _hedge_executor.submit(_timed_generate, primary, prompt, image, deadline, primary_token)
+    done, _ = wait([primary_future], timeout=delay)
+    if done and primary_future.exception() is None:
+        _won(trace, primary)
+        return primary_future.result()
+    secondary_token = None if done else _hedge_admitted(secondary, trace)
+    hedge = secondary_token is not None
+    if not done and not hedge:
+        # Secondary open or out of hedge budget: behave like plain fallback routing.
+        wait([primary_future])
+        if primary_future.exception() is None:
+            _won(trace, primary)
+            return primary_future.result()
+    if not hedge:
+        secondary_token = _admit(secondary, trace)
+        if secondary_token is None:
+            raise primary_future.exception()
+        logger.warning(f"{primary.name} failed: {primary_future.exception()}. Falling back to {secondary.name}.")
+        trace['fallback'] = True
+        _decided('fallbacks')
+        futures = {_hedge_executor.submit(_timed_generate, secondary, prompt, image, deadline, secondary_token): secondary}
+    else:
+        logger.info(f"{primary.name} has not answered after {delay:.2f}s, hedging with {secondary.name}")
+        trace['hedged'] = True
+        _decided('hedges_fired')
+        futures = {
+            primary_future: primary,
+            _hedge_executor.submit(_timed_generate, secondary, prompt, image, deadline, secondary_token): secondary,
+        }
+    pending = set(futures)
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                # A blocking SDK call cannot be interrupted; the loser's answer is discarded.
+                for other in pending:
+                    other.cancel()
+                _won(trace, futures[future])
+                if trace.get('hedged') and futures[future] is secondary:
+                    _decided('hedges_won')
+                return future.result()
+            error = future.exception()
+            logger.warning(f"{futures[future].name} failed: {error}")
+    raise error
+
+def generate_ai_response(prompt, image=None, max_retries=3, deadline=None, trace=None):
+    """Call the configured providers, retrying with backoff.
+
+    Each call is bounded by PROVIDER_TIMEOUT and by deadline, an absolute
+    time.monotonic() value (default REQUEST_DEADLINE from now), after which no retry
+    starts. trace, if given, is filled with the routing mode, attempts, hedging
+    decisions and the provider that answered.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + REQUEST_DEADLINE
+    trace = {} if trace is None else trace
+    trace['mode'] = ROUTING_MODE if openrouter_provider else 'single'
     for attempt in range(max_retries):
+        trace['attempts'] = attempt + 1
         try:
-            if api_backend == "vertex" and image:
-                from vertexai.generative_models import Part
-                img_byte_arr = BytesIO()
-                image.save(img_byte_arr, format='PNG')
-                img_byte_arr = img_byte_arr.getvalue()
-                image_part = Part.from_data(img_byte_arr, mime_type="image/png")
-                response = model.generate_content([prompt, image_part])
-            elif image:
-                response = model.generate_content([prompt, image])
-            else:
-                response = model.generate_content([prompt])
-            return response.text
+            providers = _provider_chain()
+            if ROUTING_MODE in ('hedge', 'race') and openrouter_provider:
+                token = _admit(primary_provider, trace)
+                if token is not None:
+                    return _hedged_generate(prompt, image, trace, deadline, token)
+                providers = [openrouter_provider]
+            return _fallback_generate(prompt, image, trace, deadline, providers)
+        except CircuitOpenError:
+            raise
         except Exception as e:
-            if openrouter_client:
-                logger.warning(f"Google Generative AI failed: {e}. Falling back to OpenRouter.")
-                try:
-                    if image:
-                        buffered = BytesIO()
-                        image.save(buffered, format="PNG")
-                        img_b64 = base64.b64encode(buffered.getvalue()).decode()
-                        image_url = f"data:image/png;base64,{img_b64}"
-                        completion = openrouter_client.chat.completions.create(
-                            model=VISION_MODEL,
-                            messages=[
-                                {
-                                    "role": "user",
-                                    "content": [
-                                        {"type": "text", "text": prompt},
-                                        {"type": "image_url", "image_url": {"url": image_url}}
-                                    ]
-                                }
-                            ],
-                            max_tokens=1024
-                        )
-                        return completion.choices[0].message.content
-                    else:
-                        completion = openrouter_client.chat.completions.create(
-                            model=VISION_MODEL,
-                            messages=[
-                                {"role": "user", "content": prompt}
-                            ],
-                            max_tokens=1024
-                        )
-                        return completion.choices[0].message.content
-                except Exception as oe:
-                    logger.error(f"OpenRouter fallback also failed: {oe}")
-                    if attempt < max_retries - 1:
-                        wait_time = (2 ** attempt) * 1
-                        logger.info(f"Retrying in {wait_time} seconds...")
-                        import time
-                        time.sleep(wait_time)
-                    else:
-                        raise oe
-            else:
+            if not openrouter_provider:
                 logger.warning(f"AI request attempt {attempt + 1} failed: {e}")
-                if attempt < max_retries - 1:
-                    wait_time = (2 ** attempt) * 1
-                    logger.info(f"Retrying in {wait_time} seconds...")
-                    import time
+            # A retry spends quota like any call, so it only goes ahead while the bucket has room.
+            wait_time = retry_delay(attempt)
+            if (attempt < max_retries - 1 and time.monotonic() + wait_time < deadline and not _all_open()
+                    and allow_retry(prompt, image)):
+                _decided('retries')
+                logger.info(f"Retrying in {wait_time:.2f} seconds...")
+                with retry_backoff():
                     time.sleep(wait_time)
-                else:
-                    raise e
+            else:
+                raise
+
+async def _call_with_deadline(provider, prompt, image, deadline, token):
+    breaker = get_breaker(provider.name)
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        breaker.release(token)
+        raise DeadlineExceeded("Request deadline exceeded before calling the AI provider")
+    timeout = min(PROVIDER_TIMEOUT, remaining)
+    start = time.monotonic()
+    try:
+        text = await asyncio.wait_for(provider.agenerate(prompt, image), timeout=timeout)
+    except asyncio.TimeoutError:
+        provider_stats[provider.name].record(time.monotonic() - start, False)
+        error = DeadlineExceeded(f"{provider.name} did not answer within {timeout:.1f}s")
+        await asyncio.to_thread(breaker.record, time.monotonic() - start, error, token)
+        raise error
+    except asyncio.CancelledError:
+        # A hedge loser or abandoned request says nothing about the provider's health.
+        breaker.release(token)
+        raise
+    except Exception as e:
+        provider_stats[provider.name].record(time.monotonic() - start, False)
+        await asyncio.to_thread(breaker.record, time.monotonic() - start, e, token)
+        raise
+    provider_stats[provider.name].record(time.monotonic() - start, True)
+    await asyncio.to_thread(breaker.record, time.monotonic() - start, None, token)
+    return text
+
+async def _afallback_generate(prompt, image, trace, deadline, providers):
+    error = None
+    for provider in providers:
+        token = _admit(provider, trace)
+        if token is None:
+            continue
+        if provider is not primary_provider:
+            trace['fallback'] = True
+            _decided('fallbacks')
+        try:
+            text = await _call_with_deadline(provider, prompt, image, deadline, token)
+            _won(trace, provider)
+            return text
+        except Exception as e:
+            error = e
+            logger.warning(f"{provider.name} failed: {e}")
+    if error is None:
+        raise _circuit_open_error()
+    raise error
+
+async def _ahedged_generate(prompt, image, trace, deadline, primary_token):
+    primary, secondary = primary_provider, openrouter_provider
+    delay = hedge_delay(primary)
+    trace['hedge_delay'] = round(delay, 3)
+    tasks = {asyncio.ensure_future(_call_with_deadline(primary, prompt, image, deadline, primary_token)): primary}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        secondary_token = None if done else _hedge_admitted(secondary, trace)
+        if done:
+            task = done.pop()
+            if task.exception() is None:
+                _won(trace, primary)
+                return task.result()
+            secondary_token = _admit(secondary, trace)
+            if secondary_token is None:
+                raise task.exception()
+            logger.warning(f"{primary.name} failed: {task.exception()}. Falling back to {secondary.name}.")
+            trace['fallback'] = True
+            _decided('fallbacks')
+            tasks = {}
+        elif secondary_token is None:
+            (task,) = tasks
+            try:
+                text = await task
+                _won(trace, primary)
+                return text
+            except Exception as e:
+                secondary_token = _admit(secondary, trace)
+                if secondary_token is None:
+                    raise
+                logger.warning(f"{primary.name} failed: {e}. Falling back to {secondary.name}.")
+                trace['fallback'] = True
+                _decided('fallbacks')
+                tasks = {}
+        else:
+            logger.info(f"{primary.name} has not answered after {delay:.2f}s, hedging with {secondary.name}")
+            trace['hedged'] = True
+            _decided('hedges_fired')
+        tasks[asyncio.ensure_future(_call_with_deadline(secondary, prompt, image, deadline, secondary_token))] = secondary
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    _won(trace, tasks[task])
+                    if trace.get('hedged') and tasks[task] is secondary:
+                        _decided('hedges_won')
+                    return task.result()
+                error = task.exception()
+                logger.warning(f"{tasks[task].name} failed: {error}")
+        raise error
+    finally:
+        # Cancelling the loser aborts its in-flight HTTP request.
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+async def agenerate_ai_response(prompt, image=None, max_retries=3, deadline=None, trace=None):
+    """Async counterpart of generate_ai_response with non-blocking backoff and a per-request deadline.
+
+    deadline is an absolute time.monotonic() value (default REQUEST_DEADLINE from now);
+    provider calls are cut short and retries skipped once it passes.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + REQUEST_DEADLINE
+    trace = {} if trace is None else trace
+    trace['mode'] = ROUTING_MODE if openrouter_provider else 'single'
+    for attempt in range(max_retries):
+        trace['attempts'] = attempt + 1
+        try:
+            providers = _provider_chain()
+            if ROUTING_MODE in ('hedge', 'race') and openrouter_provider:
+                token = _admit(primary_provider, trace)
+                if token is not None:
+                    return await _ahedged_generate(prompt, image, trace, deadline, token)
+                providers = [openrouter_provider]
+            return await _afallback_generate(prompt, image, trace, deadline, providers)
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            if not openrouter_provider:
+                logger.warning(f"AI request attempt {attempt + 1} failed: {e}")
+            wait_time = retry_delay(attempt)
+            if (attempt == max_retries - 1 or time.monotonic() + wait_time >= deadline or _all_open()
+                    or not allow_retry(prompt, image)):
+                raise
+            _decided('retries')
+            logger.info(f"Retrying in {wait_time:.2f} seconds...")
+            with retry_backoff():
+                await asyncio.sleep(wait_time)
+
+def stream_ai_response(prompt, image=None, trace=None):
+    """Yield the model's answer in chunks as the provider generates it.
+
+    Providers are tried in fallback order, skipping open breakers, but only until the
+    first chunk is sent: a stream that fails midway cannot be switched to another
+    provider, so the error is raised to the caller. Hedging and retries do not apply.
+    """
+    trace = {} if trace is None else trace
+    trace['mode'] = 'stream'
+    error = None
+    for provider in _provider_chain():
+        token = _admit(provider, trace)
+        if token is None:
+            continue
+        if provider is not primary_provider:
+            trace['fallback'] = True
+            _decided('fallbacks')
+        breaker = get_breaker(provider.name)
+        start = time.monotonic()
+        emitted = False
+        try:
+            for chunk in provider.stream(prompt, image):
+                if not emitted:
+                    trace['first_chunk_seconds'] = round(time.monotonic() - start, 3)
+                    emitted = True
+                yield chunk
+        except GeneratorExit:
+            breaker.release(token)
+            raise
+        except Exception as e:
+            provider_stats[provider.name].record(time.monotonic() - start, False)
+            breaker.record(time.monotonic() - start, e, token)
+            if emitted:
+                raise
+            error = e
+            logger.warning(f"{provider.name} stream failed: {e}")
+            continue
+        provider_stats[provider.name].record(time.monotonic() - start, True)
+        breaker.record(time.monotonic() - start, token=token)
+        _won(trace, provider)
+        return
+    if error is None:
+        raise _circuit_open_error()
+    raise error
+
+def get_routing_stats():
+    return {
+        'mode': ROUTING_MODE,
+        'decisions': dict(routing_stats),
+        'providers': {name: stats.as_dict() for name, stats in provider_stats.items()},
+    }
+
+async def aclose_providers():
+    if openrouter_provider is not None:
+        await openrouter_provider.aclose()
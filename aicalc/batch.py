@@ -0,0 +1,69 @@
+import os
+import re
+import threading
+
+# /calculate-batch answers a worksheet in one request. Items with the same cache key are
+# solved once, cached and locally solvable ones never reach the model, and the remaining
+# text questions are packed BATCH_PACK_SIZE to a prompt, each answer introduced by a
+# marker so the reply can be split back per question. Images go one per prompt, and a
+# question whose answer is missing from a packed reply is asked again on its own. At most
+# BATCH_CONCURRENCY model calls per batch run at once.
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 50))
+BATCH_PACK_SIZE = max(1, int(os.getenv('BATCH_PACK_SIZE', 5)))
+BATCH_CONCURRENCY = max(1, int(os.getenv('BATCH_CONCURRENCY', 4)))
+
+_ANSWER_MARKER = re.compile(r'<!--ANSWER-(\d+)-->')
+
+_lock = threading.Lock()
+_stats = {
+    'batches': 0,
+    'items': 0,
+    'deduplicated': 0,
+    'cached': 0,
+    'local': 0,
+    'model_calls': 0,
+    'packed_items': 0,
+    'unpacked': 0,
+    'failed': 0,
+}
+
+def pack_questions(questions):
+    """The question part of a prompt asking for several answers at once."""
+    lines = [
+        f"You will be given {len(questions)} separate questions. Solve each one independently. "
+        "Start the answer to question k with the marker <!--ANSWER-k--> on its own line "
+        "(<!--ANSWER-1--> for the first question) and write nothing before the first marker. "
+        "Each answer must stand on its own, including any diagram it needs."
+    ]
+    for number, question in enumerate(questions, 1):
+        lines.append(f"Question {number}: {question}")
+    return '\n'.join(lines)
+
+def split_answers(response_text, count):
+    """Answers from a packed reply, in question order; None where one is missing."""
+    parts = _ANSWER_MARKER.split(response_text)
+    answers = {}
+    for number, text in zip(parts[1::2], parts[2::2]):
+        index = int(number) - 1
+        if 0 <= index < count and index not in answers and text.strip():
+            answers[index] = text.strip()
+    return [answers.get(index) for index in range(count)]
+
+def record_batch(summary):
+    with _lock:
+        _stats['batches'] += 1
+        for name, value in summary.items():
+            if name in _stats:
+                _stats[name] += value
+
+def count(name, value=1):
+    with _lock:
+        _stats[name] += value
+
+def get_batch_stats():
+    with _lock:
+        stats = dict(_stats)
+    stats['pack_size'] = BATCH_PACK_SIZE
+    stats['concurrency'] = BATCH_CONCURRENCY
+    stats['max_items'] = BATCH_MAX_ITEMS
+    return stats
@@ -0,0 +1,132 @@
+from aicalc.config import logger
+from aicalc.redis_client import get_redis
+from aicalc.cache import LRUCache, REDIS_RETRY_INTERVAL
+from aicalc.cleanup import MAX_FILE_AGE
+from io import BytesIO
+from PIL import Image
+import base64
+import os
+import time
+
+# Where rendered diagrams live. 'files' writes them to static/generated as before;
+# 'memory' (per process) and 'redis' (shared by every worker and node) keep the PNG bytes
+# in a blob store served by /diagrams/<name> with an ETag and immutable cache headers, so
+# serving a diagram never touches the disk. Diagrams up to DIAGRAM_INLINE_MAX_BYTES are
+# embedded in the response as data URIs instead, in any mode.
+DIAGRAM_STORAGE = os.getenv('DIAGRAM_STORAGE', 'files').lower()
+DIAGRAM_BLOB_TTL = int(os.getenv('DIAGRAM_BLOB_TTL', MAX_FILE_AGE))
+DIAGRAM_BLOB_MAX_BYTES = int(os.getenv('DIAGRAM_BLOB_MAX_BYTES', 64 * 1024 * 1024))
+DIAGRAM_INLINE_MAX_BYTES = int(os.getenv('DIAGRAM_INLINE_MAX_BYTES', 0))
+DIAGRAM_OPTIMIZE = os.getenv('DIAGRAM_OPTIMIZE', 'true').lower() in ('1', 'true', 'yes')
+BLOB_KEY_PREFIX = 'aicalc:blob:'
+
+def optimize_png(data):
+    """Re-encode a diagram as a 256-colour palette PNG; plots rarely use more colours."""
+    try:
+        with Image.open(BytesIO(data)) as img:
+            quantized = img.convert('RGB').quantize(colors=256)
+            output = BytesIO()
+            quantized.save(output, format='PNG', optimize=True)
+    except Exception as e:
+        logger.warning(f"Could not optimize diagram PNG, keeping the original: {e}")
+        return data
+    optimized = output.getvalue()
+    return optimized if len(optimized) < len(data) else data
+
+def data_uri(data):
+    return 'data:image/png;base64,' + base64.b64encode(data).decode()
+
+class MemoryBlobStore:
+    name = 'memory'
+
+    def __init__(self, max_bytes=DIAGRAM_BLOB_MAX_BYTES, ttl=DIAGRAM_BLOB_TTL):
+        self.blobs = LRUCache(max_entries=max(1, max_bytes // 1024), max_bytes=max_bytes, ttl=ttl)
+
+    def get(self, key):
+        return self.blobs.get(key)
+
+    def put(self, key, data):
+        self.blobs.set(key, data, len(data))
+
+    def touch(self, key):
+        """True if the blob exists; its expiry starts over."""
+        data = self.blobs.get(key)
+        if data is None:
+            return False
+        self.blobs.set(key, data, len(data))
+        return True
+
+    def stats(self):
+        return dict(self.blobs.stats(), backend=self.name)
+
+class RedisBlobStore:
+    name = 'redis'
+
+    def __init__(self, client, ttl=DIAGRAM_BLOB_TTL, prefix=BLOB_KEY_PREFIX):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._disabled_until = 0
+
+    def _available(self):
+        return time.time() >= self._disabled_until
+
+    def _failed(self, error):
+        self.errors += 1
+        self._disabled_until = time.time() + REDIS_RETRY_INTERVAL
+        logger.warning(f"Redis blob store unavailable for {REDIS_RETRY_INTERVAL}s: {error}")
+
+    def get(self, key):
+        if not self._available():
+            return None
+        try:
+            data = self.client.get(self.prefix + key)
+        except Exception as e:
+            self._failed(e)
+            return None
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        if not self._available():
+            return
+        try:
+            self.client.set(self.prefix + key, data, ex=self.ttl)
+        except Exception as e:
+            self._failed(e)
+
+    def touch(self, key):
+        if not self._available():
+            return False
+        try:
+            return bool(self.client.expire(self.prefix + key, self.ttl))
+        except Exception as e:
+            self._failed(e)
+            return False
+
+    def stats(self):
+        return {'backend': self.name, 'hits': self.hits, 'misses': self.misses, 'errors': self.errors}
+
+def create_blob_store(storage=DIAGRAM_STORAGE):
+    if storage == 'redis':
+        client = get_redis()
+        if client is not None:
+            return RedisBlobStore(client)
+        # Files in static/generated are at least shared by the workers on this node; a
+        # per-process store would leave other workers answering 404 for its diagrams.
+        logger.warning("Redis diagram storage requested but unavailable, writing diagrams to files")
+        return None
+    elif storage == 'memory':
+        return MemoryBlobStore()
+    return None
+
+blob_store = create_blob_store()
+
+def get_blob_store_stats():
+    return blob_store.stats() if blob_store is not None else {'backend': 'files'}
@@ -1,31 +1,458 @@
 from aicalc.config import logger
+from aicalc.redis_client import get_redis
+from aicalc.metrics import CACHE_LOOKUPS
+from collections import OrderedDict
 import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
 import time
+import zlib
 
-response_cache = {}
-CACHE_TTL = 3600  # 1 hour
+CACHE_TTL = int(os.getenv('CACHE_TTL', 3600))  # 1 hour
+# 'redis' shares entries across workers, 'memory' keeps the shared tier in-process
+# (tests / local development), 'local' disables the shared tier entirely.
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'redis')
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 2000))
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', 32 * 1024 * 1024))
+CACHE_KEY_PREFIX = os.getenv('CACHE_KEY_PREFIX', 'aicalc:response:')
+REDIS_RETRY_INTERVAL = 30
+# Behind both tiers sits a zlib-compressed SQLite store on local disk, shared by the workers
+# on a host and kept across restarts and deploys. Entries are read from it on demand, so a
+# new worker starts warm without loading anything up front.
+CACHE_PERSIST = os.getenv('CACHE_PERSIST', 'true').lower() in ('1', 'true', 'yes')
+CACHE_PERSIST_PATH = os.getenv('CACHE_PERSIST_PATH', os.path.join(tempfile.gettempdir(), 'aicalc-cache.sqlite'))
+CACHE_PERSIST_TTL = int(os.getenv('CACHE_PERSIST_TTL', 7 * 24 * 3600))
+CACHE_PERSIST_MAX_ENTRIES = int(os.getenv('CACHE_PERSIST_MAX_ENTRIES', 50000))
+CACHE_PERSIST_PRUNE_EVERY = 256
 
-def get_cache_key(image_data=None, text_data=None):
-    if image_data:
+class LRUCache:
+    """In-process LRU tier bounded by entry count and serialized size."""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL):
+        self.name = 'local'
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # _entries is kept in LRU order; _expiry is kept in insertion order, which is
+        # also expiry order because every entry gets the same TTL.
+        self._entries = OrderedDict()
+        self._expiry = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, expires_at = entry
+            if time.time() >= expires_at:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        current_time = time.time()
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._purge_expired(current_time)
+            expires_at = current_time + self.ttl
+            self._entries[key] = (value, size, expires_at)
+            self._expiry[key] = expires_at
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._expiry.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        del self._expiry[key]
+        self._bytes -= size
+
+    def _purge_expired(self, current_time):
+        # Only the oldest entries can have expired, so stop at the first live one:
+        # each entry is visited once over its lifetime, amortized O(1) per insert.
+        while self._expiry:
+            key, expires_at = next(iter(self._expiry.items()))
+            if expires_at > current_time:
+                break
+            self._remove(key)
+            self.expirations += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+        }
+
+class MemorySharedCache:
+    """In-memory stand-in for the shared tier, with the same interface as RedisSharedCache."""
+
+    def __init__(self, ttl=CACHE_TTL):
+        self.name = 'memory'
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                self.hits += 1
+                return entry[0]
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+
+    def set(self, key, payload):
+        current_time = time.time()
+        with self._lock:
+            self._entries.pop(key, None)
+            while self._entries:
+                oldest_key, (_, expires_at) = next(iter(self._entries.items()))
+                if expires_at > current_time:
+                    break
+                del self._entries[oldest_key]
+            self._entries[key] = (payload, current_time + self.ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'entries': len(self._entries),
+        }
+
+class RedisSharedCache:
+    """Shared tier stored in Redis so all gunicorn workers see the same entries."""
+
+    def __init__(self, client, ttl=CACHE_TTL, prefix=CACHE_KEY_PREFIX):
+        self.name = 'redis'
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._disabled_until = 0
+
+    def get(self, key):
+        if not self._available():
+            self.misses += 1
+            return None
+        try:
+            payload = self.client.get(self.prefix + key)
+        except Exception as e:
+            self._failed(e)
+            self.misses += 1
+            return None
+        if payload is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return payload.decode() if isinstance(payload, bytes) else payload
+
+    def set(self, key, payload):
+        if not self._available():
+            return
+        try:
+            self.client.set(self.prefix + key, payload, ex=self.ttl)
+        except Exception as e:
+            self._failed(e)
+
+    def delete(self, key):
+        if not self._available():
+            return
+        try:
+            self.client.delete(self.prefix + key)
+        except Exception as e:
+            self._failed(e)
+
+    def clear(self):
+        try:
+            for key in self.client.scan_iter(match=self.prefix + '*'):
+                self.client.delete(key)
+        except Exception as e:
+            self._failed(e)
+
+    def _available(self):
+        return time.time() >= self._disabled_until
+
+    def _failed(self, error):
+        # Back off instead of paying a socket timeout on every request while Redis is down.
+        self.errors += 1
+        self._disabled_until = time.time() + REDIS_RETRY_INTERVAL
+        logger.warning(f"Redis cache unavailable, using local tier only for {REDIS_RETRY_INTERVAL}s: {error}")
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+        }
+
+class PersistentCache:
+    """Compressed on-disk tier in SQLite, surviving restarts; payloads are JSON strings."""
+
+    def __init__(self, path=CACHE_PERSIST_PATH, ttl=CACHE_PERSIST_TTL, max_entries=CACHE_PERSIST_MAX_ENTRIES):
+        self.name = 'sqlite'
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _db(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, payload BLOB NOT NULL, expires_at REAL NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS responses_expiry ON responses (expires_at)')
+            self._pid = os.getpid()
+        return self._conn
+
+    def _failed(self, error):
+        self.errors += 1
+        logger.warning(f"Persistent cache error: {error}")
+
+    def get(self, key):
+        try:
+            with self._lock:
+                row = self._db().execute('SELECT payload FROM responses WHERE key = ? AND expires_at > ?',
+                                         (key, time.time())).fetchone()
+        except sqlite3.Error as e:
+            self._failed(e)
+            return None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return zlib.decompress(row[0]).decode()
+
+    def set(self, key, payload, expires_at=None):
+        expires_at = expires_at or time.time() + self.ttl
+        blob = zlib.compress(payload.encode(), 6)
+        try:
+            with self._lock:
+                self._db().execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)', (key, blob, expires_at))
+                self._writes += 1
+                if self._writes % CACHE_PERSIST_PRUNE_EVERY == 0:
+                    self._prune()
+        except sqlite3.Error as e:
+            self._failed(e)
+
+    def _prune(self):
+        db = self._db()
+        db.execute('DELETE FROM responses WHERE expires_at <= ?', (time.time(),))
+        db.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY expires_at DESC LIMIT -1 OFFSET ?)',
+                   (self.max_entries,))
+
+    def delete(self, key):
+        try:
+            with self._lock:
+                self._db().execute('DELETE FROM responses WHERE key = ?', (key,))
+        except sqlite3.Error as e:
+            self._failed(e)
+
+    def clear(self):
+        try:
+            with self._lock:
+                self._db().execute('DELETE FROM responses')
+        except sqlite3.Error as e:
+            self._failed(e)
+
+    def items(self):
+        """(key, payload, expires_at) for every live entry, most recently written first."""
+        with self._lock:
+            rows = self._db().execute('SELECT key, payload, expires_at FROM responses WHERE expires_at > ? ORDER BY expires_at DESC',
+                                      (time.time(),)).fetchall()
+        for key, blob, expires_at in rows:
+            yield key, zlib.decompress(blob).decode(), expires_at
+
+    def stats(self):
+        try:
+            with self._lock:
+                entries, size = self._db().execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM responses').fetchone()
+        except sqlite3.Error as e:
+            self._failed(e)
+            entries = size = None
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'entries': entries,
+            'compressed_bytes': size,
+            'max_entries': self.max_entries,
+        }
+
+class TieredCache:
+    """Local LRU tier in front of an optional shared tier and an optional on-disk tier."""
+
+    def __init__(self, local, shared=None, persistent=None):
+        self.local = local
+        self.shared = shared
+        self.persistent = persistent
+        # Set by aicalc/diagram_jobs.py when other workers cannot resolve diagram job ids:
+        # maps a result still waiting for its diagrams to the copy they may serve.
+        self.shareable_pending = None
+
+    def get(self, key):
+        value = self.local.get(key)
+        CACHE_LOOKUPS.labels('local', 'miss' if value is None else 'hit').inc()
+        if value is not None:
+            return value
+        payload = None
+        if self.shared is not None:
+            payload = self.shared.get(key)
+            CACHE_LOOKUPS.labels('shared', 'miss' if payload is None else 'hit').inc()
+        if payload is None and self.persistent is not None:
+            payload = self.persistent.get(key)
+            CACHE_LOOKUPS.labels('persistent', 'miss' if payload is None else 'hit').inc()
+            if payload is not None and self.shared is not None:
+                self.shared.set(key, payload)
+        if payload is None:
+            return None
+        try:
+            value = json.loads(payload)
+        except ValueError:
+            self.delete(key)
+            return None
+        if not value.get('diagrams_pending'):
+            # A copy without the diagrams another worker is rendering is only kept in the
+            # shared tier, so the finished result replaces it for every reader.
+            self.local.set(key, value, len(payload))
+        return value
+
+    def set(self, key, value):
+        payload = json.dumps(value)
+        self.local.set(key, value, len(payload))
+        # A result still waiting for its diagrams carries job ids: when the diagram queue is
+        # per-process the shared tier gets the text without them, and the disk tier gets
+        # nothing until they are filled in, since job ids do not outlive the process.
+        pending = bool(value.get('diagram_jobs') or value.get('diagrams_pending'))
+        if self.shared is not None:
+            if pending and self.shareable_pending is not None:
+                payload = json.dumps(self.shareable_pending(value))
+            self.shared.set(key, payload)
+        if self.persistent is not None and not pending:
+            self.persistent.set(key, payload)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+        if self.persistent is not None:
+            self.persistent.delete(key)
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+        if self.persistent is not None:
+            self.persistent.clear()
+
+    def __len__(self):
+        return len(self.local)
+
+    def __contains__(self, key):
+        return key in self.local
+
+    def stats(self):
+        tiers = {'local': self.local.stats()}
+        if self.shared is not None:
+            tiers['shared'] = dict(self.shared.stats(), backend=self.shared.name)
+        if self.persistent is not None:
+            tiers['persistent'] = dict(self.persistent.stats(), backend=self.persistent.name)
+        return tiers
+
+def create_cache(backend=CACHE_BACKEND, persist=CACHE_PERSIST):
+    local = LRUCache()
+    persistent = PersistentCache() if persist else None
+    if backend == 'redis':
+        client = get_redis()
+        if client is not None:
+            return TieredCache(local, RedisSharedCache(client), persistent)
+        logger.warning("Redis cache backend requested but unavailable, falling back to local cache")
+    elif backend == 'memory':
+        return TieredCache(local, MemorySharedCache(), persistent)
+    return TieredCache(local, persistent=persistent)
+
+response_cache = create_cache()
+
+def get_cache_key(image_data=None, text_data=None, image_hash=None):
+    if image_hash:
+        return hashlib.md5(f"image:{image_hash}".encode()).hexdigest()
+    elif image_data:
         return hashlib.md5(image_data.encode()).hexdigest()
     elif text_data:
         return hashlib.md5(text_data.encode()).hexdigest()
     return None
 
 def get_cached_response(cache_key):
-    if cache_key in response_cache:
-        cached_data, timestamp = response_cache[cache_key]
-        if time.time() - timestamp < CACHE_TTL:
-            logger.info(f"Cache hit for key: {cache_key[:8]}...")
-            return cached_data
-        else:
-            del response_cache[cache_key]
-    return None
+    cached_data = response_cache.get(cache_key)
+    if cached_data is not None:
+        logger.info(f"Cache hit for key: {cache_key[:8]}...")
+    return cached_data
 
 def cache_response(cache_key, response_data):
-    response_cache[cache_key] = (response_data, time.time())
+    response_cache.set(cache_key, response_data)
     logger.info(f"Cached response for key: {cache_key[:8]}...")
-    current_time = time.time()
-    expired_keys = [k for k, (_, ts) in response_cache.items() if current_time - ts > CACHE_TTL]
-    for k in expired_keys:
-        del response_cache[k]
+
+def get_cache_stats():
+    return response_cache.stats()
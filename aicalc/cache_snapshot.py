@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Export, import and pre-seed the persistent response cache, so new nodes start warm.
+Run as `python -m aicalc.cache_snapshot`:
+
+    python -m aicalc.cache_snapshot export snapshot.jsonl.gz
+    python -m aicalc.cache_snapshot import snapshot.jsonl.gz
+    python -m aicalc.cache_snapshot seed questions.txt [--concurrency 2] [--delay 1.0]
+
+A snapshot is gzip-compressed JSON lines of {"key", "value", "expires_at"} taken from the
+on-disk tier (CACHE_PERSIST_PATH). Importing writes entries that have not expired to the
+on-disk tier and, with the Redis backend, the shared tier. Seeding answers each question
+of a corpus (one per line, or JSON lines with a "question" field) the way /calculate-text
+does, skipping questions that are already cached; --delay spaces out the model calls so a
+large corpus does not run into provider rate limits.
+"""
+import argparse
+import gzip
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from aicalc.config import logger
+from aicalc.cache import response_cache
+
+SEED_DIAGRAM_WAIT = 60
+
+def _persistent():
+    if response_cache.persistent is None:
+        sys.exit('The persistent cache is disabled (CACHE_PERSIST=false).')
+    return response_cache.persistent
+
+def export_snapshot(path):
+    count = 0
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        for key, payload, expires_at in _persistent().items():
+            f.write(json.dumps({'key': key, 'value': json.loads(payload), 'expires_at': expires_at}) + '\n')
+            count += 1
+    print(f"Exported {count} entries to {path}")
+
+def import_snapshot(path):
+    persistent = _persistent()
+    now = time.time()
+    imported = expired = 0
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry['expires_at'] <= now:
+                expired += 1
+                continue
+            payload = json.dumps(entry['value'])
+            persistent.set(entry['key'], payload, entry['expires_at'])
+            if response_cache.shared is not None:
+                response_cache.shared.set(entry['key'], payload)
+            imported += 1
+    print(f"Imported {imported} entries from {path} ({expired} expired entries skipped)")
+
+def _read_corpus(path):
+    questions = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                line = json.loads(line).get('question', '').strip()
+            if line:
+                questions.append(line)
+    return questions
+
+def seed(path, concurrency, delay):
+    # Imported here so export and import do not start the AI clients.
+    from aicalc.ai_providers import initialize_ai_model
+    from aicalc.cache import get_cache_key, cache_response
+    from aicalc.diagram_jobs import wait_for_diagram
+    from aicalc.local_solver import solve_locally
+    from aicalc.routes import get_cached_solution, solve_text
+    from aicalc.text_keys import normalize_question
+
+    initialize_ai_model()
+    counts = {'cached': 0, 'local': 0, 'ai': 0, 'failed': 0}
+    pace_lock = threading.Lock()
+    next_call = [0.0]
+
+    def pace():
+        # Model calls start at least `delay` seconds apart; cached and local answers do not wait.
+        with pace_lock:
+            now = time.monotonic()
+            start = max(next_call[0], now)
+            next_call[0] = start + delay
+        time.sleep(start - now)
+
+    def seed_question(question_text):
+        cache_key = get_cache_key(text_data=normalize_question(question_text))
+        if get_cached_solution(cache_key):
+            return 'cached'
+        local_result = solve_locally(question_text)
+        if local_result:
+            cache_response(cache_key, local_result)
+            return 'local'
+        pace()
+        result = solve_text(cache_key, question_text)
+        # Finished diagrams are written back to the cache, which persists the entry.
+        for job_id in result.get('diagram_jobs') or []:
+            wait_for_diagram(job_id, SEED_DIAGRAM_WAIT)
+        return 'ai'
+
+    questions = list(dict.fromkeys(_read_corpus(path)))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [(question_text, executor.submit(seed_question, question_text)) for question_text in questions]
+        for question_text, future in futures:
+            try:
+                counts[future.result()] += 1
+            except Exception as e:
+                logger.error(f"Could not seed {question_text[:40]!r}: {e}")
+                counts['failed'] += 1
+    print(f"Seeded {len(questions)} distinct questions: {counts['ai']} answered by the model, {counts['local']} locally, "
+          f"{counts['cached']} already cached, {counts['failed']} failed")
+
+def main():
+    parser = argparse.ArgumentParser(description='Export, import and pre-seed the persistent response cache')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('export', help='write the on-disk cache to a snapshot').add_argument('path')
+    commands.add_parser('import', help='load a snapshot into the cache').add_argument('path')
+    seed_parser = commands.add_parser('seed', help='answer a corpus of questions into the cache')
+    seed_parser.add_argument('path')
+    seed_parser.add_argument('--concurrency', type=int, default=2)
+    seed_parser.add_argument('--delay', type=float, default=1.0, help='seconds between model calls')
+    args = parser.parse_args()
+    if args.command == 'export':
+        export_snapshot(args.path)
+    elif args.command == 'import':
+        import_snapshot(args.path)
+    else:
+        seed(args.path, args.concurrency, args.delay)
+
+if __name__ == '__main__':
+    main()
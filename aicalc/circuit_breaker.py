@@ -0,0 +1,312 @@
+from aicalc.config import logger
+from aicalc.redis_client import get_redis
+from aicalc.cache import REDIS_RETRY_INTERVAL
+import os
+import threading
+import time
+
+# One breaker per AI provider. A provider whose recent calls mostly fail (or run slower
+# than BREAKER_SLOW_CALL) is opened and skipped without a network call; after
+# BREAKER_OPEN_SECONDS a single probe request is let through (half-open) to decide whether
+# to close it again. With Redis the window counts and state are shared by all workers, so
+# one worker discovering exhausted quota spares the others the failing calls.
+BREAKER_ENABLED = os.getenv('BREAKER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+BREAKER_SHARED = os.getenv('BREAKER_SHARED', 'true').lower() in ('1', 'true', 'yes')
+BREAKER_WINDOW = int(os.getenv('BREAKER_WINDOW', 60))
+BREAKER_BUCKET = 10
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', 5))
+BREAKER_ERROR_RATE = float(os.getenv('BREAKER_ERROR_RATE', 0.5))
+BREAKER_SLOW_CALL = float(os.getenv('BREAKER_SLOW_CALL', 20))
+BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', 30))
+BREAKER_SYNC_INTERVAL = 1.0
+BREAKER_KEY_PREFIX = 'aicalc:breaker:'
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitOpenError(Exception):
+    """Raised when every provider that could serve a request has an open breaker."""
+
+    def __init__(self, message, retry_after=BREAKER_OPEN_SECONDS):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+_QUOTA_ERROR_TYPES = {'ResourceExhausted', 'RateLimitError', 'TooManyRequests'}
+
+def is_quota_error(error):
+    # Exhausted quota will not recover within the window, so it opens the breaker at once.
+    # Judged by status code and exception type only: a message may mention 429 in passing.
+    status = getattr(error, 'status_code', None) or getattr(error, 'code', None)
+    if status == 429:
+        return True
+    return any(cls.__name__ in _QUOTA_ERROR_TYPES for cls in type(error).__mro__)
+
+class CallToken:
+    """Returned by allow() for an admitted call, and handed back to record() or release()."""
+
+    __slots__ = ('probe',)
+
+    def __init__(self, probe=False):
+        self.probe = probe
+
+_ORDINARY_CALL = CallToken()
+
+class CircuitBreaker:
+    # Redis is only ever called with self._lock released, so a slow Redis delays the
+    # call that needs it, not every thread asking this breaker for a decision.
+
+    def __init__(self, name, redis_client=None):
+        self.name = name
+        self.redis = redis_client
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._opened_at = None
+        self._probe = None
+        self._synced_at = 0.0
+        self._redis_down_until = 0.0
+        self._stats = {'opened': 0, 'closed': 0, 'rejected': 0, 'probes': 0}
+
+    def _shared(self):
+        # Same back-off as the shared cache tier: an unreachable Redis is not retried on every call.
+        if self.redis is None or time.monotonic() < self._redis_down_until:
+            return None
+        return self.redis
+
+    def _redis_failed(self, what, error):
+        self._redis_down_until = time.monotonic() + REDIS_RETRY_INTERVAL
+        logger.warning(f"Breaker {what} for {self.name} unavailable in Redis, using local state: {error}")
+
+    def _key(self, suffix):
+        return f"{BREAKER_KEY_PREFIX}{self.name}:{suffix}"
+
+    def _bucket(self, now):
+        return int(now // BREAKER_BUCKET)
+
+    def _window_buckets(self, now):
+        current = self._bucket(now)
+        return range(current - BREAKER_WINDOW // BREAKER_BUCKET + 1, current + 1)
+
+    def _local_window(self, now):
+        buckets = set(self._window_buckets(now))
+        for bucket in [b for b in self._buckets if b not in buckets]:
+            del self._buckets[bucket]
+        calls = sum(self._buckets[b][0] for b in self._buckets)
+        bad = sum(self._buckets[b][1] for b in self._buckets)
+        return calls, bad
+
+    def _shared_window(self, now):
+        keys = []
+        for bucket in self._window_buckets(now):
+            keys += [self._key(f"calls:{bucket}"), self._key(f"bad:{bucket}")]
+        values = [int(v or 0) for v in self._shared().mget(keys)]
+        return sum(values[0::2]), sum(values[1::2])
+
+    def _sync(self, now):
+        """Refresh the open/closed state from Redis at most once per BREAKER_SYNC_INTERVAL."""
+        redis = self._shared()
+        if redis is None or now - self._synced_at < BREAKER_SYNC_INTERVAL:
+            return
+        self._synced_at = now
+        try:
+            opened_at = redis.get(self._key('opened_at'))
+        except Exception as e:
+            self._redis_failed('state', e)
+            return
+        with self._lock:
+            if opened_at is not None:
+                self._opened_at = float(opened_at)
+            elif self._opened_at is not None and self._probe is None:
+                self._opened_at = None
+
+    def state(self):
+        self._sync(time.time())
+        with self._lock:
+            return self._state(time.time())
+
+    def _state(self, now):
+        if self._opened_at is None:
+            return CLOSED
+        if now - self._opened_at < BREAKER_OPEN_SECONDS:
+            return OPEN
+        return HALF_OPEN
+
+    def allow(self):
+        """A CallToken if a call may go to this provider now, else None; half-open admits a single probe."""
+        if not BREAKER_ENABLED:
+            return _ORDINARY_CALL
+        now = time.time()
+        self._sync(now)
+        with self._lock:
+            state = self._state(now)
+            if state == CLOSED:
+                return _ORDINARY_CALL
+            if state != HALF_OPEN or self._probe is not None:
+                self._stats['rejected'] += 1
+                return None
+            # Reserve the probe here, then claim it across workers without the lock.
+            token = self._probe = CallToken(probe=True)
+        if not self._claim_probe():
+            with self._lock:
+                if self._probe is token:
+                    self._probe = None
+                self._stats['rejected'] += 1
+            return None
+        with self._lock:
+            self._stats['probes'] += 1
+        logger.info(f"Breaker for {self.name} half-open, sending a probe request")
+        return token
+
+    def _claim_probe(self):
+        redis = self._shared()
+        if redis is None:
+            return True
+        try:
+            return bool(redis.set(self._key('probe'), '1', nx=True, px=int(BREAKER_OPEN_SECONDS * 1000)))
+        except Exception as e:
+            self._redis_failed('probe lock', e)
+            return True
+
+    def record(self, latency, error=None, token=None):
+        """Count a finished call. Only the probe's own token decides a half-open breaker."""
+        if not BREAKER_ENABLED:
+            return
+        now = time.time()
+        bad = error is not None or latency > BREAKER_SLOW_CALL
+        with self._lock:
+            probe = token is not None and token is self._probe
+            if probe:
+                self._probe = None
+                if bad:
+                    self._mark_open(now, f"probe failed: {error or f'{latency:.1f}s'}")
+                else:
+                    self._mark_closed()
+            else:
+                counts = self._buckets.setdefault(self._bucket(now), [0, 0])
+                counts[0] += 1
+                counts[1] += int(bad)
+                calls, bad_calls = self._local_window(now)
+        if probe:
+            if bad:
+                self._publish_open(now)
+            else:
+                self._publish_closed(now)
+            return
+        shared = self._count_shared(now, bad)
+        if shared is not None:
+            calls, bad_calls = shared
+        with self._lock:
+            if self._opened_at is not None:
+                return
+            if error is not None and is_quota_error(error):
+                self._mark_open(now, f"quota exhausted: {error}")
+            elif calls >= BREAKER_MIN_CALLS and bad_calls / calls >= BREAKER_ERROR_RATE:
+                self._mark_open(now, f"{bad_calls}/{calls} bad calls in the last {BREAKER_WINDOW}s")
+            else:
+                return
+        self._publish_open(now)
+
+    def _count_shared(self, now, bad):
+        """Add the call to the shared window and return its (calls, bad) totals, or None without Redis."""
+        redis = self._shared()
+        if redis is None:
+            return None
+        bucket = self._bucket(now)
+        try:
+            pipe = redis.pipeline(transaction=False)
+            pipe.incr(self._key(f"calls:{bucket}"))
+            if bad:
+                pipe.incr(self._key(f"bad:{bucket}"))
+            pipe.expire(self._key(f"calls:{bucket}"), BREAKER_WINDOW + BREAKER_BUCKET)
+            pipe.expire(self._key(f"bad:{bucket}"), BREAKER_WINDOW + BREAKER_BUCKET)
+            pipe.execute()
+            return self._shared_window(now)
+        except Exception as e:
+            self._redis_failed('counts', e)
+            return None
+
+    def _mark_open(self, now, reason):
+        self._opened_at = now
+        self._stats['opened'] += 1
+        logger.warning(f"Breaker for {self.name} opened ({reason}); skipping it for {BREAKER_OPEN_SECONDS:.0f}s")
+
+    def _publish_open(self, now):
+        redis = self._shared()
+        if redis is not None:
+            try:
+                pipe = redis.pipeline(transaction=False)
+                pipe.set(self._key('opened_at'), now, ex=int(BREAKER_OPEN_SECONDS * 10))
+                pipe.delete(self._key('probe'))
+                pipe.execute()
+            except Exception as e:
+                self._redis_failed('open state', e)
+
+    def _mark_closed(self):
+        self._opened_at = None
+        self._buckets.clear()
+        self._stats['closed'] += 1
+        logger.info(f"Breaker for {self.name} closed, provider recovered")
+
+    def _publish_closed(self, now):
+        redis = self._shared()
+        if redis is not None:
+            try:
+                keys = [self._key('opened_at'), self._key('probe')]
+                for bucket in self._window_buckets(now):
+                    keys += [self._key(f"calls:{bucket}"), self._key(f"bad:{bucket}")]
+                redis.delete(*keys)
+            except Exception as e:
+                self._redis_failed('closed state', e)
+
+    def release(self, token=None):
+        """Give up a call that was cancelled before it produced a result; frees the probe slot if it was the probe."""
+        with self._lock:
+            if token is None or token is not self._probe:
+                return
+            self._probe = None
+        redis = self._shared()
+        if redis is not None:
+            try:
+                redis.delete(self._key('probe'))
+            except Exception as e:
+                self._redis_failed('probe lock', e)
+
+    def retry_after(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            return max(0.0, BREAKER_OPEN_SECONDS - (time.time() - self._opened_at))
+
+    def as_dict(self):
+        now = time.time()
+        self._sync(now)
+        shared = None
+        if self._shared() is not None:
+            try:
+                shared = self._shared_window(now)
+            except Exception:
+                shared = None
+        with self._lock:
+            state = self._state(now)
+            calls, bad = shared if shared is not None else self._local_window(now)
+            stats = dict(self._stats)
+        stats.update({
+            'state': state,
+            'window_calls': calls,
+            'window_error_rate': round(bad / calls, 3) if calls else 0.0,
+        })
+        return stats
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(name):
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, get_redis() if BREAKER_SHARED else None)
+        return _breakers[name]
+
+def get_breaker_states():
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.as_dict() for breaker in breakers}
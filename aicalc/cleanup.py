@@ -1,53 +1,219 @@
 import os
-import glob
+import sqlite3
+import tempfile
+import threading
 import time
 from aicalc.config import logger
 
-CLEANUP_INTERVAL = 3600
-MAX_FILE_AGE = 7200
-MAX_FILES_COUNT = 500
+# Every generated artifact (plots and TikZ renders) is recorded in a small SQLite table
+# ordered by expiry, shared by all workers on the host. The sweep pops what is due in
+# batches instead of listing and stat-ing the directory, and also trims the oldest
+# artifacts when the file count or total size goes over budget.
+GENERATED_DIR = os.path.join('static', 'generated')
+CLEANUP_INTERVAL = int(os.getenv('CLEANUP_INTERVAL', 60))
+MAX_FILE_AGE = int(os.getenv('MAX_FILE_AGE', 7200))
+MAX_FILES_COUNT = int(os.getenv('MAX_FILES_COUNT', 500))
+MAX_GENERATED_BYTES = int(os.getenv('MAX_GENERATED_BYTES', 200 * 1024 * 1024))
+ARTIFACT_INDEX_PATH = os.getenv('ARTIFACT_INDEX_PATH', os.path.join(tempfile.gettempdir(), 'aicalc-artifacts.sqlite'))
+CLEANUP_BATCH = 200
+# Only the worker holding this lock sweeps; when it exits the lock is freed and another
+# worker takes over at its next interval.
+MAINTENANCE_LOCK_PATH = os.getenv('MAINTENANCE_LOCK_PATH', os.path.join(tempfile.gettempdir(), 'aicalc-maintenance.lock'))
+
+class ArtifactIndex:
+    def __init__(self, path=ARTIFACT_INDEX_PATH, root=GENERATED_DIR):
+        self.path = path
+        self.root = root
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats = {'registered': 0, 'expired': 0, 'evicted': 0}
+
+    def _db(self):
+        if self._conn is None or self._pid != os.getpid():
+            created = not os.path.exists(self.path)
+            self._conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS artifacts (name TEXT PRIMARY KEY, size INTEGER NOT NULL, expires_at REAL NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS artifacts_expiry ON artifacts (expires_at)')
+            self._pid = os.getpid()
+            if created:
+                self._adopt_existing()
+        return self._conn
+
+    def _adopt_existing(self):
+        """Index files already on disk, e.g. from before a restart that lost the index."""
+        rows = []
+        for directory, _, files in os.walk(self.root):
+            for filename in files:
+                if not filename.endswith('.png'):
+                    continue
+                full_path = os.path.join(directory, filename)
+                try:
+                    st = os.stat(full_path)
+                except OSError:
+                    continue
+                rows.append((os.path.relpath(full_path, self.root), st.st_size, st.st_mtime + MAX_FILE_AGE))
+        self._conn.executemany('INSERT OR IGNORE INTO artifacts VALUES (?, ?, ?)', rows)
+        if rows:
+            logger.info(f"Indexed {len(rows)} existing generated files")
+
+    def register(self, name, size):
+        with self._lock:
+            self._db().execute('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?)', (name, size, time.time() + MAX_FILE_AGE))
+            self._stats['registered'] += 1
+
+    def touch(self, name):
+        """Push back the expiry of an artifact that is being reused."""
+        now = time.time()
+        with self._lock:
+            # Only rewritten once half the lifetime has passed, so hot diagrams rarely change their row.
+            self._db().execute('UPDATE artifacts SET expires_at = ? WHERE name = ? AND expires_at < ?',
+                               (now + MAX_FILE_AGE, name, now + MAX_FILE_AGE / 2))
+
+    def _take(self, choose):
+        # BEGIN IMMEDIATE lets only one worker claim a batch, so files are not deleted twice.
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            rows = choose(db)
+            db.executemany('DELETE FROM artifacts WHERE name = ?', [(name,) for name, _ in rows])
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return rows
+
+    def _delete_files(self, rows):
+        for name, _ in rows:
+            try:
+                os.remove(os.path.join(self.root, name))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Failed to delete generated file {name}: {e}")
+
+    @staticmethod
+    def _expired(db):
+        return db.execute('SELECT name, size FROM artifacts WHERE expires_at <= ? ORDER BY expires_at LIMIT ?',
+                          (time.time(), CLEANUP_BATCH)).fetchall()
+
+    @staticmethod
+    def _over_budget(db):
+        count, total = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM artifacts').fetchone()
+        victims = []
+        for name, size in db.execute('SELECT name, size FROM artifacts ORDER BY expires_at LIMIT ?', (CLEANUP_BATCH,)):
+            if count <= MAX_FILES_COUNT and total <= MAX_GENERATED_BYTES:
+                break
+            victims.append((name, size))
+            count -= 1
+            total -= size
+        return victims
+
+    def sweep(self):
+        """Delete expired artifacts, then the oldest ones while over the count or byte budget."""
+        expired = evicted = 0
+        with self._lock:
+            while True:
+                rows = self._take(self._expired)
+                self._delete_files(rows)
+                expired += len(rows)
+                if len(rows) < CLEANUP_BATCH:
+                    break
+            while True:
+                rows = self._take(self._over_budget)
+                if not rows:
+                    break
+                self._delete_files(rows)
+                evicted += len(rows)
+            self._stats['expired'] += expired
+            self._stats['evicted'] += evicted
+        if expired or evicted:
+            logger.info(f"Cleanup completed: {expired} expired and {evicted} over-budget files deleted")
+        return expired + evicted
+
+    def stats(self):
+        with self._lock:
+            count, total = self._db().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM artifacts').fetchone()
+            stats = dict(self._stats)
+        stats.update({
+            'live_files': count,
+            'live_bytes': total,
+            'max_files': MAX_FILES_COUNT,
+            'max_bytes': MAX_GENERATED_BYTES,
+        })
+        return stats
+
+artifact_index = ArtifactIndex()
+
+def register_artifact(name, size):
+    try:
+        artifact_index.register(name, size)
+    except sqlite3.Error as e:
+        logger.error(f"Failed to index generated file {name}: {e}")
+
+def touch_artifact(name):
+    try:
+        artifact_index.touch(name)
+    except sqlite3.Error as e:
+        logger.warning(f"Failed to refresh expiry of {name}: {e}")
+
+def get_artifact_stats():
+    return artifact_index.stats()
 
 def cleanup_generated_files():
     try:
-        generated_dir = os.path.join('static', 'generated')
-        if not os.path.exists(generated_dir):
-            return
-        current_time = time.time()
-        files_pattern = os.path.join(generated_dir, 'plot_*.png')
-        files = glob.glob(files_pattern)
-        files.sort(key=lambda x: os.path.getmtime(x))
-        deleted_count = 0
-        for file_path in files:
-            file_age = current_time - os.path.getmtime(file_path)
-            if file_age > MAX_FILE_AGE:
-                try:
-                    os.remove(file_path)
-                    deleted_count += 1
-                    logger.info(f"Deleted old generated file: {os.path.basename(file_path)} (age: {file_age/3600:.1f} hours)")
-                except OSError as e:
-                    logger.error(f"Failed to delete file {file_path}: {e}")
-        remaining_files = [f for f in files if os.path.exists(f)]
-        if len(remaining_files) > MAX_FILES_COUNT:
-            files_to_delete = remaining_files[:-MAX_FILES_COUNT]
-            for file_path in files_to_delete:
-                try:
-                    os.remove(file_path)
-                    deleted_count += 1
-                    logger.info(f"Deleted excess file: {os.path.basename(file_path)} (count management)")
-                except OSError as e:
-                    logger.error(f"Failed to delete excess file {file_path}: {e}")
-        if deleted_count > 0:
-            logger.info(f"Cleanup completed: {deleted_count} files deleted")
-        current_files = len(glob.glob(files_pattern))
-        logger.info(f"Generated files count after cleanup: {current_files}")
+        artifact_index.sweep()
     except Exception as e:
         logger.error(f"Error during cleanup: {e}")
 
+_maintenance_lock = None
+_cleanup_pid = None
+_cleanup_start_lock = threading.Lock()
+
+def hold_maintenance_lock(path=MAINTENANCE_LOCK_PATH):
+    """Whether this process runs the host's maintenance, taking the lock if it is free."""
+    global _maintenance_lock
+    if _maintenance_lock is not None:
+        return True
+    try:
+        import fcntl
+    except ImportError:
+        # No flock on this platform: every worker sweeps, which the index tolerates.
+        return True
+    lock_file = open(path, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _maintenance_lock = lock_file
+    logger.info(f"Worker {os.getpid()} runs background maintenance for this host")
+    return True
+
 def cleanup_worker():
     while True:
         try:
-            cleanup_generated_files()
+            if hold_maintenance_lock():
+                cleanup_generated_files()
             time.sleep(CLEANUP_INTERVAL)
         except Exception as e:
             logger.error(f"Error in cleanup worker: {e}")
             time.sleep(60)
+
+def start_cleanup_worker():
+    """Start the cleanup thread in this process if it is not running yet.
+
+    Called on each request rather than at import, so a preloading gunicorn master
+    never starts a thread before forking its workers.
+    """
+    global _cleanup_pid
+    if _cleanup_pid == os.getpid():
+        return
+    with _cleanup_start_lock:
+        if _cleanup_pid == os.getpid():
+            return
+        threading.Thread(target=cleanup_worker, daemon=True, name='artifact-cleanup').start()
+        _cleanup_pid = os.getpid()
+    logger.info(f"Started cleanup worker thread (interval: {CLEANUP_INTERVAL}s, max age: {MAX_FILE_AGE/3600:.1f}h, "
+                f"budget: {MAX_FILES_COUNT} files / {MAX_GENERATED_BYTES // (1024 * 1024)} MB)")
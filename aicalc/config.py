@@ -7,4 +7,6 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 logger = logging.getLogger(__name__)
 
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
+
 # ...existing config.py code...
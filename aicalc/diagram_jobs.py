@@ -0,0 +1,427 @@
+from aicalc.config import logger, REDIS_URL
+from aicalc.cache import response_cache, cache_response, CACHE_BACKEND
+from aicalc.diagrams import render_diagram_job, find_rendered_diagram, diagram_url
+from aicalc.redis_client import get_redis
+from aicalc.metrics import DIAGRAM_RENDERS, DIAGRAM_QUEUE_DEPTH, observe_stage
+from collections import deque
+from contextlib import contextmanager
+from aicalc.plot_renderer import plot_renderer, get_plot_renderer_stats
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import threading
+import time
+import uuid
+
+# Diagrams render out of band: the solution goes out with a placeholder carrying a job id,
+# and the image arrives through /diagram/<id> (or a "diagram" SSE event). Rendering runs
+# on a bounded pool of threads that drive the plot worker processes and pdflatex. 'local' keeps the queue in this process, 'redis'
+# shares queue and job status across workers, 'inline' renders in the request as before.
+# Cached results carry job ids, so the queue is shared by default whenever the cache is.
+DIAGRAM_QUEUE_BACKEND = os.getenv('DIAGRAM_QUEUE_BACKEND', 'redis' if CACHE_BACKEND == 'redis' else 'local').lower()
+DIAGRAM_WORKERS = int(os.getenv('DIAGRAM_WORKERS', 2))
+DIAGRAM_MAX_QUEUE = int(os.getenv('DIAGRAM_MAX_QUEUE', 32))
+DIAGRAM_JOB_TTL = int(os.getenv('DIAGRAM_JOB_TTL', 600))
+DIAGRAM_KEY_PREFIX = 'aicalc:diagram:'
+DIAGRAM_QUEUE_KEY = 'aicalc:diagram-queue'
+DIAGRAM_RESULT_LOCK_PREFIX = 'aicalc:diagram-result-lock:'
+DIAGRAM_RESULT_LOCK_TIMEOUT = 5
+DIAGRAM_POLL_INTERVAL = 0.2
+LATENCY_WINDOW = 200
+
+DIAGRAM_FAILED_HTML = '<p><em>Diagram generation failed. Please refer to the text solution.</em></p>'
+
+def diagram_html(image_url):
+    return f'<div class="math-diagram-container"><img src="{image_url}" alt="Mathematical Diagram" class="math-diagram"></div>'
+
+def pending_diagram_html(job_id):
+    return (f'<div class="math-diagram-container diagram-pending" data-diagram-job="{job_id}">'
+            '<p><em>Rendering diagram...</em></p></div>')
+
+class DiagramStats:
+    def __init__(self, window=LATENCY_WINDOW):
+        self.counts = {'submitted': 0, 'reused': 0, 'completed': 0, 'failed': 0, 'rejected': 0}
+        self.latencies = deque(maxlen=window)
+        self.render_times = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def record(self, ok, latency, render_seconds):
+        with self._lock:
+            self.counts['completed' if ok else 'failed'] += 1
+            self.latencies.append(latency)
+            if render_seconds is not None:
+                self.render_times.append(render_seconds)
+
+    @staticmethod
+    def _summary(samples):
+        if not samples:
+            return {'avg': None, 'p95': None}
+        ordered = sorted(samples)
+        return {
+            'avg': round(sum(ordered) / len(ordered), 3),
+            'p95': round(ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))], 3),
+        }
+
+    def as_dict(self):
+        with self._lock:
+            stats = dict(self.counts)
+            stats['latency_seconds'] = self._summary(self.latencies)
+            stats['render_seconds'] = self._summary(self.render_times)
+        return stats
+
+diagram_stats = DiagramStats()
+
+class RenderPool:
+    """Render threads, created on first use in each process.
+
+    The renders themselves happen in subprocesses (plot workers, pdflatex), so threads are
+    enough here and model code never runs in this process.
+    """
+
+    def __init__(self, workers=DIAGRAM_WORKERS):
+        self.workers = workers
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, kind, code):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='diagram-render')
+                self._pid = os.getpid()
+                # Start the plot workers now so the first plot does not wait for their imports.
+                self._executor.submit(plot_renderer.start)
+            return self._executor.submit(render_diagram_job, kind, code)
+
+render_pool = RenderPool()
+
+def _complete(queue, job, compiled_image, render_seconds):
+    job['status'] = 'done' if compiled_image else 'failed'
+    job['url'] = diagram_url(compiled_image) if compiled_image else None
+    label = 'matplotlib' if job['kind'] == 'plot' else 'TikZ'
+    if compiled_image:
+        logger.info(f"Successfully generated {label} diagram{job['context']}: {job['url']}")
+    else:
+        logger.warning(f"{label} diagram generation failed{job['context']}, removed from response")
+    diagram_stats.record(compiled_image is not None, time.time() - job['submitted_at'], render_seconds)
+    DIAGRAM_RENDERS.labels(job['kind'], job['status']).inc()
+    if render_seconds is not None:
+        observe_stage(f"render_{job['kind']}", render_seconds)
+    queue.save(job)
+    DIAGRAM_QUEUE_DEPTH.set(queue.depth())
+    if job.get('cache_key'):
+        # The cached solution still has the placeholder; swap in the finished diagram. Other
+        # diagrams of the same solution can finish at the same moment, so the update runs
+        # under a lock keyed by the solution and fills in every job finished so far.
+        with queue.result_lock(job['cache_key']):
+            cached_result = response_cache.get(job['cache_key'])
+            resolved = resolve_diagrams(cached_result) if cached_result else None
+            if resolved is not None:
+                cache_response(job['cache_key'], resolved)
+
+class LocalDiagramQueue:
+    name = 'local'
+
+    def __init__(self, max_queue=DIAGRAM_MAX_QUEUE):
+        self.max_queue = max_queue
+        self.jobs = {}
+        self._events = {}
+        self._lock = threading.Lock()
+        self._result_locks = [threading.Lock() for _ in range(64)]
+
+    def result_lock(self, cache_key):
+        return self._result_locks[hash(cache_key) % len(self._result_locks)]
+
+    def _prune(self):
+        cutoff = time.time() - DIAGRAM_JOB_TTL
+        for job_id in [i for i, job in self.jobs.items() if job['submitted_at'] < cutoff and job['status'] != 'pending']:
+            del self.jobs[job_id]
+            self._events.pop(job_id, None)
+
+    def depth(self):
+        with self._lock:
+            return sum(1 for job in self.jobs.values() if job['status'] == 'pending')
+
+    def enqueue(self, job):
+        with self._lock:
+            self._prune()
+            if sum(1 for j in self.jobs.values() if j['status'] == 'pending') >= self.max_queue:
+                return False
+            self.jobs[job['id']] = job
+            self._events[job['id']] = threading.Event()
+        try:
+            future = render_pool.submit(job['kind'], job['code'])
+        except Exception as e:
+            logger.error(f"Failed to queue diagram: {e}")
+            _complete(self, job, None, None)
+            return True
+        future.add_done_callback(lambda f: self._done(job, f))
+        return True
+
+    def _done(self, job, future):
+        try:
+            compiled_image, render_seconds = future.result()
+        except Exception as e:
+            logger.error(f"Diagram worker failed: {e}")
+            compiled_image, render_seconds = None, None
+        _complete(self, job, compiled_image, render_seconds)
+
+    def save(self, job):
+        with self._lock:
+            self.jobs[job['id']] = job
+            event = self._events.setdefault(job['id'], threading.Event())
+        if job['status'] != 'pending':
+            event.set()
+
+    def load(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def wait(self, job_id, timeout):
+        with self._lock:
+            event = self._events.get(job_id)
+        if event is not None:
+            event.wait(timeout)
+        return self.load(job_id)
+
+class RedisDiagramQueue:
+    """Queue and job status in Redis, so any worker can render a job or report on it."""
+
+    name = 'redis'
+
+    def __init__(self, client, max_queue=DIAGRAM_MAX_QUEUE, workers=DIAGRAM_WORKERS):
+        self.client = client
+        self.max_queue = max_queue
+        self.workers = workers
+        self.fallback = LocalDiagramQueue(max_queue)
+        self._consumers_pid = None
+        self._lock = threading.Lock()
+
+    def _start_consumers(self):
+        with self._lock:
+            if self._consumers_pid == os.getpid():
+                return
+            self._consumers_pid = os.getpid()
+        for i in range(self.workers):
+            threading.Thread(target=self._consume, name=f'diagram-consumer-{i}', daemon=True).start()
+
+    def _consume(self):
+        import redis
+        # BLPOP outlives the short socket timeout of the shared client.
+        client = redis.Redis.from_url(REDIS_URL, socket_timeout=10, socket_connect_timeout=1)
+        while True:
+            try:
+                item = client.blpop(DIAGRAM_QUEUE_KEY, timeout=5)
+                if item is None:
+                    continue
+                job = self.load(item[1].decode())
+                if job is None or job['status'] != 'pending':
+                    continue
+                try:
+                    compiled_image, render_seconds = render_pool.submit(job['kind'], job['code']).result()
+                except Exception as e:
+                    logger.error(f"Diagram worker failed: {e}")
+                    compiled_image, render_seconds = None, None
+                _complete(self, job, compiled_image, render_seconds)
+            except Exception as e:
+                logger.warning(f"Diagram queue consumer error: {e}")
+                time.sleep(1)
+
+    def depth(self):
+        try:
+            return self.client.llen(DIAGRAM_QUEUE_KEY)
+        except Exception:
+            return self.fallback.depth()
+
+    def enqueue(self, job):
+        self._start_consumers()
+        try:
+            if self.client.llen(DIAGRAM_QUEUE_KEY) >= self.max_queue:
+                return False
+            pipe = self.client.pipeline(transaction=False)
+            pipe.set(DIAGRAM_KEY_PREFIX + job['id'], json.dumps(job), ex=DIAGRAM_JOB_TTL)
+            pipe.rpush(DIAGRAM_QUEUE_KEY, job['id'])
+            pipe.execute()
+            return True
+        except Exception as e:
+            logger.warning(f"Redis diagram queue unavailable, rendering in this worker: {e}")
+            return self.fallback.enqueue(job)
+
+    def save(self, job):
+        try:
+            self.client.set(DIAGRAM_KEY_PREFIX + job['id'], json.dumps(job), ex=DIAGRAM_JOB_TTL)
+        except Exception as e:
+            logger.warning(f"Failed to store diagram job {job['id'][:8]}... in Redis: {e}")
+            self.fallback.save(job)
+
+    def load(self, job_id):
+        job = self.fallback.load(job_id)
+        if job is not None:
+            return job
+        try:
+            payload = self.client.get(DIAGRAM_KEY_PREFIX + job_id)
+        except Exception:
+            return None
+        return json.loads(payload) if payload else None
+
+    @contextmanager
+    def result_lock(self, cache_key):
+        # The jobs of one solution can finish in different workers.
+        lock = self.client.lock(DIAGRAM_RESULT_LOCK_PREFIX + cache_key, timeout=DIAGRAM_RESULT_LOCK_TIMEOUT,
+                                blocking_timeout=DIAGRAM_RESULT_LOCK_TIMEOUT)
+        try:
+            acquired = lock.acquire()
+        except Exception as e:
+            logger.warning(f"Diagram result lock unavailable in Redis, locking in this worker only: {e}")
+            acquired = False
+        try:
+            with self.fallback.result_lock(cache_key):
+                yield
+        finally:
+            if acquired:
+                try:
+                    lock.release()
+                except Exception as e:
+                    logger.warning(f"Failed to release diagram result lock {cache_key[:8]}...: {e}")
+
+    def wait(self, job_id, timeout):
+        deadline = time.monotonic() + timeout
+        job = self.load(job_id)
+        while job is not None and job['status'] == 'pending' and time.monotonic() < deadline:
+            time.sleep(DIAGRAM_POLL_INTERVAL)
+            job = self.load(job_id)
+        return job
+
+class InlineDiagramQueue(LocalDiagramQueue):
+    """Renders in the calling thread, as before the queue existed."""
+
+    name = 'inline'
+
+    def enqueue(self, job):
+        self.save(job)
+        compiled_image, render_seconds = render_diagram_job(job['kind'], job['code'])
+        _complete(self, job, compiled_image, render_seconds)
+        return True
+
+def create_queue(backend=DIAGRAM_QUEUE_BACKEND):
+    if backend == 'redis':
+        client = get_redis()
+        if client is not None:
+            return RedisDiagramQueue(client)
+        logger.warning("Redis diagram queue requested but unavailable, using the local queue")
+    elif backend == 'inline':
+        return InlineDiagramQueue()
+    return LocalDiagramQueue()
+
+def without_diagram_jobs(result):
+    """Copy of result other workers can serve: the text, without the diagrams still rendering here."""
+    shared = dict(result)
+    for job_id in shared.pop('diagram_jobs'):
+        shared['solution'] = shared['solution'].replace(pending_diagram_html(job_id), '')
+    shared['has_diagram'] = bool(shared.get('diagram_urls'))
+    shared['diagrams_pending'] = True
+    return shared
+
+diagram_queue = create_queue()
+# With a per-process queue, other workers could not resolve this worker's job ids: they get
+# the text right away, and the whole result once this worker has rendered the diagrams.
+response_cache.shareable_pending = None if diagram_queue.name == 'redis' else without_diagram_jobs
+
+def submit_diagram(kind, code, context='', cache_key=None):
+    """Queue a PLOT or TIKZ block for rendering and return its job id."""
+    job = {
+        'id': uuid.uuid4().hex,
+        'kind': kind,
+        'code': code,
+        'context': context,
+        'cache_key': cache_key,
+        'status': 'pending',
+        'url': None,
+        'submitted_at': time.time(),
+    }
+    diagram_stats.count('submitted')
+    compiled_image = find_rendered_diagram(kind, code)
+    if compiled_image:
+        # Same source as a diagram already on disk: no render, no queue.
+        diagram_stats.count('reused')
+        logger.info(f"Reusing rendered diagram{context}: {compiled_image}")
+        job['status'] = 'done'
+        job['url'] = diagram_url(compiled_image)
+        diagram_queue.save(job)
+    elif not diagram_queue.enqueue(job):
+        diagram_stats.count('rejected')
+        logger.warning(f"Diagram queue full ({diagram_queue.depth()} pending), skipping diagram{context}")
+        job['status'] = 'failed'
+        diagram_queue.save(job)
+    else:
+        DIAGRAM_QUEUE_DEPTH.set(diagram_queue.depth())
+    return job['id']
+
+def _public(job):
+    html = None
+    if job['status'] == 'done':
+        html = diagram_html(job['url'])
+    elif job['status'] == 'failed':
+        html = DIAGRAM_FAILED_HTML
+    return {'id': job['id'], 'status': job['status'], 'url': job['url'], 'html': html}
+
+def get_diagram_job(job_id):
+    job = diagram_queue.load(job_id)
+    return _public(job) if job else None
+
+def wait_for_diagram(job_id, timeout):
+    job = diagram_queue.wait(job_id, timeout)
+    return _public(job) if job else None
+
+def _apply(result, job):
+    pending = result.get('diagram_jobs') or []
+    if job['id'] not in pending or job['status'] == 'pending':
+        return None
+    resolved = dict(result)
+    replacement = diagram_html(job['url']) if job['status'] == 'done' else DIAGRAM_FAILED_HTML
+    resolved['solution'] = result['solution'].replace(pending_diagram_html(job['id']), replacement)
+    if job['status'] == 'done':
+        resolved['diagram_urls'] = (result.get('diagram_urls') or []) + [job['url']]
+        resolved['diagram_url'] = resolved['diagram_urls'][0]
+    remaining = [job_id for job_id in pending if job_id != job['id']]
+    if remaining:
+        resolved['diagram_jobs'] = remaining
+    else:
+        del resolved['diagram_jobs']
+    resolved['has_diagram'] = bool(remaining or resolved.get('diagram_urls'))
+    return resolved
+
+def diagram_jobs_known(result):
+    """False when result waits on a diagram job this worker's queue does not know, so it can never complete here."""
+    if diagram_queue.name == 'redis':
+        # Shared queue: a job that has expired resolves as failed in resolve_diagrams.
+        return True
+    return all(diagram_queue.load(job_id) is not None for job_id in result.get('diagram_jobs') or [])
+
+def resolve_diagrams(result):
+    """Return result with its finished diagrams filled in, or None if there is nothing to update."""
+    resolved = None
+    for job_id in result.get('diagram_jobs') or []:
+        job = diagram_queue.load(job_id)
+        if job is None:
+            if diagram_queue.name != 'redis':
+                # Checked by diagram_jobs_known before a cached result is served.
+                continue
+            job = {'id': job_id, 'status': 'failed', 'url': None}
+        updated = _apply(resolved or result, job)
+        if updated is not None:
+            resolved = updated
+    return resolved
+
+def get_diagram_queue_stats():
+    stats = diagram_stats.as_dict()
+    stats['backend'] = diagram_queue.name
+    stats['queue_depth'] = diagram_queue.depth()
+    stats['workers'] = DIAGRAM_WORKERS
+    stats['plot_workers'] = get_plot_renderer_stats()
+    return stats
@@ -1,58 +1,139 @@
 # ...existing diagrams.py code...
 import os
 import re
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import numpy as np
-import networkx as nx
 import uuid
 import tempfile
 import subprocess
+import hashlib
+import threading
+import time
 from aicalc.config import logger
+from aicalc.metrics import timed
+from aicalc.plot_renderer import render_plot
+from aicalc.cleanup import register_artifact, touch_artifact
+from aicalc.blob_store import blob_store, optimize_png, data_uri, DIAGRAM_OPTIMIZE, DIAGRAM_INLINE_MAX_BYTES
 
-def generate_matplotlib_diagram(python_code, output_filename):
+# Part of every diagram's content address; bump DIAGRAM_CACHE_VERSION when the renderers
+# or the TikZ preamble change so old renders are not reused.
+DIAGRAM_CACHE_VERSION = '2'
+PLOT_RENDER_PARAMS = 'figsize=8x6,dpi=150'
+TIKZ_RENDER_PARAMS = 'border=30pt,r=300'
+GENERATED_DIR = os.path.join('static', 'generated')
+
+# The fixed TikZ preamble is compiled once into a TeX format file, so each diagram only
+# pays for its own picture instead of reloading tikz, pgfplots and the libraries.
+TIKZ_WARM_FORMAT = os.getenv('TIKZ_WARM_FORMAT', 'true').lower() in ('1', 'true', 'yes')
+TIKZ_FORMAT_DIR = os.getenv('TIKZ_FORMAT_DIR', os.path.join(tempfile.gettempdir(), 'aicalc-tex'))
+TIKZ_PREAMBLE = r"""\documentclass[border=30pt]{standalone}
+\usepackage{tikz}
+\usepackage{pgfplots}
+\usepackage{amsmath}
+\usepackage{amssymb}
+\usetikzlibrary{arrows,automata,positioning,shapes,patterns,decorations.pathreplacing,calc,angles,quotes,trees}
+\pgfplotsset{compat=1.18}
+"""
+TIKZ_FORMAT_CHECK = r"""\begin{document}
+\begin{tikzpicture}
+\node[state] (a) {$q_0$};
+\end{tikzpicture}
+\end{document}
+"""
+
+_tikz_format = None
+_tikz_format_lock = threading.Lock()
+
+def _tex_env(format_dir):
+    # Trailing separator keeps TeX's default search path after our directory.
+    return dict(os.environ, TEXFORMATS=format_dir + os.pathsep)
+
+def _tex_version():
+    result = subprocess.run(['pdflatex', '--version'], capture_output=True, text=True, timeout=30)
+    return result.stdout
+
+def _build_tikz_format():
+    # A format file only loads in the TeX build that dumped it, so the version is part of its name.
+    source = _tex_version() + TIKZ_PREAMBLE
+    name = 'aicalc-tikz-' + hashlib.sha256(source.encode()).hexdigest()[:12]
+    if os.path.exists(os.path.join(TIKZ_FORMAT_DIR, name + '.fmt')):
+        return name
+    os.makedirs(TIKZ_FORMAT_DIR, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=TIKZ_FORMAT_DIR) as temp_dir:
+        with open(os.path.join(temp_dir, 'preamble.tex'), 'w') as f:
+            f.write(TIKZ_PREAMBLE + '\\dump\n')
+        start = time.monotonic()
+        result = subprocess.run([
+            'pdflatex', '-ini', '-interaction=nonstopmode', f'-jobname={name}',
+            '-output-directory', temp_dir, '&pdflatex', 'preamble.tex'
+        ], cwd=temp_dir, capture_output=True, text=True, timeout=120)
+        built = os.path.join(temp_dir, name + '.fmt')
+        if result.returncode != 0 or not os.path.exists(built):
+            logger.warning(f"Could not build TikZ format file, using cold pdflatex: {result.stdout[-500:]}")
+            return None
+        with open(os.path.join(temp_dir, 'check.tex'), 'w') as f:
+            f.write(TIKZ_FORMAT_CHECK)
+        check = subprocess.run([
+            'pdflatex', f'-fmt={name}', '-interaction=nonstopmode', '-output-directory', temp_dir, 'check.tex'
+        ], cwd=temp_dir, env=_tex_env(temp_dir), capture_output=True, text=True, timeout=30)
+        if check.returncode != 0:
+            logger.warning(f"TikZ format file failed its check render, using cold pdflatex: {check.stdout[-500:]}")
+            return None
+        # Several worker processes may build at once; the rename makes whichever finishes last win cleanly.
+        os.replace(built, os.path.join(TIKZ_FORMAT_DIR, name + '.fmt'))
+    logger.info(f"Built TikZ format file {name}.fmt in {time.monotonic() - start:.1f}s")
+    return name
+
+def tikz_format():
+    """Name of the precompiled preamble format, or None to fall back to a full pdflatex run."""
+    global _tikz_format
+    if not TIKZ_WARM_FORMAT:
+        return None
+    with _tikz_format_lock:
+        if _tikz_format is None:
+            try:
+                _tikz_format = _build_tikz_format() or False
+            except (OSError, subprocess.SubprocessError) as e:
+                logger.warning(f"Could not build TikZ format file, using cold pdflatex: {e}")
+                _tikz_format = False
+        return _tikz_format or None
+
+def _drop_tikz_format(name):
+    """Stop using a format file that fails where cold pdflatex works, e.g. one left truncated."""
+    global _tikz_format
+    with _tikz_format_lock:
+        if _tikz_format == name:
+            _tikz_format = False
+    logger.warning(f"TikZ format file {name}.fmt failed a render that cold pdflatex managed, using cold pdflatex")
     try:
-        plt.figure(figsize=(8, 6), dpi=100)
-        plt.style.use('default')
-        safe_globals = {
-            'plt': plt,
-            'np': np,
-            'numpy': np,
-            'matplotlib': matplotlib,
-            'nx': nx,
-            'networkx': nx,
-            'sin': np.sin,
-            'cos': np.cos,
-            'tan': np.tan,
-            'log': np.log,
-            'exp': np.exp,
-            'sqrt': np.sqrt,
-            'pi': np.pi,
-            'e': np.e,
-            'linspace': np.linspace,
-            'arange': np.arange,
-            'array': np.array,
-            'range': range,
-            'len': len,
-            'abs': abs,
-            'max': max,
-            'min': min,
-            'python': None,
-        }
-        exec(python_code, safe_globals)
-        output_path = os.path.join('static', 'generated', output_filename)
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        plt.tight_layout()
-        plt.savefig(output_path, dpi=150, bbox_inches='tight', facecolor='white', edgecolor='none')
-        plt.close()
-        return output_filename
-    except Exception as e:
-        logger.error(f"Error generating matplotlib diagram: {str(e)}")
-        plt.close()
+        # The next process to start builds a fresh one.
+        os.remove(os.path.join(TIKZ_FORMAT_DIR, name + '.fmt'))
+    except OSError:
+        pass
+
+def _run_pdflatex(latex_content, temp_dir, format_name):
+    if format_name:
+        command = ['pdflatex', f'-fmt={format_name}']
+        env = _tex_env(TIKZ_FORMAT_DIR)
+    else:
+        latex_content = TIKZ_PREAMBLE + latex_content
+        command = ['pdflatex']
+        env = None
+    tex_file = os.path.join(temp_dir, 'diagram.tex')
+    with open(tex_file, 'w') as f:
+        f.write(latex_content)
+    with timed('pdflatex'):
+        return subprocess.run(command + [
+            '-interaction=nonstopmode',
+            '-output-directory', temp_dir,
+            tex_file
+        ], env=env, capture_output=True, text=True, timeout=30)
+
+def generate_matplotlib_diagram(python_code, output_filename, output_dir=GENERATED_DIR):
+    output_path = os.path.join(output_dir, output_filename)
+    if not render_plot(python_code, os.path.abspath(output_path)):
         return None
+    return output_filename
 
-def generate_tikz_diagram(tikz_code, output_filename):
+def generate_tikz_diagram(tikz_code, output_filename, output_dir=GENERATED_DIR):
     try:
         with tempfile.TemporaryDirectory() as temp_dir:
             cleaned_tikz_code = tikz_code.strip()
@@ -81,31 +162,21 @@ def generate_tikz_diagram(tikz_code, output_filename):
             if 'binary tree' in tikz_code.lower() or 'tree' in tikz_code.lower() or 'wide' in tikz_code.lower():
                 cleaned_tikz_code = f"% Explicit bounding box for wide diagrams\n\\path[use as bounding box] (-12,-8) rectangle (12,6);\n{cleaned_tikz_code}"
             logger.info(f"Processing TikZ code: {cleaned_tikz_code[:200]}...")
-            latex_content = f"""
-\\documentclass[border=30pt]{{standalone}}
-\\usepackage{{tikz}}
-\\usepackage{{pgfplots}}
-\\usepackage{{amsmath}}
-\\usepackage{{amssymb}}
-\\usetikzlibrary{{arrows,automata,positioning,shapes,patterns,decorations.pathreplacing,calc,angles,quotes,trees}}
-\\pgfplotsset{{compat=1.18}}
-
-\\begin{{document}}
+            latex_content = f"""\\begin{{document}}
 \\begin{{tikzpicture}}[auto,node distance=2cm,>=stealth']
 {cleaned_tikz_code}
 \\end{{tikzpicture}}
 \\end{{document}}
 """
-            tex_file = os.path.join(temp_dir, 'diagram.tex')
-            with open(tex_file, 'w') as f:
-                f.write(latex_content)
+            format_name = tikz_format()
             try:
-                result = subprocess.run([
-                    'pdflatex', 
-                    '-interaction=nonstopmode',
-                    '-output-directory', temp_dir,
-                    tex_file
-                ], capture_output=True, text=True, timeout=30)
+                result = _run_pdflatex(latex_content, temp_dir, format_name)
+                if result.returncode != 0 and format_name:
+                    # A stale or damaged format file fails every render; only a cold run tells
+                    # it apart from a picture that does not compile.
+                    result = _run_pdflatex(latex_content, temp_dir, None)
+                    if result.returncode == 0:
+                        _drop_tikz_format(format_name)
                 pdf_file = os.path.join(temp_dir, 'diagram.pdf')
                 if result.returncode != 0:
                     logger.error(f"pdflatex failed with return code {result.returncode}")
@@ -119,17 +190,18 @@ def generate_tikz_diagram(tikz_code, output_filename):
                 if not os.path.exists(pdf_file):
                     logger.error("PDF file was not generated despite successful compilation")
                     return None
-                output_path = os.path.join('static', 'generated', 'tikz', output_filename)
+                output_path = os.path.join(output_dir, 'tikz', output_filename)
                 os.makedirs(os.path.dirname(output_path), exist_ok=True)
                 try:
-                    result = subprocess.run([
-                        'pdftoppm',
-                        '-png',
-                        '-singlefile',
-                        '-r', '300',
-                        pdf_file,
-                        output_path.replace('.png', '')
-                    ], capture_output=True, text=True, timeout=15)
+                    with timed('tikz_rasterize'):
+                        result = subprocess.run([
+                            'pdftoppm',
+                            '-png',
+                            '-singlefile',
+                            '-r', '300',
+                            pdf_file,
+                            output_path.replace('.png', '')
+                        ], capture_output=True, text=True, timeout=15)
                     if result.returncode != 0:
                         logger.error(f"pdftoppm failed with return code {result.returncode}")
                         if result.stderr:
@@ -139,13 +211,14 @@ def generate_tikz_diagram(tikz_code, output_filename):
                 except (subprocess.CalledProcessError, FileNotFoundError) as e:
                     logger.warning(f"pdftoppm failed: {e}, trying ImageMagick convert...")
                     try:
-                        result = subprocess.run([
-                            'convert',
-                            '-density', '300',
-                            '-quality', '100',
-                            pdf_file,
-                            output_path
-                        ], capture_output=True, text=True, timeout=15)
+                        with timed('tikz_rasterize'):
+                            result = subprocess.run([
+                                'convert',
+                                '-density', '300',
+                                '-quality', '100',
+                                pdf_file,
+                                output_path
+                            ], capture_output=True, text=True, timeout=15)
                         if result.returncode != 0:
                             logger.error(f"ImageMagick convert failed with return code {result.returncode}")
                             if result.stderr:
@@ -172,3 +245,116 @@ def generate_tikz_diagram(tikz_code, output_filename):
     except Exception as e:
         logger.error(f"Error generating TikZ diagram: {str(e)}")
         return None
+
+def normalize_diagram_source(code):
+    return '\n'.join(line.rstrip() for line in code.strip().splitlines())
+
+def diagram_filename(kind, code):
+    """Content address of a diagram: the same source and render settings give the same file."""
+    params = PLOT_RENDER_PARAMS if kind == 'plot' else TIKZ_RENDER_PARAMS
+    source = f"{DIAGRAM_CACHE_VERSION}\0{kind}\0{params}\0{normalize_diagram_source(code)}"
+    digest = hashlib.sha256(source.encode()).hexdigest()[:32]
+    return f"plot_{digest}.png" if kind == 'plot' else f"tikz/tikz_{digest}.png"
+
+def find_rendered_diagram(kind, code):
+    """File name of an already rendered copy of this diagram, or None."""
+    compiled_image = diagram_filename(kind, code)
+    if blob_store is not None:
+        return compiled_image if blob_store.touch(os.path.basename(compiled_image)) else None
+    if not os.path.exists(os.path.join(GENERATED_DIR, compiled_image)):
+        return None
+    # Diagrams that keep being reused stay clear of expiry.
+    touch_artifact(compiled_image)
+    return compiled_image
+
+def read_diagram(compiled_image, max_bytes=None):
+    if blob_store is not None:
+        return blob_store.get(os.path.basename(compiled_image))
+    path = os.path.join(GENERATED_DIR, compiled_image)
+    try:
+        if max_bytes is not None and os.path.getsize(path) > max_bytes:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def diagram_url(compiled_image):
+    """Where the browser gets a rendered diagram: a data URI if small enough, else a URL."""
+    if DIAGRAM_INLINE_MAX_BYTES:
+        data = read_diagram(compiled_image, DIAGRAM_INLINE_MAX_BYTES)
+        if data is not None and len(data) <= DIAGRAM_INLINE_MAX_BYTES:
+            return data_uri(data)
+    if blob_store is not None:
+        return f"/diagrams/{os.path.basename(compiled_image)}"
+    return f"/static/generated/{compiled_image}"
+
+def diagram_file_available(image_url):
+    if not image_url or image_url.startswith('data:'):
+        return True
+    if image_url.startswith('/diagrams/'):
+        return blob_store is not None and blob_store.touch(image_url[len('/diagrams/'):])
+    compiled_image = image_url[len('/static/generated/'):]
+    if not os.path.exists(os.path.join(GENERATED_DIR, compiled_image)):
+        return False
+    touch_artifact(compiled_image)
+    return True
+
+def _render(kind, code, output_dir, compiled_image):
+    """Render a block into output_dir under a unique name; path of the PNG, or None."""
+    # Render under a unique name and rename into place, so concurrent renders of the same
+    # source never expose a half-written file.
+    temp_name = os.path.basename(compiled_image)[:-len('.png')] + f".{uuid.uuid4().hex[:8]}.png"
+    if kind == 'plot':
+        if code.startswith('python'):
+            code = '\n'.join(code.split('\n')[1:])
+        rendered = generate_matplotlib_diagram(code, temp_name, output_dir)
+    else:
+        rendered = generate_tikz_diagram(code, temp_name, output_dir)
+    if not rendered:
+        # A converter that failed part way can leave a partial file behind.
+        temp_path = os.path.join(output_dir, os.path.dirname(compiled_image), temp_name)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return None
+    return os.path.join(output_dir, rendered)
+
+def render_diagram_file(kind, code):
+    """Render a PLOT (matplotlib) or TIKZ block; returns its name in static/generated or the blob store, or None."""
+    compiled_image = find_rendered_diagram(kind, code)
+    if compiled_image:
+        return compiled_image
+    compiled_image = diagram_filename(kind, code)
+    if blob_store is not None:
+        # The blob store keeps the bytes: render in a scratch directory, never in static/generated.
+        with tempfile.TemporaryDirectory() as output_dir:
+            rendered_path = _render(kind, code, output_dir, compiled_image)
+            if rendered_path is None:
+                return None
+            with open(rendered_path, 'rb') as f:
+                data = f.read()
+        if DIAGRAM_OPTIMIZE:
+            with timed('png_optimize'):
+                data = optimize_png(data)
+        blob_store.put(os.path.basename(compiled_image), data)
+        return compiled_image
+    rendered_path = _render(kind, code, GENERATED_DIR, compiled_image)
+    if rendered_path is None:
+        return None
+    if DIAGRAM_OPTIMIZE:
+        with open(rendered_path, 'rb') as f:
+            data = f.read()
+        with timed('png_optimize'):
+            data = optimize_png(data)
+        with open(rendered_path, 'wb') as f:
+            f.write(data)
+    output_path = os.path.join(GENERATED_DIR, compiled_image)
+    os.replace(rendered_path, output_path)
+    register_artifact(compiled_image, os.path.getsize(output_path))
+    return compiled_image
+
+def render_diagram_job(kind, code):
+    """Entry point for diagram worker processes: (file name or None, render seconds)."""
+    start = time.monotonic()
+    compiled_image = render_diagram_file(kind, code)
+    return compiled_image, time.monotonic() - start
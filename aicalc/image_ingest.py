@@ -0,0 +1,145 @@
+from aicalc.image_keys import ImageRejected, decode_image_data, decode_image_bytes, flatten_gray, light_background, ink_bbox, INK_THRESHOLD
+from aicalc.metrics import observe_stage
+from collections import deque
+from io import BytesIO
+from PIL import Image, ImageOps
+import base64
+import os
+import threading
+import time
+
+# A drawing is prepared once per request before any provider sees it: cropped to the ink,
+# downscaled to what the vision models use, reduced to grayscale (or 1-bit) and encoded to
+# PNG a single time. Every retry, hedge and provider then reuses the same bytes.
+IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', 1024))
+IMAGE_COLOR_MODE = os.getenv('IMAGE_COLOR_MODE', 'gray').lower()  # 'gray' or '1bit'
+IMAGE_CROP_MARGIN = 24
+INK_SEARCH_SIDE = 512
+LATENCY_WINDOW = 200
+
+class PreparedImage:
+    """An encoded PNG plus the per-provider forms of it, each built at most once."""
+
+    mime_type = 'image/png'
+
+    def __init__(self, png, size):
+        self.png = png
+        self.size = size
+        self._data_url = None
+
+    @property
+    def data_url(self):
+        if self._data_url is None:
+            self._data_url = f"data:{self.mime_type};base64,{base64.b64encode(self.png).decode()}"
+        return self._data_url
+
+class IngestStats:
+    def __init__(self, window=LATENCY_WINDOW):
+        self.uploads = {'json': 0, 'binary': 0}
+        self.upload_bytes = 0
+        self.prepared = 0
+        self.prepared_bytes = 0
+        self.decode_times = deque(maxlen=window)
+        self.prepare_times = deque(maxlen=window)
+        self.encode_times = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record_upload(self, form, size, decode_seconds):
+        observe_stage('decode', decode_seconds)
+        with self._lock:
+            self.uploads[form] += 1
+            self.upload_bytes += size
+            self.decode_times.append(decode_seconds)
+
+    def record(self, size, prepare_seconds, encode_seconds):
+        observe_stage('prepare', prepare_seconds)
+        observe_stage('encode', encode_seconds)
+        with self._lock:
+            self.prepared += 1
+            self.prepared_bytes += size
+            self.prepare_times.append(prepare_seconds)
+            self.encode_times.append(encode_seconds)
+
+    @staticmethod
+    def _avg_ms(samples):
+        return round(sum(samples) / len(samples) * 1000, 2) if samples else None
+
+    def as_dict(self):
+        with self._lock:
+            uploads = sum(self.uploads.values())
+            return {
+                'uploads': dict(self.uploads),
+                'avg_upload_bytes': self.upload_bytes // uploads if uploads else None,
+                'avg_decode_ms': self._avg_ms(self.decode_times),
+                'prepared': self.prepared,
+                'avg_prepared_bytes': self.prepared_bytes // self.prepared if self.prepared else None,
+                'avg_prepare_ms': self._avg_ms(self.prepare_times),
+                'avg_encode_ms': self._avg_ms(self.encode_times),
+                'max_side': IMAGE_MAX_SIDE,
+                'color_mode': IMAGE_COLOR_MODE,
+            }
+
+ingest_stats = IngestStats()
+
+def _find_ink(ink):
+    """Ink bounding box, searched on a mask shrunk to about INK_SEARCH_SIDE pixels."""
+    mask = ink.point(lambda p: 255 if p > INK_THRESHOLD else 0)
+    # Box-averaging the thresholded mask keeps even one-pixel strokes above zero.
+    factor = max(1, max(mask.size) // INK_SEARCH_SIDE)
+    if factor > 1:
+        mask = mask.reduce(factor)
+    bbox = ink_bbox(mask, threshold=0, margin=0)
+    if bbox is None:
+        return None
+    left, top, right, bottom = bbox
+    return (max(left * factor - IMAGE_CROP_MARGIN, 0), max(top * factor - IMAGE_CROP_MARGIN, 0),
+            min(right * factor + IMAGE_CROP_MARGIN, ink.width), min(bottom * factor + IMAGE_CROP_MARGIN, ink.height))
+
+def decode_upload(image):
+    """Decode an upload: a base64 data URL from the JSON form, or raw bytes from a binary body."""
+    if not image:
+        raise ImageRejected('No image provided.')
+    if not isinstance(image, (bytes, str)):
+        raise ImageRejected('Image must be a base64 data URL or raw image bytes.')
+    start = time.perf_counter()
+    if isinstance(image, bytes):
+        img = decode_image_bytes(image)
+        form = 'binary'
+    else:
+        img = decode_image_data(image)
+        form = 'json'
+    ingest_stats.record_upload(form, len(image), time.perf_counter() - start)
+    return img
+
+def prepare_image(img):
+    """Crop, downscale, reduce and encode a decoded drawing once for every provider."""
+    start = time.perf_counter()
+    # Work on light ink over black (the canvas's own look) and turn photos of dark ink on
+    # paper back to their polarity at the end.
+    gray = flatten_gray(img)
+    # Cheap integer reduction first, so the ink search below never runs on a HiDPI canvas.
+    factor = max(gray.size) // (2 * IMAGE_MAX_SIDE)
+    if factor > 1:
+        gray = gray.reduce(factor)
+    light = light_background(gray)
+    ink = ImageOps.invert(gray) if light else gray
+    bbox = _find_ink(ink)
+    if bbox is not None:
+        ink = ink.crop(bbox)
+    if max(ink.size) > IMAGE_MAX_SIDE:
+        ink.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+    if IMAGE_COLOR_MODE == '1bit':
+        ink = ink.point(lambda p: 255 if p > INK_THRESHOLD else 0)
+    gray = ImageOps.invert(ink) if light else ink
+    if IMAGE_COLOR_MODE == '1bit':
+        gray = gray.convert('1')
+    encode_start = time.perf_counter()
+    output = BytesIO()
+    gray.save(output, format='PNG')
+    done = time.perf_counter()
+    prepared = PreparedImage(output.getvalue(), gray.size)
+    ingest_stats.record(len(prepared.png), done - start, done - encode_start)
+    return prepared
+
+def get_ingest_stats():
+    return ingest_stats.as_dict()
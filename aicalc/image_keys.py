@@ -0,0 +1,212 @@
+from aicalc.config import logger
+from aicalc.metrics import timed
+from collections import OrderedDict
+from io import BytesIO
+from PIL import Image, ImageChops, ImageFilter, ImageOps
+import base64
+import binascii
+import os
+import threading
+
+# Drawings are reduced to a square grayscale thumbnail of this size before hashing,
+# so canvas size, stroke offset and single-pixel differences do not change the key.
+CANONICAL_SIZE = 64
+HASH_SIZE = 16  # 16x16 difference hash -> 256-bit key
+INK_THRESHOLD = 48
+INK_MARGIN = 2
+# Hamming distance (in bits) under which two drawings share a cache entry; 0 disables
+# near-duplicate lookups so only identical perceptual hashes are reused.
+IMAGE_HASH_MAX_DISTANCE = int(os.getenv('IMAGE_HASH_MAX_DISTANCE', 0))
+IMAGE_HASH_INDEX_SIZE = int(os.getenv('IMAGE_HASH_INDEX_SIZE', 5000))
+IMAGE_MAX_PIXELS = int(os.getenv('IMAGE_MAX_PIXELS', 16 * 1024 * 1024))
+
+class ImageRejected(ValueError):
+    pass
+
+def decode_image_data(image_data):
+    """Decode a base64 data URL (or bare base64 string) into a loaded PIL image."""
+    if image_data.startswith('data:'):
+        _, comma, image_data = image_data.partition(',')
+        if not comma:
+            raise ImageRejected('Image data URL has no data.')
+    try:
+        raw = base64.b64decode(image_data)
+    except binascii.Error as e:
+        raise ImageRejected('Image data is not valid base64.') from e
+    return decode_image_bytes(raw)
+
+def decode_image_bytes(raw):
+    # UnidentifiedImageError and truncated files are OSErrors; both are the client's upload.
+    try:
+        img = Image.open(BytesIO(raw))
+        # The header is read by open(); refuse oversized images before decoding the pixels.
+        if img.width * img.height > IMAGE_MAX_PIXELS:
+            raise ImageRejected(f"Image is {img.width}x{img.height}, over the {IMAGE_MAX_PIXELS} pixel limit.")
+        img.load()
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ImageRejected('The upload is not a readable image.') from e
+    return img
+
+def flatten_gray(img):
+    """Grayscale copy with any transparency composited onto black."""
+    if img.mode == 'P' and 'transparency' in img.info:
+        img = img.convert('RGBA')
+    if img.mode in ('RGBA', 'LA'):
+        # Over black, compositing is just luminance scaled by alpha.
+        return ImageChops.multiply(img.convert('L'), img.getchannel('A'))
+    return img.convert('L')
+
+def to_ink_on_black(img):
+    """Grayscale copy with bright ink on a black background, whatever the input polarity."""
+    gray = flatten_gray(img)
+    if light_background(gray):
+        gray = ImageOps.invert(gray)
+    return gray
+
+def light_background(gray):
+    width, height = gray.size
+    border = [gray.getpixel((x, y)) for x in (0, width - 1) for y in (0, height // 2, height - 1)]
+    return sum(border) / len(border) > 127
+
+def ink_bbox(gray, threshold=INK_THRESHOLD, margin=INK_MARGIN):
+    """Bounding box of the pixels brighter than threshold, padded by margin, or None."""
+    # The median filter drops isolated specks so a stray pixel cannot stretch the box.
+    mask = gray.filter(ImageFilter.MedianFilter(3)).point(lambda p: 255 if p > threshold else 0)
+    bbox = mask.getbbox()
+    if bbox is None:
+        return None
+    left, top, right, bottom = bbox
+    return (max(left - margin, 0), max(top - margin, 0),
+            min(right + margin, gray.width), min(bottom + margin, gray.height))
+
+def find_ink(gray, search_side):
+    """ink_bbox, searched on a mask box-reduced to about search_side pixels."""
+    factor = max(gray.size) // search_side
+    if factor < 2:
+        return ink_bbox(gray)
+    # A thin stroke leaves at least one ink pixel per row of each block it crosses; a stray
+    # speck leaves less and drops out, as the median filter would drop it at full size.
+    mask = gray.point(lambda p: 255 if p > INK_THRESHOLD else 0)
+    blocks = mask.reduce(factor).point(lambda p: 255 if p * factor >= 255 - factor else 0).getbbox()
+    if blocks is None:
+        return None
+    # Then the exact edge within the blocks found, so moving a drawing keeps its key.
+    left, top, right, bottom = blocks
+    coarse = (max(left - 1, 0) * factor, max(top - 1, 0) * factor,
+              min((right + 1) * factor, gray.width), min((bottom + 1) * factor, gray.height))
+    left, top, right, bottom = mask.crop(coarse).getbbox()
+    left, top, right, bottom = left + coarse[0], top + coarse[1], right + coarse[0], bottom + coarse[1]
+    return (max(left - INK_MARGIN, 0), max(top - INK_MARGIN, 0),
+            min(right + INK_MARGIN, gray.width), min(bottom + INK_MARGIN, gray.height))
+
+def normalize_image(img, size=CANONICAL_SIZE):
+    """Crop to the ink, pad to a square and downsample to a canonical grayscale thumbnail."""
+    gray = to_ink_on_black(img)
+    # The filtering runs at about twice the thumbnail size, not on the full upload: this
+    # runs on every request, cache hits included.
+    bbox = find_ink(gray, 2 * size)
+    if bbox is not None:
+        gray = gray.crop(bbox)
+    side = max(gray.size)
+    square = Image.new('L', (side, side), 0)
+    square.paste(gray, ((side - gray.width) // 2, (side - gray.height) // 2))
+    return ImageOps.autocontrast(square.resize((size, size), Image.LANCZOS, reducing_gap=3.0))
+
+def perceptual_hash(normalized, hash_size=HASH_SIZE):
+    """Difference hash of a normalized thumbnail as an int of hash_size**2 bits."""
+    small = normalized.resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+def format_hash(value, hash_size=HASH_SIZE):
+    return f"{value:0{hash_size * hash_size // 4}x}"
+
+class HammingIndex:
+    """Bounded near-duplicate index over fixed-width hashes.
+
+    Hashes are split into max_distance + 1 bands; by the pigeonhole principle any
+    hash within max_distance bits agrees exactly with a stored one on at least one
+    band, so candidates come from band lookups instead of a full scan.
+    """
+
+    def __init__(self, max_distance, bits=HASH_SIZE * HASH_SIZE, max_entries=IMAGE_HASH_INDEX_SIZE):
+        self.max_distance = max_distance
+        self.bits = bits
+        self.max_entries = max_entries
+        self.band_count = min(max_distance + 1, bits)
+        self.band_bits = -(-bits // self.band_count)
+        self._hashes = OrderedDict()
+        self._bands = [dict() for _ in range(self.band_count)]
+        self._lock = threading.Lock()
+
+    def _band_keys(self, value):
+        mask = (1 << self.band_bits) - 1
+        return [(value >> (i * self.band_bits)) & mask for i in range(self.band_count)]
+
+    def add(self, value):
+        with self._lock:
+            if value in self._hashes:
+                self._hashes.move_to_end(value)
+                return
+            self._hashes[value] = None
+            for band, key in zip(self._bands, self._band_keys(value)):
+                band.setdefault(key, set()).add(value)
+            while len(self._hashes) > self.max_entries:
+                oldest, _ = self._hashes.popitem(last=False)
+                for band, key in zip(self._bands, self._band_keys(oldest)):
+                    bucket = band.get(key)
+                    if bucket is not None:
+                        bucket.discard(oldest)
+                        if not bucket:
+                            del band[key]
+
+    def nearest(self, value):
+        """Closest stored hash within max_distance bits, or None."""
+        with self._lock:
+            if value in self._hashes:
+                return value
+            best, best_distance = None, self.max_distance + 1
+            seen = set()
+            for band, key in zip(self._bands, self._band_keys(value)):
+                for candidate in band.get(key, ()):
+                    if candidate in seen:
+                        continue
+                    seen.add(candidate)
+                    distance = bin(candidate ^ value).count('1')
+                    if distance < best_distance:
+                        best, best_distance = candidate, distance
+            return best
+
+    def __len__(self):
+        return len(self._hashes)
+
+near_duplicate_index = HammingIndex(IMAGE_HASH_MAX_DISTANCE) if IMAGE_HASH_MAX_DISTANCE > 0 else None
+_stats = {'hashed': 0, 'near_duplicate_hits': 0}
+
+def image_hash(img):
+    """Perceptual hash for an image, mapped onto a stored near-duplicate when one is close enough."""
+    with timed('image_hash'):
+        value = perceptual_hash(normalize_image(img))
+    _stats['hashed'] += 1
+    if near_duplicate_index is not None:
+        match = near_duplicate_index.nearest(value)
+        if match is not None and match != value:
+            _stats['near_duplicate_hits'] += 1
+            logger.info(f"Near-duplicate drawing matched (distance {bin(match ^ value).count('1')})")
+            value = match
+    return format_hash(value)
+
+def remember_image_hash(hash_hex):
+    """Make a cached drawing available to later near-duplicate lookups."""
+    if near_duplicate_index is not None:
+        near_duplicate_index.add(int(hash_hex, 16))
+
+def get_image_key_stats():
+    return dict(_stats,
+                max_distance=IMAGE_HASH_MAX_DISTANCE,
+                indexed=len(near_duplicate_index) if near_duplicate_index is not None else 0)
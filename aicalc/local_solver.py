@@ -0,0 +1,197 @@
+from aicalc.config import logger
+from aicalc.mathparse import parse_math, sympy_available, has_unhandled_notation, FUNCTION_NAMES, CONSTANT_NAMES
+from aicalc.text_keys import normalize_whitespace, normalize_case, normalize_unicode, normalize_operators
+import os
+import re
+import threading
+
+# Plain arithmetic, single-variable equations, derivatives and integrals are answered
+# with sympy before /calculate-text pays for a model call. Anything outside what the
+# confidence checks below accept falls through to the AI provider.
+LOCAL_SOLVER_ENABLED = os.getenv('LOCAL_SOLVER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+MAX_POLYNOMIAL_DEGREE = 4
+MAX_INTEGRAND_OPS = 25
+MAX_SOLUTION_LENGTH = 2400
+# Exact answers with longer integers ("10^1000") go to the model, which can explain them.
+MAX_RESULT_DIGITS = 60
+DECIMAL_DIGITS = 15
+
+_INTENT_PATTERNS = (
+    ('diff', re.compile(r'^(?:(?:what is|find) the derivative of|derivative of|differentiate)\b(.*?)(?:with respect to [a-z]|wrt [a-z])?$')),
+    ('integrate', re.compile(r'^(?:(?:what is|find) the integral of|integral of|integrate)\b(.*?)(?:d[a-z]|with respect to [a-z])?$')),
+    ('solve', re.compile(r'^(?:solve for [a-z]|solve|find [a-z])\b[,:]?(.*)$')),
+    ('solve', re.compile(r'^(.*?)[,;]?(?:solve|solve for [a-z])$')),
+    ('evaluate', re.compile(r'^(?:what is|evaluate|calculate|compute)\b(.*)$')),
+    ('evaluate', re.compile(r'^(.*)$')),
+)
+
+_WORD = re.compile(r'[a-z]+')
+# Factorials and d/dx notation are left to the model; see _fully_parsed for the rest.
+_UNSUPPORTED_QUESTION = re.compile(r'!|d/d')
+
+_lock = threading.Lock()
+_stats = {'attempted': 0, 'solved': 0, 'fell_through': 0}
+
+def _latex(sympy, expr):
+    return sympy.latex(expr, ln_notation=True)
+
+def _single_symbol(expr):
+    symbols = list(expr.free_symbols)
+    return symbols[0] if len(symbols) == 1 else None
+
+def _too_long(sympy, *exprs):
+    # Counted in bits: converting a huge integer to a string is itself slow, and capped.
+    max_bits = MAX_RESULT_DIGITS * 3.33
+    return any(abs(n.p).bit_length() > max_bits or n.q.bit_length() > max_bits
+               for expr in exprs for n in expr.atoms(sympy.Rational))
+
+def _fully_parsed(expression):
+    # Every word must be a known function or constant or a single-letter variable, so
+    # nothing the parser would quietly turn into a product (such as "dx" or "by") remains.
+    if has_unhandled_notation(expression):
+        return False
+    return all(len(word) == 1 or word in FUNCTION_NAMES or word in CONSTANT_NAMES for word in _WORD.findall(expression))
+
+def _evaluate(sympy, expr):
+    if expr.free_symbols or isinstance(expr, sympy.Eq):
+        return None
+    # Decimals are taken exactly as written, never guessed into closed forms.
+    floats = expr.atoms(sympy.Float)
+    value = expr.xreplace({f: sympy.Rational(str(f)) for f in floats}).doit()
+    if not value.is_number or value.has(sympy.zoo, sympy.nan, sympy.oo, -sympy.oo):
+        return None
+    if floats:
+        decimal = sympy.N(value, DECIMAL_DIGITS)
+        relation = '=' if sympy.Rational(str(decimal)) == value else '\\approx'
+        steps = [f"<p>Evaluate the expression:</p>\\[ {_latex(sympy, expr)} {relation} {_latex(sympy, decimal)} \\]"]
+        return steps, f"\\( {_latex(sympy, decimal)} \\)"
+    if _too_long(sympy, value):
+        return None
+    steps = [f"<p>Evaluate the expression:</p>\\[ {_latex(sympy, expr)} = {_latex(sympy, value)} \\]"]
+    if not value.is_Integer:
+        steps.append(f"<p>As a decimal: \\( \\approx {sympy.N(value, 10)} \\)</p>")
+    return steps, f"\\( {_latex(sympy, value)} \\)"
+
+def _solve(sympy, expr):
+    equation = expr if isinstance(expr, sympy.Eq) else sympy.Eq(expr, 0)
+    polynomial = sympy.expand(equation.lhs - equation.rhs)
+    var = _single_symbol(polynomial)
+    if var is None or not polynomial.is_polynomial(var):
+        return None
+    degree = sympy.degree(polynomial, var)
+    if degree < 1 or degree > MAX_POLYNOMIAL_DEGREE:
+        return None
+    if _too_long(sympy, polynomial):
+        return None
+    solutions = sympy.solve(polynomial, var)
+    if _too_long(sympy, *solutions):
+        return None
+    if not solutions:
+        steps = [f"<p>Rewrite in standard form:</p>\\[ {_latex(sympy, polynomial)} = 0 \\]",
+                 f"<p>This equation has no solutions for \\( {_latex(sympy, var)} \\).</p>"]
+        return steps, "no solution"
+    steps = [f"<p>Solve for \\( {_latex(sympy, var)} \\):</p>\\[ {_latex(sympy, equation)} \\]",
+             f"<p>Rewrite in standard form:</p>\\[ {_latex(sympy, polynomial)} = 0 \\]"]
+    factored = sympy.factor(polynomial)
+    if degree > 1 and factored != polynomial:
+        steps.append(f"<p>Factor:</p>\\[ {_latex(sympy, factored)} = 0 \\]")
+    answer = ', \\quad '.join(f"{_latex(sympy, var)} = {_latex(sympy, s)}" for s in solutions)
+    steps.append(f"<p>Solutions:</p>\\[ {answer} \\]")
+    return steps, f"\\( {answer} \\)"
+
+def _differentiate(sympy, expr):
+    if isinstance(expr, sympy.Eq):
+        return None
+    var = _single_symbol(expr)
+    if var is None:
+        return None
+    derivative = sympy.diff(expr, var)
+    d = f"\\frac{{d}}{{d{_latex(sympy, var)}}}"
+    steps = [f"<p>Differentiate with respect to \\( {_latex(sympy, var)} \\):</p>"
+             f"\\[ {d}\\left({_latex(sympy, expr)}\\right) = {_latex(sympy, derivative)} \\]"]
+    return steps, f"\\( {_latex(sympy, derivative)} \\)"
+
+def _integrate(sympy, expr):
+    if isinstance(expr, sympy.Eq) or sympy.count_ops(expr) > MAX_INTEGRAND_OPS:
+        return None
+    var = _single_symbol(expr)
+    if var is None:
+        return None
+    from sympy.integrals.manualintegrate import manualintegrate
+    antiderivative = manualintegrate(expr, var)
+    if antiderivative.has(sympy.Integral):
+        return None
+    dvar = _latex(sympy, var)
+    steps = [f"<p>Integrate with respect to \\( {dvar} \\):</p>"
+             f"\\[ \\int {_latex(sympy, expr)} \\, d{dvar} = {_latex(sympy, antiderivative)} + C \\]"]
+    return steps, f"\\( {_latex(sympy, antiderivative)} + C \\)"
+
+_SOLVERS = {
+    'evaluate': _evaluate,
+    'solve': _solve,
+    'diff': _differentiate,
+    'integrate': _integrate,
+}
+
+def _match_intent(text):
+    for intent, pattern in _INTENT_PATTERNS:
+        match = pattern.match(text)
+        if match:
+            expression = match.group(1).strip(' ,;:')
+            if expression:
+                yield intent, expression
+
+def solve_locally(question_text):
+    """Answer simple questions with sympy, or return None to fall through to the AI."""
+    if not LOCAL_SOLVER_ENABLED or not sympy_available():
+        return None
+    import sympy
+    text = question_text
+    for stage in (normalize_whitespace, normalize_case, normalize_unicode, normalize_operators):
+        text = stage(text)
+    with _lock:
+        _stats['attempted'] += 1
+    intents = () if _UNSUPPORTED_QUESTION.search(question_text.lower()) else _match_intent(text)
+    for intent, expression in intents:
+        if not _fully_parsed(expression):
+            continue
+        # Arithmetic is parsed unevaluated so the worked line shows the original expression.
+        expr = parse_math(expression, evaluate=intent != 'evaluate')
+        if expr is None or (intent != 'evaluate' and _too_long(sympy, expr)):
+            continue
+        if intent == 'evaluate' and isinstance(expr, sympy.Eq):
+            # A bare equation such as "2x+3=7" is a request to solve it.
+            intent, expr = 'solve', parse_math(expression)
+        try:
+            answer = _SOLVERS[intent](sympy, expr)
+        except Exception as e:
+            logger.info(f"Local solver declined ({intent}): {e}")
+            answer = None
+        if answer is None:
+            continue
+        steps, final = answer
+        solution = '\n'.join(steps) + f"\n<p><strong>Answer:</strong> {final}</p>"
+        if len(solution) > MAX_SOLUTION_LENGTH:
+            continue
+        with _lock:
+            _stats['solved'] += 1
+        logger.info(f"Local solver answered ({intent}) without calling the AI")
+        return {
+            'success': True,
+            'solution': solution,
+            'has_diagram': False,
+            'diagram_url': None,
+            'api_backend': 'local',
+            'engine': 'local',
+            'cached': False
+        }
+    with _lock:
+        _stats['fell_through'] += 1
+    return None
+
+def get_local_solver_stats():
+    with _lock:
+        stats = dict(_stats)
+    stats['enabled'] = LOCAL_SOLVER_ENABLED
+    stats['offload_ratio'] = round(stats['solved'] / stats['attempted'], 4) if stats['attempted'] else 0.0
+    return stats
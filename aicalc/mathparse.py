@@ -0,0 +1,115 @@
+import re
+
+# Plain-text math is parsed with sympy, whose parser evaluates Python code, so input
+# is restricted to a small alphabet and a whitelist of names before it gets there,
+# and exponents are bounded so "9^9^9" cannot pin a worker.
+MAX_INPUT_LENGTH = 200
+MAX_NUMBER_DIGITS = 30
+MAX_EXPONENT = 1000
+
+# No ",": sympy reads "1,000" and "1,5" as tuples, so 1,000,000 and 1,00,000 would be equal.
+_ALLOWED_CHARS = re.compile(r'^[0-9a-z+\-*/^().= ]*$')
+_IDENTIFIER = re.compile(r'[a-z]+')
+_NUMBER = re.compile(r'\d+')
+# Notation the parser would silently misread: "d/dx" and a bare "dx" become products of
+# d and x, and a factorial or prime is not in the alphabet at all.
+_UNHANDLED_NOTATION = re.compile(r"d/d[a-z]|\bd[a-z]\b|[!'<>∫∑∂]")
+
+FUNCTION_NAMES = {
+    'sin': 'sin', 'cos': 'cos', 'tan': 'tan', 'cot': 'cot', 'sec': 'sec', 'csc': 'csc',
+    'asin': 'asin', 'acos': 'acos', 'atan': 'atan', 'arcsin': 'asin', 'arccos': 'acos', 'arctan': 'atan',
+    'sinh': 'sinh', 'cosh': 'cosh', 'tanh': 'tanh',
+    'ln': 'log', 'exp': 'exp', 'sqrt': 'sqrt', 'abs': 'Abs',
+}
+# No "log": it is base 10 to some and natural to others, so "log 100" stays text and is
+# left to the model rather than answered, or keyed, as "ln 100".
+CONSTANT_NAMES = {'pi': 'pi', 'e': 'E'}
+
+_sympy = None
+_parser = None
+
+def _load_sympy():
+    global _sympy, _parser
+    if _sympy is None:
+        import sympy
+        from sympy.parsing import sympy_parser
+        _sympy, _parser = sympy, sympy_parser
+    return _sympy, _parser
+
+def sympy_available():
+    try:
+        _load_sympy()
+        return True
+    except ImportError:
+        return False
+
+def is_safe_math_text(text):
+    if not text or len(text) > MAX_INPUT_LENGTH or not _ALLOWED_CHARS.match(text):
+        return False
+    # Any other word of two or more letters would become a product: "2 by 3" is 2*b*y*3.
+    for name in _IDENTIFIER.findall(text):
+        if name not in FUNCTION_NAMES and name not in CONSTANT_NAMES and len(name) > 1:
+            return False
+    return all(len(number) <= MAX_NUMBER_DIGITS for number in _NUMBER.findall(text))
+
+def has_unhandled_notation(text):
+    return bool(_UNHANDLED_NOTATION.search(text))
+
+def _namespace(sympy):
+    namespace = {'__builtins__': {}}
+    for name in ('Integer', 'Float', 'Rational', 'Symbol', 'Function', 'Mul', 'Add', 'Pow', 'Eq'):
+        namespace[name] = getattr(sympy, name)
+    for alias, name in FUNCTION_NAMES.items():
+        namespace[alias] = getattr(sympy, name)
+    for alias, name in CONSTANT_NAMES.items():
+        namespace[alias] = getattr(sympy, name)
+    return namespace
+
+def _exponents_bounded(sympy, expr):
+    for node in sympy.preorder_traversal(expr):
+        if isinstance(node, sympy.Pow) and not node.exp.free_symbols:
+            try:
+                if abs(float(node.exp.evalf(15))) > MAX_EXPONENT:
+                    return False
+            except (TypeError, ValueError):
+                return False
+    return True
+
+def parse_math(text, evaluate=True):
+    """Parse a plain-text expression or single equation into sympy.
+
+    Returns an expression, an Eq for "lhs = rhs", or None when the text is not
+    something this parser is willing to handle.
+    """
+    text = text.strip()
+    if not is_safe_math_text(text) or text.count('=') > 1:
+        return None
+    try:
+        sympy, parser = _load_sympy()
+    except ImportError:
+        return None
+    transformations = parser.standard_transformations + (
+        parser.implicit_multiplication_application,
+        parser.convert_xor,
+    )
+    sides = text.split('=')
+    parsed = []
+    try:
+        for side in sides:
+            if not side.strip():
+                return None
+            # Parse unevaluated first so nothing is computed until the exponents are checked.
+            unevaluated = parser.parse_expr(side, global_dict=_namespace(sympy),
+                                            transformations=transformations, evaluate=False)
+            if not _exponents_bounded(sympy, unevaluated):
+                return None
+            if evaluate:
+                parsed.append(parser.parse_expr(side, global_dict=_namespace(sympy),
+                                                transformations=transformations))
+            else:
+                parsed.append(unevaluated)
+    except Exception:
+        return None
+    if len(parsed) == 2:
+        return sympy.Eq(parsed[0], parsed[1], evaluate=False)
+    return parsed[0]
@@ -0,0 +1,62 @@
+import os
+import time
+from contextlib import contextmanager
+from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST,
+                               generate_latest, multiprocess)
+
+# Prometheus metrics for the hot path, served at /metrics. Under gunicorn,
+# PROMETHEUS_MULTIPROC_DIR (set by gunicorn.conf.py) makes every worker write its samples
+# to memory-mapped files in that directory and /metrics merges them, so a scrape sees the
+# whole server whichever worker answers it. An update costs a few microseconds.
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICS_CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+REQUEST_SECONDS = Histogram('aicalc_request_seconds', 'Time to produce a response, by endpoint and status',
+                            ['endpoint', 'status'], buckets=LATENCY_BUCKETS)
+STAGE_SECONDS = Histogram('aicalc_stage_seconds', 'Time spent in each stage of a request or diagram render',
+                          ['stage'], buckets=LATENCY_BUCKETS)
+PROVIDER_SECONDS = Histogram('aicalc_provider_seconds', 'Latency of single model calls, by provider and outcome',
+                             ['provider', 'outcome'], buckets=LATENCY_BUCKETS)
+ROUTING_DECISIONS = Counter('aicalc_routing_decisions_total',
+                            'Routing decisions: provider wins, fallbacks, hedges, retries and skipped breakers',
+                            ['decision'])
+TOKENS = Counter('aicalc_tokens_total', 'Model tokens used, by provider and kind (prompt or completion)',
+                 ['provider', 'kind'])
+CACHE_LOOKUPS = Counter('aicalc_cache_lookups_total', 'Response cache lookups, by tier and result', ['tier', 'result'])
+DIAGRAM_RENDERS = Counter('aicalc_diagram_renders_total', 'Diagram renders, by kind and outcome', ['kind', 'outcome'])
+# With the Redis queue every worker sees the same depth, so take the largest report
+# rather than adding them up. Same setting as aicalc/diagram_jobs.py.
+DIAGRAM_QUEUE_DEPTH = Gauge('aicalc_diagram_queue_depth', 'Diagram jobs queued or rendering',
+                            multiprocess_mode='livemax' if os.getenv('DIAGRAM_QUEUE_BACKEND') == 'redis' else 'livesum')
+
+ADMISSION_DECISIONS = Counter('aicalc_admission_total', 'Admission decisions for model calls, by priority and outcome',
+                              ['priority', 'outcome'])
+ADMISSION_LIMIT = Gauge('aicalc_admission_concurrency_limit', 'Adaptive limit on concurrent model calls',
+                        multiprocess_mode='livesum')
+ADMISSION_WAITING = Gauge('aicalc_admission_waiting', 'Requests queued for a model call', multiprocess_mode='livesum')
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+def record_tokens(provider, prompt_tokens, completion_tokens):
+    if prompt_tokens:
+        TOKENS.labels(provider, 'prompt').inc(prompt_tokens)
+    if completion_tokens:
+        TOKENS.labels(provider, 'completion').inc(completion_tokens)
+
+def render_metrics():
+    """All metrics in the Prometheus text format, merged across workers when multiprocess."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
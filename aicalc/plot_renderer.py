@@ -0,0 +1,144 @@
+from aicalc.config import logger
+import json
+import os
+import queue
+import select
+import subprocess
+import sys
+import threading
+
+# Matplotlib diagrams render in a small pool of long-lived worker processes
+# (aicalc/plot_worker.py) that have matplotlib, numpy and networkx imported and a figure
+# drawn before their first job. Model code never runs in a web worker: each job has a CPU
+# time limit, the worker has a memory cap, output larger than PLOT_MAX_BYTES is refused,
+# and workers are replaced after PLOT_JOBS_PER_WORKER jobs or when one dies or hangs.
+PLOT_WORKERS = int(os.getenv('PLOT_WORKERS', 2))
+PLOT_JOBS_PER_WORKER = int(os.getenv('PLOT_JOBS_PER_WORKER', 100))
+PLOT_CPU_SECONDS = int(os.getenv('PLOT_CPU_SECONDS', 10))
+PLOT_MEMORY_MB = int(os.getenv('PLOT_MEMORY_MB', 512))
+PLOT_MAX_BYTES = int(os.getenv('PLOT_MAX_BYTES', 5 * 1024 * 1024))
+PLOT_RENDER_TIMEOUT = float(os.getenv('PLOT_RENDER_TIMEOUT', 30))
+PLOT_START_TIMEOUT = 30
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class PlotWorkerError(Exception):
+    pass
+
+class PlotWorker:
+    def __init__(self):
+        env = dict(os.environ, OPENBLAS_NUM_THREADS='1', OMP_NUM_THREADS='1', MPLBACKEND='Agg')
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'aicalc.plot_worker', '--memory-mb', str(PLOT_MEMORY_MB)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            cwd=PROJECT_ROOT, env=env, text=True, bufsize=1)
+        self.ready = False
+        self.jobs = 0
+
+    def _read(self, timeout):
+        readable, _, _ = select.select([self.process.stdout], [], [], timeout)
+        if not readable:
+            raise TimeoutError(f"plot worker did not answer within {timeout:.0f}s")
+        line = self.process.stdout.readline()
+        if not line:
+            raise PlotWorkerError(f"plot worker exited with code {self.process.wait()}")
+        return json.loads(line)
+
+    def render(self, code, output_path):
+        if not self.ready:
+            self._read(PLOT_START_TIMEOUT)
+            self.ready = True
+        self.jobs += 1
+        try:
+            self.process.stdin.write(json.dumps({
+                'code': code,
+                'path': output_path,
+                'cpu_seconds': PLOT_CPU_SECONDS,
+                'max_bytes': PLOT_MAX_BYTES,
+            }) + '\n')
+            self.process.stdin.flush()
+        except OSError as e:
+            raise PlotWorkerError(f"plot worker is gone: {e}")
+        return self._read(PLOT_RENDER_TIMEOUT)
+
+    def stop(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=2)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+class PlotRenderer:
+    """Pool of plot workers, started on first use in each process."""
+
+    def __init__(self, workers=PLOT_WORKERS):
+        self.workers = workers
+        self._idle = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats = {'jobs': 0, 'failed': 0, 'timeouts': 0, 'crashed': 0, 'recycled': 0}
+
+    def start(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._idle = queue.Queue()
+                for _ in range(self.workers):
+                    self._idle.put(PlotWorker())
+                self._pid = os.getpid()
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def render(self, code, output_path):
+        """Render plot code to output_path; returns True on success."""
+        self.start()
+        worker = self._idle.get()
+        replace = False
+        try:
+            reply = worker.render(code, output_path)
+            self._count('jobs')
+            if not reply['ok']:
+                self._count('failed')
+                logger.error(f"Error generating matplotlib diagram: {reply['error']}")
+            return reply['ok']
+        except TimeoutError as e:
+            self._count('timeouts')
+            logger.error(f"Error generating matplotlib diagram: {e}")
+            replace = True
+            return False
+        except (PlotWorkerError, ValueError) as e:
+            # Usually the CPU or memory limit killing the worker mid-job.
+            self._count('crashed')
+            logger.error(f"Error generating matplotlib diagram: {e}")
+            replace = True
+            return False
+        finally:
+            if replace or worker.jobs >= PLOT_JOBS_PER_WORKER:
+                if replace:
+                    worker.process.kill()
+                else:
+                    self._count('recycled')
+                worker.stop()
+                try:
+                    # The replacement warms up while it waits in the idle queue.
+                    worker = PlotWorker()
+                except OSError as e:
+                    # Keep the dead one in the pool; the next job fails over to a new start.
+                    logger.error(f"Could not start a plot worker: {e}")
+            self._idle.put(worker)
+
+    def as_dict(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['workers'] = self.workers
+        stats['jobs_per_worker'] = PLOT_JOBS_PER_WORKER
+        return stats
+
+plot_renderer = PlotRenderer()
+
+def render_plot(code, output_path):
+    return plot_renderer.render(code, output_path)
+
+def get_plot_renderer_stats():
+    return plot_renderer.as_dict()
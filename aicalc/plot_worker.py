@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Matplotlib render worker, started by aicalc/plot_renderer.py as
+`python -m aicalc.plot_worker`.
+
+Reads one JSON job per line on stdin ({"code", "path", "cpu_seconds", "max_bytes"}) and
+answers each with one JSON line on the original stdout. Model code runs here, never in a
+web worker: each job gets its own Figure through the object-oriented Agg API, a CPU-time
+limit and an output-size cap, and the process has a memory cap. Anything the model code
+prints goes to stderr so it cannot corrupt the protocol.
+"""
+import argparse
+import builtins
+import io
+import json
+import os
+import resource
+import sys
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot
+from matplotlib.axes import Axes
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import numpy as np
+import networkx as nx
+
+FIGSIZE = (8, 6)
+AXES_ALIASES = {
+    'title': 'set_title',
+    'xlabel': 'set_xlabel',
+    'ylabel': 'set_ylabel',
+    'xlim': 'set_xlim',
+    'ylim': 'set_ylim',
+    'xscale': 'set_xscale',
+    'yscale': 'set_yscale',
+}
+NO_OPS = ('show', 'close', 'savefig', 'ion', 'ioff', 'pause', 'draw')
+
+class PyplotShim:
+    """The pyplot calls model code makes, bound to this job's Figure instead of global state."""
+
+    def __init__(self, figure):
+        self._figure = figure
+        self._axes = None
+
+    def gcf(self):
+        return self._figure
+
+    def gca(self):
+        if self._axes is None:
+            self._axes = self._figure.axes[-1] if self._figure.axes else self._figure.add_subplot()
+        return self._axes
+
+    def sca(self, axes):
+        self._axes = axes
+
+    def figure(self, *args, figsize=None, **kwargs):
+        # One figure per job; a second plt.figure() keeps drawing on the same one.
+        if figsize:
+            self._figure.set_size_inches(figsize)
+        return self._figure
+
+    def subplots(self, nrows=1, ncols=1, figsize=None, dpi=None, **kwargs):
+        self._figure.clear()
+        if figsize:
+            self._figure.set_size_inches(figsize)
+        axes = self._figure.subplots(nrows, ncols, **kwargs)
+        self._axes = axes.flat[0] if hasattr(axes, 'flat') else axes
+        return self._figure, axes
+
+    def subplot(self, *args, **kwargs):
+        self._axes = self._figure.add_subplot(*args, **kwargs)
+        return self._axes
+
+    def axes(self, rect=None, **kwargs):
+        # Axes has an `axes` attribute too, so __getattr__ would hand back the current axes.
+        self._axes = self._figure.add_subplot(**kwargs) if rect is None else self._figure.add_axes(rect, **kwargs)
+        return self._axes
+
+    def colorbar(self, mappable=None, ax=None, **kwargs):
+        if mappable is None:
+            mappable = self.gca().collections[-1] if self.gca().collections else self.gca().images[-1]
+        return self._figure.colorbar(mappable, ax=ax or self.gca(), **kwargs)
+
+    def _ticks(self, axis, ticks=None, labels=None, **kwargs):
+        axes = self.gca()
+        if ticks is not None:
+            getattr(axes, f'set_{axis}ticks')(ticks, labels)
+        for label in getattr(axes, f'get_{axis}ticklabels')():
+            label.update(kwargs)
+
+    def xticks(self, *args, **kwargs):
+        self._ticks('x', *args, **kwargs)
+
+    def yticks(self, *args, **kwargs):
+        self._ticks('y', *args, **kwargs)
+
+    def __getattr__(self, name):
+        if name in NO_OPS:
+            return lambda *args, **kwargs: None
+        if name in AXES_ALIASES:
+            return getattr(self.gca(), AXES_ALIASES[name])
+        if hasattr(Axes, name):
+            return getattr(self.gca(), name)
+        if hasattr(Figure, name):
+            return getattr(self._figure, name)
+        # Classes and registries (plt.cm, plt.style, plt.Circle, plt.rcParams, ...).
+        return getattr(matplotlib.pyplot, name)
+
+class NetworkxShim:
+    """networkx with its draw functions pointed at the job's axes rather than pyplot's."""
+
+    def __init__(self, pyplot):
+        self._pyplot = pyplot
+
+    def __getattr__(self, name):
+        attr = getattr(nx, name)
+        if not (name.startswith('draw') and callable(attr)):
+            return attr
+
+        def draw(*args, **kwargs):
+            kwargs.setdefault('ax', self._pyplot.gca())
+            return attr(*args, **kwargs)
+        return draw
+
+class MatplotlibShim:
+    """The matplotlib package as model code sees it, with pyplot bound to the job's Figure."""
+
+    def __init__(self, pyplot):
+        self.pyplot = pyplot
+
+    def __getattr__(self, name):
+        return getattr(matplotlib, name)
+
+def job_import(pyplot, networkx):
+    """__import__ for model code: `import matplotlib.pyplot as plt` must get the shim, not
+    the real pyplot, or the job's Figure stays empty."""
+    shims = {'matplotlib': MatplotlibShim(pyplot), 'networkx': networkx}
+
+    def _import(name, globals=None, locals=None, fromlist=(), level=0):
+        module = builtins.__import__(name, globals, locals, fromlist, level)
+        if level:
+            return module
+        if name == 'matplotlib.pyplot' and fromlist:
+            return pyplot
+        if name == 'networkx' or (name.partition('.')[0] == 'matplotlib' and (not fromlist or name == 'matplotlib')):
+            return shims[name.partition('.')[0]]
+        return module
+    return _import
+
+def drew_something(figure):
+    if figure.artists or figure.lines or figure.patches or figure.texts or figure.images:
+        return True
+    return any(axes.has_data() or axes.texts or axes.artists or axes.tables for axes in figure.axes)
+
+def render(code):
+    """Run model plot code on a fresh Figure and return the PNG bytes."""
+    with matplotlib.rc_context():
+        # Style changes made by a previous job's code must not leak into this one.
+        matplotlib.rcdefaults()
+        figure = Figure(figsize=FIGSIZE, dpi=100)
+        FigureCanvasAgg(figure)
+        pyplot = PyplotShim(figure)
+        networkx = NetworkxShim(pyplot)
+        safe_globals = {
+            '__builtins__': dict(vars(builtins), __import__=job_import(pyplot, networkx)),
+            'plt': pyplot,
+            'np': np,
+            'numpy': np,
+            'matplotlib': MatplotlibShim(pyplot),
+            'nx': networkx,
+            'networkx': networkx,
+            'sin': np.sin,
+            'cos': np.cos,
+            'tan': np.tan,
+            'log': np.log,
+            'exp': np.exp,
+            'sqrt': np.sqrt,
+            'pi': np.pi,
+            'e': np.e,
+            'linspace': np.linspace,
+            'arange': np.arange,
+            'array': np.array,
+            'range': range,
+            'len': len,
+            'abs': abs,
+            'max': max,
+            'min': min,
+            'python': None,
+        }
+        exec(code, safe_globals)
+        if not drew_something(figure):
+            # Saving would cache a blank PNG as a successful render.
+            raise ValueError('the plot code drew nothing on the figure')
+        figure.tight_layout()
+        output = io.BytesIO()
+        figure.savefig(output, format='png', dpi=150, bbox_inches='tight', facecolor='white', edgecolor='none')
+    return output.getvalue()
+
+def _limit_memory(memory_mb):
+    # The cap is headroom above what the interpreter and libraries already map.
+    try:
+        with open('/proc/self/statm') as f:
+            baseline = int(f.read().split()[0]) * resource.getpagesize()
+    except OSError:
+        baseline = 0
+    limit = baseline + memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, resource.getrlimit(resource.RLIMIT_AS)[1]))
+
+def _limit_cpu(seconds):
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = usage.ru_utime + usage.ru_stime
+    # RLIMIT_CPU counts the whole process, so each job's allowance starts from what is used
+    # so far; going over it delivers SIGXCPU and the renderer replaces this worker.
+    resource.setrlimit(resource.RLIMIT_CPU, (int(used) + 1 + seconds, resource.getrlimit(resource.RLIMIT_CPU)[1]))
+
+def run_job(job):
+    _limit_cpu(job['cpu_seconds'])
+    try:
+        png = render(job['code'])
+    except MemoryError:
+        return {'ok': False, 'error': 'memory limit exceeded'}
+    except Exception as e:
+        return {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+    if len(png) > job['max_bytes']:
+        return {'ok': False, 'error': f"output is {len(png)} bytes, over the {job['max_bytes']} byte cap"}
+    os.makedirs(os.path.dirname(job['path']), exist_ok=True)
+    with open(job['path'], 'wb') as f:
+        f.write(png)
+    return {'ok': True, 'bytes': len(png)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Matplotlib render worker')
+    parser.add_argument('--memory-mb', type=int, default=0)
+    args = parser.parse_args()
+    protocol = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+    # Warm up font loading and the Agg renderer before the first real job.
+    render('plt.plot([0, 1], [0, 1]); plt.title("warm-up")')
+    if args.memory_mb:
+        _limit_memory(args.memory_mb)
+    protocol.write(json.dumps({'ready': True}) + '\n')
+    protocol.flush()
+    for line in sys.stdin:
+        protocol.write(json.dumps(run_job(json.loads(line))) + '\n')
+        protocol.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import html
+import re
+
+# Model replies are cleaned in one pass of one precompiled pattern: code fences are
+# dropped, every PLOT and TIKZ block is handed to on_diagram (its return value, a
+# placeholder, takes the block's place), and markup that could run script in the page
+# is removed: script and style blocks, embedding and form tags, on* event handlers and
+# javascript: URLs, also when written with entities ("&#106;avascript:") or with "/" in
+# place of a space ("<svg/onload=...>"). aicalc/streaming.py does the same incrementally
+# for streamed replies.
+DIAGRAM_MARKERS = {
+    'plot': ('<!--PLOT-START-->', '<!--PLOT-END-->'),
+    'tikz': ('<!--TIKZ-START-->', '<!--TIKZ-END-->'),
+}
+UNSAFE_TAGS = ('script', 'style', 'iframe', 'frame', 'frameset', 'object', 'embed', 'applet',
+               'base', 'link', 'meta', 'form', 'input', 'button', 'textarea', 'select')
+
+# The inside of a tag, up to its closing '>'. A quote only opens a value right after '=',
+# as in the browser, and a quoted value may hold '<' and '>'. Written so each character
+# can be matched one way only, which keeps a failed match linear.
+TAG_BODY = r'''(?:=\s*(?:"[^"]*"|'[^']*'|(?![\s"']))|[^>=])*'''
+
+FENCE_PATTERN = re.compile(r'\s*```\w*\s*')
+# Every alternative starts with a literal '<' or '`', so the scan skips straight to the
+# next candidate instead of trying each alternative at every character.
+_UNSAFE_HTML = (
+    r'<(?i:(?P<block>script|style)\b.*?</(?P=block)\s*>)'
+    r'|<(?i:/?(?:' + '|'.join(UNSAFE_TAGS) + r')\b' + TAG_BODY + '>)'
+    # Any tag with attributes; _clean_tag drops event handlers and script URLs.
+    r'|<(?P<tag>(?i:[a-z][\w-]*[\s/]' + TAG_BODY + '>))'
+)
+_RESPONSE_TOKENS = re.compile(
+    r'<!--(?P<kind>PLOT|TIKZ)-START-->(?P<code>.*?)<!--(?P=kind)-END-->'
+    r'|```\w*\s*'
+    r'|' + _UNSAFE_HTML,
+    re.DOTALL)
+_SANITIZE_PATTERN = re.compile(_UNSAFE_HTML, re.DOTALL)
+_TAG_NAME = re.compile(r'[a-z][\w-]*', re.IGNORECASE)
+# Browsers split attributes on "/" as well as whitespace.
+_ATTRIBUTE = re.compile(r'''[\s/]+([^\s/>=]+)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s>]+))?''')
+_SCRIPT_SCHEME = re.compile(r'(?:javascript:|vbscript:|data:text/html)', re.IGNORECASE)
+# Whitespace and control characters browsers skip inside a URL scheme.
+_IGNORED_IN_SCHEME = re.compile(r'[\x00-\x20]+')
+
+def strip_fences(text):
+    return FENCE_PATTERN.sub('', text)
+
+def _clean_attribute(match):
+    name, value = match.groups()
+    if name.lower().startswith('on'):
+        return ''
+    if value is not None:
+        url = _IGNORED_IN_SCHEME.sub('', html.unescape(value.strip('"\'')))
+        if _SCRIPT_SCHEME.match(url):
+            return f' {name}="#"'
+    return match.group(0)
+
+def _clean_tag(tag):
+    name = _TAG_NAME.match(tag).group(0)
+    return '<' + name + _ATTRIBUTE.sub(_clean_attribute, tag[len(name):])
+
+def _sanitize_match(match):
+    tag = match.group('tag')
+    return _clean_tag(tag) if tag else ''
+
+def sanitize_html(text):
+    """Remove markup that could run script, leaving everything else as it is."""
+    return _SANITIZE_PATTERN.sub(_sanitize_match, text)
+
+def clean_response(response_text, on_diagram):
+    """Strip fences, sanitize and replace each diagram block with on_diagram(kind, code)."""
+    out = []
+    position = 0
+    for match in _RESPONSE_TOKENS.finditer(response_text):
+        text = response_text[position:match.start()]
+        position = match.end()
+        kind = match.group('kind')
+        if kind:
+            out.append(text)
+            out.append(on_diagram(kind.lower(), strip_fences(match.group('code')).strip()))
+        elif response_text[match.start()] == '`':
+            # Whitespace before a fence goes with it.
+            out.append(text.rstrip())
+        else:
+            out.append(text)
+            out.append(_sanitize_match(match))
+    out.append(response_text[position:])
+    return ''.join(out)
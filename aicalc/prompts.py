@@ -0,0 +1,43 @@
+# Prompt templates, assembled once at import. Both endpoints share the formatting and
+# diagram instructions; text questions are appended to TEXT_PROMPT by text_prompt().
+FORMAT_INSTRUCTIONS = (
+    "Format your response as HTML with MathJax-compatible LaTeX for all mathematical expressions. "
+    "Use \\( \\) for inline math and \\[ \\] for display math. "
+)
+
+DIAGRAM_INSTRUCTIONS = (
+    "If the problem would benefit from a visual diagram, choose the appropriate method: "
+    "For simple plots, graphs, and statistical charts, use Python matplotlib code wrapped in <!--PLOT-START--> and <!--PLOT-END--> tags. "
+    "For complex diagrams like DFAs, NFAs, flowcharts, automata, trees, complex geometric constructions, or formal structures, "
+    "use TikZ code wrapped in <!--TIKZ-START--> and <!--TIKZ-END--> tags. "
+    "For matplotlib: Use plt, np, numpy, matplotlib and standard math functions with proper labels and titles. "
+    "For TikZ: Use standard TikZ syntax with automata, positioning, shapes libraries available. "
+    "When creating TikZ tree diagrams, ensure adequate spacing between nodes by using appropriate sibling distances. "
+    "For binary trees, use sibling distances of at least 4cm for level 1, 2cm for level 2, 1cm for level 3, etc. "
+    "Make sure nodes don't overlap and text is clearly readable. "
+    "IMPORTANT: Do not include any markdown code block markers (like ```python or ```) in your response. "
+    "IMPORTANT: Choose TikZ for formal computer science diagrams, automata, complex geometric proofs, trees. "
+    "Choose matplotlib for function plots, statistical charts, simple geometric shapes. "
+)
+
+IMAGE_PROMPT = (
+    "You will be provided an image file containing a mathematical expression. "
+    "The image has a black background with the math expression drawn in white or other colors. "
+    "Identify the mathematical expression and provide a complete solution. "
+    + FORMAT_INSTRUCTIONS
+    + "Include step-by-step explanations where appropriate. "
+    + DIAGRAM_INSTRUCTIONS
+    + "Do not reference 'python' as a variable or function name. "
+    "Keep your response concise and focused on the solution."
+)
+
+TEXT_PROMPT = (
+    "You will be provided with a mathematical question in text format. "
+    "Provide a complete solution with step-by-step explanations. "
+    + FORMAT_INSTRUCTIONS
+    + DIAGRAM_INSTRUCTIONS
+    + "Keep your response clear, concise and mathematically accurate. "
+)
+
+def text_prompt(question_text):
+    return f"{TEXT_PROMPT}Question: {question_text}"
@@ -0,0 +1,26 @@
+from aicalc.config import logger, REDIS_URL
+import threading
+
+REDIS_SOCKET_TIMEOUT = 0.5
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_redis():
+    """Return a shared Redis client for REDIS_URL, or None if redis is unavailable."""
+    global _client
+    if _client is not None:
+        return _client
+    with _client_lock:
+        if _client is None:
+            try:
+                import redis
+                _client = redis.Redis.from_url(
+                    REDIS_URL,
+                    socket_timeout=REDIS_SOCKET_TIMEOUT,
+                    socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+                )
+            except Exception as e:
+                logger.warning(f"Redis client unavailable ({REDIS_URL}): {e}")
+                return None
+    return _client
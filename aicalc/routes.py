@@ -1,4 +1,4 @@
-from flask import Blueprint, request, jsonify, send_from_directory
+from flask import Blueprint, Response, g, request, jsonify, send_from_directory, stream_with_context
 from PIL import Image
 import base64
 import re
@@ -9,13 +9,35 @@ import json
 from datetime import datetime
 from io import BytesIO
 import threading
-from aicalc.cache import get_cache_key, get_cached_response, cache_response, response_cache
-from aicalc.ai_providers import generate_ai_response, api_backend
-from aicalc.diagrams import generate_matplotlib_diagram, generate_tikz_diagram
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from aicalc.cache import get_cache_key, get_cached_response, cache_response, response_cache, get_cache_stats
+from aicalc import ai_providers
+from aicalc.ai_providers import generate_ai_response, stream_ai_response, get_routing_stats, DeadlineExceeded
+from aicalc.circuit_breaker import CircuitOpenError, get_breaker_states, CLOSED
+from aicalc.diagrams import diagram_file_available
+from aicalc.cleanup import get_artifact_stats
+from aicalc.blob_store import blob_store, get_blob_store_stats
+from aicalc.diagram_jobs import (submit_diagram, wait_for_diagram, get_diagram_job, resolve_diagrams,
+                                 diagram_jobs_known, pending_diagram_html, get_diagram_queue_stats)
+from aicalc.image_keys import image_hash, remember_image_hash, get_image_key_stats, ImageRejected
+from aicalc.image_ingest import decode_upload, prepare_image, get_ingest_stats
+from aicalc.text_keys import normalize_question, get_text_key_stats
+from aicalc.local_solver import solve_locally, get_local_solver_stats
+from aicalc import batch
+from aicalc.batch import BATCH_MAX_ITEMS, BATCH_PACK_SIZE, BATCH_CONCURRENCY, pack_questions, split_answers, get_batch_stats
+from aicalc.singleflight import coalesce, get_singleflight_stats
+from aicalc.streaming import StreamCleaner, sse_event
+from aicalc.postprocess import clean_response
+from aicalc.prompts import IMAGE_PROMPT, TEXT_PROMPT, text_prompt
+from aicalc.metrics import REQUEST_SECONDS, METRICS_CONTENT_TYPE, timed, render_metrics
+from aicalc.admission import admitted, text_priority, get_admission_stats, PRIORITY_IMAGE, PRIORITY_TEXT
 from aicalc.config import logger
 
 routes = Blueprint('routes', __name__)
 
+DIAGRAM_STREAM_WAIT = 45
+
 @routes.route('/')
 def serve_index():
     return send_from_directory('static', 'index.html')
@@ -24,6 +46,18 @@ def serve_index():
 def serve_static(filename):
     return send_from_directory('static', filename)
 
+@routes.before_app_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@routes.after_app_request
+def record_request_time(response):
+    # Streamed responses are timed to their first byte; the stream itself is not.
+    start = g.pop('request_start', None)
+    if start is not None:
+        REQUEST_SECONDS.labels(request.endpoint or 'unmatched', response.status_code).observe(time.perf_counter() - start)
+    return response
+
 @routes.app_errorhandler(404)
 def not_found_error(error):
     return send_from_directory('static', '404.html'), 404
@@ -32,116 +66,129 @@ def not_found_error(error):
 def internal_error(error):
     return send_from_directory('static', '500.html'), 500
 
+def process_ai_response(response_text, context='', cache_key=None, submitted=None):
+    """Clean a model reply and queue each distinct diagram block; returns (html, diagram job ids).
+
+    submitted maps (kind, code) to jobs already queued for this response while streaming.
+    """
+    submitted = {} if submitted is None else submitted
+    diagram_jobs = []
+    def on_diagram(kind, code):
+        diagram_job = submitted.get((kind, code))
+        if diagram_job is None:
+            diagram_job = submitted[(kind, code)] = submit_diagram(kind, code, context, cache_key)
+        if diagram_job not in diagram_jobs:
+            diagram_jobs.append(diagram_job)
+        return pending_diagram_html(diagram_job)
+    with timed('postprocess'):
+        return clean_response(response_text, on_diagram), diagram_jobs
+
+def build_ai_result(response_text, context='', trace=None, cache_key=None, submitted=None):
+    cleaned_response, diagram_jobs = process_ai_response(response_text, context, cache_key, submitted)
+    trace = trace or {}
+    result = {
+        'success': True,
+        'solution': cleaned_response,
+        'has_diagram': bool(diagram_jobs),
+        'diagram_url': None,
+        'api_backend': ai_providers.api_backend,
+        'engine': 'ai',
+        'provider': trace.get('provider', ai_providers.api_backend),
+        'routing': trace,
+        'cached': False
+    }
+    if diagram_jobs:
+        result['diagram_jobs'] = diagram_jobs
+    # Inline rendering, or renders that already finished, fill the diagrams in right away.
+    return resolve_diagrams(result) or result
+
+def get_cached_solution(cache_key):
+    """Cached result, with any diagram that finished since it was cached filled in."""
+    with timed('cache_lookup'):
+        cached_result = get_cached_response(cache_key)
+    if cached_result and not all(map(diagram_file_available, cached_result.get('diagram_urls') or [cached_result.get('diagram_url')])):
+        logger.info(f"Diagram for cached key {cache_key[:8]}... was cleaned up, recomputing")
+        response_cache.delete(cache_key)
+        return None
+    if cached_result and not diagram_jobs_known(cached_result):
+        # Its diagram ids would only ever answer 404 from this worker.
+        logger.info(f"Diagram jobs for cached key {cache_key[:8]}... are unknown to this worker, recomputing")
+        response_cache.delete(cache_key)
+        return None
+    if cached_result:
+        resolved = resolve_diagrams(cached_result)
+        if resolved is not None:
+            cache_response(cache_key, resolved)
+            return resolved
+    return cached_result
+
+def uploaded_image():
+    """The drawing as sent: a raw image body, a multipart 'image' file, or the JSON data URL."""
+    if request.mimetype.startswith('image/'):
+        return request.get_data()
+    if 'image' in request.files:
+        return request.files['image'].read()
+    return (request.get_json(silent=True) or {}).get('image')
+
+def solve_image(cache_key, img, img_hash):
+    """Model answer for a drawing, shared with concurrent requests for the same key."""
+    def compute():
+        trace = {}
+        image = prepare_image(img)
+        with admitted(PRIORITY_IMAGE, IMAGE_PROMPT, image), timed('model'):
+            response_text = generate_ai_response(IMAGE_PROMPT, image, trace=trace)
+        result = build_ai_result(response_text, trace=trace, cache_key=cache_key)
+        cache_response(cache_key, result)
+        remember_image_hash(img_hash)
+        return result
+    return coalesce(cache_key, compute)
+
+def solve_text(cache_key, question_text):
+    """Model answer for a text question, shared with concurrent requests for the same key."""
+    def compute():
+        trace = {}
+        prompt = text_prompt(question_text)
+        with admitted(text_priority(question_text), prompt), timed('model'):
+            response_text = generate_ai_response(prompt, trace=trace)
+        result = build_ai_result(response_text, ' for text question', trace, cache_key)
+        cache_response(cache_key, result)
+        return result
+    return coalesce(cache_key, compute)
+
+def service_unavailable(error):
+    response = jsonify({
+        'success': False,
+        'error': 'The AI service is temporarily unavailable. Please try again shortly.'
+    })
+    response.headers['Retry-After'] = str(max(1, int(error.retry_after + 0.5)))
+    return response, 503
+
+def gateway_timeout():
+    return jsonify({
+        'success': False,
+        'error': 'The AI service took too long to respond. Please try again later.'
+    }), 504
+
 @routes.route('/calculate', methods=['POST'])
 def calculate():
     try:
-        data = request.json
-        image_data = data.get('image')
-        cache_key = get_cache_key(image_data=image_data)
-        cached_result = get_cached_response(cache_key)
+        img = decode_upload(uploaded_image())
+        img_hash = image_hash(img)
+        cache_key = get_cache_key(image_hash=img_hash)
+        cached_result = get_cached_solution(cache_key)
         if cached_result:
             logger.info("Returning cached result for image")
             return jsonify(cached_result)
-        image_data = image_data.replace('data:image/png;base64,', '')
-        image_bytes = base64.b64decode(image_data)
-        img = Image.open(BytesIO(image_bytes))
-        prompt = (
-            "You will be provided an image file containing a mathematical expression. "
-            "The image has a black background with the math expression drawn in white or other colors. "
-            "Identify the mathematical expression and provide a complete solution. "
-            "Format your response as HTML with MathJax-compatible LaTeX for all mathematical expressions. "
-            "Use \\( \\) for inline math and \\[ \\] for display math. "
-            "Include step-by-step explanations where appropriate. "
-            "If the problem would benefit from a visual diagram, choose the appropriate method: "
-            "For simple plots, graphs, and statistical charts, use Python matplotlib code wrapped in <!--PLOT-START--> and <!--PLOT-END--> tags. "
-            "For complex diagrams like DFAs, NFAs, flowcharts, automata, trees, complex geometric constructions, or formal structures, "
-            "use TikZ code wrapped in <!--TIKZ-START--> and <!--TIKZ-END--> tags. "
-            "For matplotlib: Use plt, np, numpy, matplotlib and standard math functions with proper labels and titles. "
-            "For TikZ: Use standard TikZ syntax with automata, positioning, shapes libraries available. "
-            "When creating TikZ tree diagrams, ensure adequate spacing between nodes by using appropriate sibling distances. "
-            "For binary trees, use sibling distances of at least 4cm for level 1, 2cm for level 2, 1cm for level 3, etc. "
-            "Make sure nodes don't overlap and text is clearly readable. "
-            "IMPORTANT: Do not include any markdown code block markers (like ```python or ```) in your response. "
-            "IMPORTANT: Choose TikZ for formal computer science diagrams, automata, complex geometric proofs, trees. "
-            "Choose matplotlib for function plots, statistical charts, simple geometric shapes. "
-            "Do not reference 'python' as a variable or function name. "
-            "Keep your response concise and focused on the solution."
-        )
-        response_text = generate_ai_response(prompt, img)
-        cleaned_response = response_text
-        cleaned_response = re.sub(r'^```(?:html|markdown)?\s*', '', cleaned_response)
-        cleaned_response = re.sub(r'\s*```$', '', cleaned_response)
-        cleaned_response = re.sub(r'```\w*\s*|\s*```', '', cleaned_response)
-        plot_image_url = None
-        plot_pattern = r'<!--PLOT-START-->(.*?)<!--PLOT-END-->'
-        plot_match = re.search(plot_pattern, cleaned_response, re.DOTALL)
-        tikz_pattern = r'<!--TIKZ-START-->(.*?)<!--TIKZ-END-->'
-        tikz_match = re.search(tikz_pattern, cleaned_response, re.DOTALL)
-        if plot_match:
-            plot_code = plot_match.group(1).strip()
-            if plot_code.startswith('python'):
-                plot_code = '\n'.join(plot_code.split('\n')[1:])
-            image_filename = f"plot_{uuid.uuid4().hex[:8]}.png"
-            compiled_image = generate_matplotlib_diagram(plot_code, image_filename)
-            if compiled_image:
-                plot_image_url = f"/static/generated/{compiled_image}"
-                cleaned_response = re.sub(plot_pattern, 
-                    f'<div class="math-diagram-container"><img src="{plot_image_url}" alt="Mathematical Diagram" class="math-diagram"></div>', 
-                    cleaned_response, flags=re.DOTALL)
-                logger.info(f"Successfully generated matplotlib diagram: {plot_image_url}")
-                def delayed_delete():
-                    time.sleep(600)
-                    try:
-                        file_path = os.path.join('static', 'generated', compiled_image)
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                            logger.info(f"Deleted served image: {compiled_image}")
-                    except OSError as e:
-                        logger.error(f"Failed to delete served image {compiled_image}: {e}")
-                delete_thread = threading.Thread(target=delayed_delete, daemon=True)
-                delete_thread.start()
-            else:
-                cleaned_response = re.sub(plot_pattern, 
-                    '<p><em>Diagram generation failed. Please refer to the text solution.</em></p>', 
-                    cleaned_response, flags=re.DOTALL)
-                logger.warning("Matplotlib diagram generation failed, removed from response")
-        elif tikz_match:
-            tikz_code = tikz_match.group(1).strip()
-            image_filename = f"tikz_{uuid.uuid4().hex[:8]}.png"
-            compiled_image = generate_tikz_diagram(tikz_code, image_filename)
-            if compiled_image:
-                plot_image_url = f"/static/generated/{compiled_image}"
-                cleaned_response = re.sub(tikz_pattern, 
-                    f'<div class="math-diagram-container"><img src="{plot_image_url}" alt="Mathematical Diagram" class="math-diagram"></div>', 
-                    cleaned_response, flags=re.DOTALL)
-                logger.info(f"Successfully generated TikZ diagram: {plot_image_url}")
-                def delayed_delete():
-                    time.sleep(600)
-                    try:
-                        file_path = os.path.join('static', 'generated', compiled_image)
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                            logger.info(f"Deleted served image: {compiled_image}")
-                    except OSError as e:
-                        logger.error(f"Failed to delete served image {compiled_image}: {e}")
-                delete_thread = threading.Thread(target=delayed_delete, daemon=True)
-                delete_thread.start()
-            else:
-                cleaned_response = re.sub(tikz_pattern, 
-                    '<p><em>Diagram generation failed. Please refer to the text solution.</em></p>', 
-                    cleaned_response, flags=re.DOTALL)
-                logger.warning("TikZ diagram generation failed, removed from response")
-        result = {
-            'success': True,
-            'solution': cleaned_response,
-            'has_diagram': plot_image_url is not None,
-            'diagram_url': plot_image_url,
-            'api_backend': api_backend,
-            'cached': False
-        }
-        cache_response(cache_key, result)
-        json.dumps(result)
+        result = solve_image(cache_key, img, img_hash)
         return jsonify(result)
+    except ImageRejected as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except CircuitOpenError as e:
+        logger.warning('AI providers unavailable in /calculate: %s', str(e))
+        return service_unavailable(e)
+    except DeadlineExceeded as e:
+        logger.error('Deadline exceeded in /calculate: %s', str(e))
+        return gateway_timeout()
     except Exception as e:
         logger.error('Error in /calculate: %s', str(e), exc_info=True)
         return jsonify({
@@ -159,113 +206,353 @@ def calculate_text():
                 'success': False,
                 'error': 'No question provided.'
             }), 400
-        cache_key = get_cache_key(text_data=question_text)
-        cached_result = get_cached_response(cache_key)
+        cache_key = get_cache_key(text_data=normalize_question(question_text))
+        cached_result = get_cached_solution(cache_key)
         if cached_result:
             logger.info("Returning cached result for text")
             return jsonify(cached_result)
-        prompt = (
-            "You will be provided with a mathematical question in text format. "
-            "Provide a complete solution with step-by-step explanations. "
-            "Format your response as HTML with MathJax-compatible LaTeX for all mathematical expressions. "
-            "Use \\( \\) for inline math and \\[ \\] for display math. "
-            "If the problem would benefit from a visual diagram, choose the appropriate method: "
-            "For simple plots, graphs, and statistical charts, use Python matplotlib code wrapped in <!--PLOT-START--> and <!--PLOT-END--> tags. "
-            "For complex diagrams like DFAs, NFAs, flowcharts, automata, trees, complex geometric constructions, or formal structures, "
-            "use TikZ code wrapped in <!--TIKZ-START--> and <!--TIKZ-END--> tags. "
-            "For matplotlib: Use plt, np, numpy, matplotlib and standard math functions with proper labels and titles. "
-            "For TikZ: Use standard TikZ syntax with automata, positioning, shapes libraries available. "
-            "When creating TikZ tree diagrams, ensure adequate spacing between nodes by using appropriate sibling distances. "
-            "For binary trees, use sibling distances of at least 4cm for level 1, 2cm for level 2, 1cm for level 3, etc. "
-            "Make sure nodes don't overlap and text is clearly readable. "
-            "IMPORTANT: Do not include any markdown code block markers (like ```python or ```) in your response. "
-            "IMPORTANT: Choose TikZ for formal computer science diagrams, automata, complex geometric proofs, trees. "
-            "Choose matplotlib for function plots, statistical charts, simple geometric shapes. "
-            "Keep your response clear, concise and mathematically accurate. "
-            f"Question: {question_text}"
-        )
-        response_text = generate_ai_response(prompt)
-        cleaned_response = response_text
-        cleaned_response = re.sub(r'^```(?:html|markdown)?\s*', '', cleaned_response)
-        cleaned_response = re.sub(r'\s*```$', '', cleaned_response)
-        cleaned_response = re.sub(r'```\w*\s*|\s*```', '', cleaned_response)
-        plot_image_url = None
-        plot_pattern = r'<!--PLOT-START-->(.*?)<!--PLOT-END-->'
-        plot_match = re.search(plot_pattern, cleaned_response, re.DOTALL)
-        tikz_pattern = r'<!--TIKZ-START-->(.*?)<!--TIKZ-END-->'
-        tikz_match = re.search(tikz_pattern, cleaned_response, re.DOTALL)
-        if plot_match:
-            plot_code = plot_match.group(1).strip()
-            if plot_code.startswith('python'):
-                plot_code = '\n'.join(plot_code.split('\n')[1:])
-            image_filename = f"plot_{uuid.uuid4().hex[:8]}.png"
-            compiled_image = generate_matplotlib_diagram(plot_code, image_filename)
-            if compiled_image:
-                plot_image_url = f"/static/generated/{compiled_image}"
-                cleaned_response = re.sub(plot_pattern, 
-                    f'<div class="math-diagram-container"><img src="{plot_image_url}" alt="Mathematical Diagram" class="math-diagram"></div>', 
-                    cleaned_response, flags=re.DOTALL)
-                logger.info(f"Successfully generated matplotlib diagram for text question: {plot_image_url}")
-                def delayed_delete():
-                    time.sleep(600)
-                    try:
-                        file_path = os.path.join('static', 'generated', compiled_image)
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                            logger.info(f"Deleted served image: {compiled_image}")
-                    except OSError as e:
-                        logger.error(f"Failed to delete served image {compiled_image}: {e}")
-                delete_thread = threading.Thread(target=delayed_delete, daemon=True)
-                delete_thread.start()
-            else:
-                cleaned_response = re.sub(plot_pattern, 
-                    '<p><em>Diagram generation failed. Please refer to the text solution.</em></p>', 
-                    cleaned_response, flags=re.DOTALL)
-                logger.warning("Matplotlib diagram generation failed for text question")
-        elif tikz_match:
-            tikz_code = tikz_match.group(1).strip()
-            image_filename = f"tikz_{uuid.uuid4().hex[:8]}.png"
-            compiled_image = generate_tikz_diagram(tikz_code, image_filename)
-            if compiled_image:
-                plot_image_url = f"/static/generated/{compiled_image}"
-                cleaned_response = re.sub(tikz_pattern, 
-                    f'<div class="math-diagram-container"><img src="{plot_image_url}" alt="Mathematical Diagram" class="math-diagram"></div>', 
-                    cleaned_response, flags=re.DOTALL)
-                logger.info(f"Successfully generated TikZ diagram for text question: {plot_image_url}")
-                def delayed_delete():
-                    time.sleep(600)
-                    try:
-                        file_path = os.path.join('static', 'generated', compiled_image)
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                            logger.info(f"Deleted served image: {compiled_image}")
-                    except OSError as e:
-                        logger.error(f"Failed to delete served image {compiled_image}: {e}")
-                delete_thread = threading.Thread(target=delayed_delete, daemon=True)
-                delete_thread.start()
+        local_result = solve_locally(question_text)
+        if local_result:
+            cache_response(cache_key, local_result)
+            return jsonify(local_result)
+        result = solve_text(cache_key, question_text)
+        return jsonify(result)
+    except CircuitOpenError as e:
+        logger.warning('AI providers unavailable in /calculate-text: %s', str(e))
+        return service_unavailable(e)
+    except DeadlineExceeded as e:
+        logger.error('Deadline exceeded in /calculate-text: %s', str(e))
+        return gateway_timeout()
+    except Exception as e:
+        logger.error('Error in /calculate-text: %s', str(e), exc_info=True)
+        return jsonify({
+            'success': False,
+            'error': 'An internal error occurred. Please try again later.'
+        }), 500
+
+def stream_solution(cache_key, prompt, img=None, context='', on_cached=None, priority=PRIORITY_IMAGE):
+    """SSE response that forwards the model's answer as it is generated.
+
+    img is the decoded upload; it is only prepared for the model on a cache miss.
+
+    Events: "delta" carries HTML to append, "diagram" the rendered diagram that replaces
+    the placeholder, "done" the same result /calculate returns, and "error" a failure.
+    A diagram still rendering after DIAGRAM_STREAM_WAIT is left to /diagram/<id>.
+    """
+    def events():
+        cached_result = get_cached_solution(cache_key)
+        if cached_result:
+            logger.info(f"Returning cached result{context or ' for image'} as a stream")
+            yield sse_event('done', cached_result)
+            return
+        submitted = {}
+        def on_diagram(kind, code):
+            # Render while the model keeps writing; a repeated block shares its first job.
+            if (kind, code) not in submitted:
+                submitted[(kind, code)] = submit_diagram(kind, code, context, cache_key)
+            return pending_diagram_html(submitted[(kind, code)])
+        trace = {}
+        chunks = []
+        cleaner = StreamCleaner(on_diagram)
+        try:
+            image = prepare_image(img) if img is not None else None
+            with admitted(priority, prompt, image):
+                for chunk in stream_ai_response(prompt, image, trace):
+                    chunks.append(chunk)
+                    html = cleaner.feed(chunk)
+                    if html:
+                        yield sse_event('delta', {'html': html})
+            html = cleaner.finish()
+            if html:
+                yield sse_event('delta', {'html': html})
+            for diagram_job in submitted.values():
+                job = wait_for_diagram(diagram_job, DIAGRAM_STREAM_WAIT)
+                if job and job['status'] != 'pending':
+                    yield sse_event('diagram', job)
+            result = build_ai_result(''.join(chunks), context, trace, cache_key, submitted)
+            cache_response(cache_key, result)
+            if on_cached:
+                on_cached()
+            yield sse_event('done', result)
+        except CircuitOpenError as e:
+            logger.warning('AI providers unavailable while streaming: %s', str(e))
+            yield sse_event('error', {
+                'success': False,
+                'error': 'The AI service is temporarily unavailable. Please try again shortly.',
+                'retry_after': max(1, int(e.retry_after + 0.5))
+            })
+        except Exception as e:
+            logger.error('Error while streaming: %s', str(e), exc_info=True)
+            yield sse_event('error', {
+                'success': False,
+                'error': 'An internal error occurred. Please try again later.'
+            })
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream.
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@routes.route('/calculate-stream', methods=['POST'])
+def calculate_stream():
+    try:
+        img = decode_upload(uploaded_image())
+        img_hash = image_hash(img)
+        cache_key = get_cache_key(image_hash=img_hash)
+        return stream_solution(cache_key, IMAGE_PROMPT, img, on_cached=lambda: remember_image_hash(img_hash))
+    except ImageRejected as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        logger.error('Error in /calculate-stream: %s', str(e), exc_info=True)
+        return jsonify({
+            'success': False,
+            'error': 'An internal error occurred. Please try again later.'
+        }), 500
+
+@routes.route('/calculate-text-stream', methods=['POST'])
+def calculate_text_stream():
+    try:
+        data = request.json
+        question_text = data.get('question')
+        if not question_text or not question_text.strip():
+            return jsonify({
+                'success': False,
+                'error': 'No question provided.'
+            }), 400
+        cache_key = get_cache_key(text_data=normalize_question(question_text))
+        if get_cached_solution(cache_key) is None:
+            local_result = solve_locally(question_text)
+            if local_result:
+                cache_response(cache_key, local_result)
+        return stream_solution(cache_key, text_prompt(question_text), context=' for text question',
+                               priority=text_priority(question_text))
+    except Exception as e:
+        logger.error('Error in /calculate-text-stream: %s', str(e), exc_info=True)
+        return jsonify({
+            'success': False,
+            'error': 'An internal error occurred. Please try again later.'
+        }), 500
+
+def batch_entries(items):
+    """Cache key per batch item (or an error result for a bad item), plus one entry per distinct key."""
+    entries = {}
+    slots = []
+    for item in items:
+        if isinstance(item, str):
+            item = {'question': item}
+        elif not isinstance(item, dict):
+            item = {}
+        try:
+            if item.get('image'):
+                img = decode_upload(item['image'])
+                img_hash = image_hash(img)
+                cache_key = get_cache_key(image_hash=img_hash)
+                entry = {'image': img, 'image_hash': img_hash}
+            elif isinstance(item.get('question'), str) and item['question'].strip():
+                cache_key = get_cache_key(text_data=normalize_question(item['question']))
+                entry = {'question': item['question']}
             else:
-                cleaned_response = re.sub(tikz_pattern, 
-                    '<p><em>Diagram generation failed. Please refer to the text solution.</em></p>', 
-                    cleaned_response, flags=re.DOTALL)
-                logger.warning("TikZ diagram generation failed for text question")
-        result = {
-            'success': True,
-            'solution': cleaned_response,
-            'has_diagram': plot_image_url is not None,
-            'diagram_url': plot_image_url,
-            'api_backend': api_backend,
-            'cached': False
+                slots.append({'success': False, 'error': 'Each item needs a question or an image.'})
+                continue
+        except ImageRejected as e:
+            slots.append({'success': False, 'error': str(e)})
+            continue
+        entries.setdefault(cache_key, entry)
+        slots.append(cache_key)
+    return entries, slots
+
+def batch_error(error):
+    if isinstance(error, CircuitOpenError):
+        return {
+            'success': False,
+            'error': 'The AI service is temporarily unavailable. Please try again shortly.',
+            'retry_after': max(1, int(error.retry_after + 0.5))
         }
+    return {'success': False, 'error': 'An internal error occurred. Please try again later.'}
+
+def solve_packed(questions):
+    """Answer several text questions with one model call.
+
+    Returns {cache_key: result} and the number of model calls made, counting the
+    questions the packed reply left out and that were asked again on their own.
+    """
+    if len(questions) == 1:
+        cache_key, question_text = questions[0]
+        return {cache_key: solve_text(cache_key, question_text)}, 1
+    trace = {}
+    prompt = TEXT_PROMPT + pack_questions([question_text for _, question_text in questions])
+    with admitted(PRIORITY_TEXT, prompt), timed('model'):
+        response_text = generate_ai_response(prompt, trace=trace)
+    answers = split_answers(response_text, len(questions))
+    trace['packed'] = len(questions)
+    solved = {}
+    model_calls = 1
+    for (cache_key, question_text), answer in zip(questions, answers):
+        if answer is None:
+            logger.info(f"Packed reply had no answer for {cache_key[:8]}..., asking on its own")
+            batch.count('unpacked')
+            model_calls += 1
+            try:
+                solved[cache_key] = solve_text(cache_key, question_text)
+            except Exception as e:
+                logger.error('Error in /calculate-batch: %s', str(e), exc_info=True)
+                solved[cache_key] = batch_error(e)
+            continue
+        result = build_ai_result(answer, ' for text question', dict(trace), cache_key)
         cache_response(cache_key, result)
-        json.dumps(result)
-        return jsonify(result)
+        solved[cache_key] = result
+    return solved, model_calls
+
+def solve_batch_image(cache_key, entry):
+    return {cache_key: solve_image(cache_key, entry['image'], entry['image_hash'])}, 1
+
+def run_batch(entries, summary):
+    """Yield (cache_key, result) for each distinct item as soon as it is answered."""
+    questions = []
+    jobs = []
+    for cache_key, entry in entries.items():
+        cached_result = get_cached_solution(cache_key)
+        if cached_result:
+            summary['cached'] += 1
+            yield cache_key, cached_result
+            continue
+        if 'question' in entry:
+            local_result = solve_locally(entry['question'])
+            if local_result:
+                cache_response(cache_key, local_result)
+                summary['local'] += 1
+                yield cache_key, local_result
+                continue
+            questions.append((cache_key, entry['question']))
+        else:
+            jobs.append(([cache_key], partial(solve_batch_image, cache_key, entry)))
+    for start in range(0, len(questions), BATCH_PACK_SIZE):
+        group = questions[start:start + BATCH_PACK_SIZE]
+        if len(group) > 1:
+            summary['packed_items'] += len(group)
+        jobs.append(([cache_key for cache_key, _ in group], partial(solve_packed, group)))
+    if not jobs:
+        return
+    with ThreadPoolExecutor(max_workers=min(BATCH_CONCURRENCY, len(jobs)), thread_name_prefix='batch') as executor:
+        futures = {executor.submit(fn): keys for keys, fn in jobs}
+        for future in as_completed(futures):
+            try:
+                solved, model_calls = future.result()
+                summary['model_calls'] += model_calls
+            except Exception as e:
+                # An open circuit refuses the call before it reaches the model.
+                if not isinstance(e, CircuitOpenError):
+                    summary['model_calls'] += 1
+                    logger.error('Error in /calculate-batch: %s', str(e), exc_info=True)
+                solved = {cache_key: batch_error(e) for cache_key in futures[future]}
+            for cache_key, result in solved.items():
+                if not result.get('success'):
+                    summary['failed'] += 1
+                yield cache_key, result
+
+@routes.route('/calculate-batch', methods=['POST'])
+def calculate_batch():
+    """Solve a list of problems in one request.
+
+    Takes {"items": [...]} where each item is {"question": ...}, {"image": "data:..."} or a
+    plain question string. Answers come back as {"results": [...]} in item order, or, with
+    "stream": true or Accept: application/x-ndjson, as one JSON line per item (tagged with
+    its index) as soon as it is ready, followed by a summary line.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        items = data.get('items')
+        if not isinstance(items, list) or not items:
+            return jsonify({'success': False, 'error': 'No items provided.'}), 400
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({'success': False, 'error': f'A batch holds at most {BATCH_MAX_ITEMS} items.'}), 400
+        entries, slots = batch_entries(items)
+        keyed = [slot for slot in slots if isinstance(slot, str)]
+        summary = {
+            'items': len(items),
+            'deduplicated': len(keyed) - len(entries),
+            'cached': 0,
+            'local': 0,
+            'model_calls': 0,
+            'packed_items': 0,
+            'failed': len(slots) - len(keyed),
+        }
+        if data.get('stream') or request.accept_mimetypes.best == 'application/x-ndjson':
+            def lines():
+                waiting = {}
+                for index, slot in enumerate(slots):
+                    if isinstance(slot, str):
+                        waiting.setdefault(slot, []).append(index)
+                    else:
+                        yield json.dumps(dict(slot, index=index)) + '\n'
+                try:
+                    for cache_key, result in run_batch(entries, summary):
+                        for index in waiting[cache_key]:
+                            yield json.dumps(dict(result, index=index)) + '\n'
+                except Exception as e:
+                    logger.error('Error in /calculate-batch: %s', str(e), exc_info=True)
+                    yield json.dumps(dict(batch_error(e), done=True)) + '\n'
+                    return
+                batch.record_batch(summary)
+                yield json.dumps({'done': True, 'summary': summary}) + '\n'
+            response = Response(stream_with_context(lines()), mimetype='application/x-ndjson')
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['X-Accel-Buffering'] = 'no'
+            return response
+        solved = dict(run_batch(entries, summary))
+        batch.record_batch(summary)
+        results = [dict(solved[slot] if isinstance(slot, str) else slot, index=index) for index, slot in enumerate(slots)]
+        return jsonify({'success': True, 'results': results, 'summary': summary})
     except Exception as e:
-        logger.error('Error in /calculate-text: %s', str(e), exc_info=True)
+        logger.error('Error in /calculate-batch: %s', str(e), exc_info=True)
         return jsonify({
             'success': False,
             'error': 'An internal error occurred. Please try again later.'
         }), 500
 
+@routes.route('/diagram/<job_id>')
+def diagram_status(job_id):
+    job = get_diagram_job(job_id)
+    if job is None:
+        return jsonify({'id': job_id, 'status': 'unknown'}), 404
+    return jsonify(job), 200
+
+@routes.route('/diagrams/<name>')
+def diagram_blob(name):
+    # Names are content hashes, so a diagram never changes and can be cached for good.
+    etag = name.rsplit('.', 1)[0]
+    headers = {'Cache-Control': 'public, max-age=31536000, immutable', 'ETag': f'"{etag}"'}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    data = blob_store.get(name) if blob_store is not None else None
+    if data is None:
+        return jsonify({'success': False, 'error': 'Diagram not found.'}), 404
+    return Response(data, mimetype='image/png', headers=headers)
+
 @routes.route('/health')
 def health_check():
-    return jsonify({'status': 'healthy'}), 200
+    breakers = get_breaker_states()
+    probe = ai_providers.probe_primary()
+    healthy = all(b['state'] == CLOSED for b in breakers.values()) and probe['ok'] is not False
+    return jsonify({'status': 'healthy' if healthy else 'degraded', 'providers': breakers, 'probe': probe}), 200
+
+@routes.route('/metrics')
+def metrics():
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+@routes.route('/stats')
+def stats():
+    return jsonify({
+        'cache': get_cache_stats(),
+        'image_keys': get_image_key_stats(),
+        'image_ingest': get_ingest_stats(),
+        'text_keys': get_text_key_stats(),
+        'local_solver': get_local_solver_stats(),
+        'batch': get_batch_stats(),
+        'admission': get_admission_stats(),
+        'singleflight': get_singleflight_stats(),
+        'routing': get_routing_stats(),
+        'diagrams': get_diagram_queue_stats(),
+        'artifacts': get_artifact_stats(),
+        'diagram_storage': get_blob_store_stats(),
+    }), 200
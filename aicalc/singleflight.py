@@ -0,0 +1,190 @@
+from aicalc.config import logger
+from aicalc.cache import response_cache, get_cached_response, RedisSharedCache
+import asyncio
+import os
+import threading
+import time
+import uuid
+
+# Concurrent requests for the same cache key share one model call: within a worker the
+# followers wait on the leader's result, and across workers the leader holds a Redis lock
+# while the others poll the shared cache tier for its answer.
+COALESCE_TIMEOUT = float(os.getenv('COALESCE_TIMEOUT', 60))
+COALESCE_ACROSS_WORKERS = os.getenv('COALESCE_ACROSS_WORKERS', 'true').lower() in ('1', 'true', 'yes')
+COALESCE_POLL_INTERVAL = 0.1
+COALESCE_LOCK_PREFIX = 'aicalc:inflight:'
+
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    def __init__(self, timeout=COALESCE_TIMEOUT, redis_client=None):
+        self.timeout = timeout
+        self.redis = redis_client
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            'leaders': 0,
+            'coalesced': 0,
+            'coalesced_across_workers': 0,
+            'timeouts': 0,
+            'errors': 0,
+        }
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def do(self, key, fn):
+        """Run fn() once per key across concurrent callers and hand every caller its result."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            self._count('coalesced')
+            if not call.done.wait(self.timeout):
+                self._count('timeouts')
+                logger.warning(f"Timed out waiting for in-flight call {key[:8]}..., calling directly")
+                return fn()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        self._count('leaders')
+        try:
+            call.result = self._run_leader(key, fn)
+            return call.result
+        except Exception as e:
+            call.error = e
+            self._count('errors')
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _run_leader(self, key, fn):
+        # A previous leader may have cached the answer after our caller's cache check.
+        result = get_cached_response(key)
+        if result is not None:
+            return result
+        if self.redis is None:
+            return fn()
+        token = uuid.uuid4().hex
+        lock_key = COALESCE_LOCK_PREFIX + key
+        try:
+            acquired = self.redis.set(lock_key, token, nx=True, px=int(self.timeout * 1000))
+        except Exception as e:
+            logger.warning(f"In-flight lock unavailable, coalescing within this worker only: {e}")
+            return fn()
+        if acquired:
+            try:
+                return fn()
+            finally:
+                try:
+                    self.redis.eval(_RELEASE_SCRIPT, 1, lock_key, token)
+                except Exception as e:
+                    logger.warning(f"Failed to release in-flight lock {key[:8]}...: {e}")
+        # Another worker is computing this key; wait for its answer in the shared cache.
+        self._count('coalesced_across_workers')
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            time.sleep(COALESCE_POLL_INTERVAL)
+            result = get_cached_response(key)
+            if result is not None:
+                return result
+            try:
+                if not self.redis.exists(lock_key):
+                    break
+            except Exception:
+                break
+        result = get_cached_response(key)
+        if result is not None:
+            return result
+        self._count('timeouts')
+        logger.warning(f"In-flight call {key[:8]}... in another worker did not finish, calling directly")
+        return fn()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._calls)
+        stats['across_workers'] = self.redis is not None
+        return stats
+
+class _LeaderCancelled(Exception):
+    """Set on the shared future when the leader's request goes away: followers start over."""
+
+class AsyncSingleFlight:
+    """Event-loop counterpart of SingleFlight for the ASGI entry point (per process only)."""
+
+    def __init__(self, timeout=COALESCE_TIMEOUT):
+        self.timeout = timeout
+        self._calls = {}
+        self._stats = {'leaders': 0, 'coalesced': 0, 'timeouts': 0, 'errors': 0}
+
+    async def do(self, key, fn):
+        future = self._calls.get(key)
+        if future is not None:
+            self._stats['coalesced'] += 1
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+            except asyncio.TimeoutError:
+                self._stats['timeouts'] += 1
+                logger.warning(f"Timed out waiting for in-flight call {key[:8]}..., calling directly")
+                return await fn()
+            except _LeaderCancelled:
+                # The first follower back becomes the new leader, the rest coalesce onto it.
+                return await self.do(key, fn)
+        self._stats['leaders'] += 1
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = get_cached_response(key)
+            if result is None:
+                result = await fn()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            # Cancelling the shared future would cancel the followers' requests too.
+            future.set_exception(_LeaderCancelled())
+            future.exception()
+            raise
+        except Exception as e:
+            self._stats['errors'] += 1
+            future.set_exception(e)
+            # Mark the exception retrieved so it is not reported when nobody was waiting.
+            future.exception()
+            raise
+        finally:
+            del self._calls[key]
+
+    def stats(self):
+        return dict(self._stats, in_flight=len(self._calls))
+
+def _shared_redis():
+    # Waiting across workers only works when they share the cache tier the answer lands in.
+    if COALESCE_ACROSS_WORKERS and isinstance(response_cache.shared, RedisSharedCache):
+        return response_cache.shared.client
+    return None
+
+single_flight = SingleFlight(redis_client=_shared_redis())
+async_single_flight = AsyncSingleFlight()
+
+def coalesce(cache_key, fn):
+    return single_flight.do(cache_key, fn)
+
+def get_singleflight_stats():
+    stats = single_flight.stats()
+    stats['async'] = async_single_flight.stats()
+    return stats
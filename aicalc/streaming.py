@@ -0,0 +1,107 @@
+import json
+import re
+from aicalc.postprocess import DIAGRAM_MARKERS, TAG_BODY, strip_fences, sanitize_html
+
+# Incremental counterpart of aicalc/postprocess.clean_response, for forwarding model
+# output to the browser as it is generated. Text that could still turn into a code fence,
+# a diagram marker or an HTML tag is held back until the next chunk decides it; diagram
+# blocks are swallowed whole and handed to on_diagram, whose return value (a placeholder)
+# is emitted in their place. A script or style block is held back whole until its
+# closing tag arrives, so sanitize_html drops it with its content, as clean_response does.
+_UNSETTLED_TAIL = re.compile(r'\s*(?:`{1,3}\w*\s*)?$')
+# A tag still waiting for its '>', possibly inside a quoted value that holds a '<'.
+_OPEN_TAG = re.compile(r'''</?(?:[A-Za-z]''' + TAG_BODY + r'''(?:=\s*(?:"[^"]*|'[^']*))?)?$''')
+_BLOCK_START = re.compile(r'<(script|style)\b', re.IGNORECASE)
+_BLOCK_ENDS = {name: re.compile(rf'</{name}\s*>', re.IGNORECASE) for name in ('script', 'style')}
+
+def _emit(text):
+    return sanitize_html(strip_fences(text))
+
+class StreamCleaner:
+    def __init__(self, on_diagram):
+        self.on_diagram = on_diagram
+        self.buffer = ''
+        self.block = None
+
+    def _script_blocks(self):
+        """(start, end) of each script or style block in the buffer; end is None while it is still open."""
+        blocks = []
+        position = 0
+        while True:
+            match = _BLOCK_START.search(self.buffer, position)
+            if match is None:
+                return blocks
+            end = _BLOCK_ENDS[match.group(1).lower()].search(self.buffer, match.end())
+            if end is None:
+                blocks.append((match.start(), None))
+                return blocks
+            blocks.append((match.start(), end.end()))
+            position = end.end()
+
+    def _marker_outside(self, marker, blocks):
+        # A marker inside a script block goes with the block, not to a renderer.
+        i = self.buffer.find(marker)
+        while i >= 0 and any(b <= i and (e is None or i < e) for b, e in blocks):
+            i = self.buffer.find(marker, i + 1)
+        return i
+
+    def _held_tail(self):
+        hold = len(self.buffer) - _UNSETTLED_TAIL.search(self.buffer).start()
+        tag = _OPEN_TAG.search(self.buffer)
+        if tag is not None:
+            # A tag is only sanitized once it is complete.
+            hold = max(hold, len(self.buffer) - tag.start())
+        for start, _ in DIAGRAM_MARKERS.values():
+            for size in range(min(len(start) - 1, len(self.buffer)), hold, -1):
+                if self.buffer.endswith(start[:size]):
+                    hold = size
+                    break
+        return hold
+
+    def feed(self, chunk):
+        """Add a chunk of model output and return the HTML that is now safe to show."""
+        self.buffer += chunk
+        out = []
+        while True:
+            if self.block is not None:
+                end = DIAGRAM_MARKERS[self.block][1]
+                i = self.buffer.find(end)
+                if i < 0:
+                    break
+                code = strip_fences(self.buffer[:i]).strip()
+                out.append(self.on_diagram(self.block, code))
+                self.buffer = self.buffer[i + len(end):]
+                self.block = None
+                continue
+            blocks = self._script_blocks()
+            starts = []
+            for kind, (start, _) in DIAGRAM_MARKERS.items():
+                i = self._marker_outside(start, blocks)
+                if i >= 0:
+                    starts.append((i, kind, start))
+            if starts:
+                i, kind, start = min(starts)
+                out.append(_emit(self.buffer[:i]))
+                self.buffer = self.buffer[i + len(start):]
+                self.block = kind
+                continue
+            cut = len(self.buffer) - self._held_tail()
+            if blocks and blocks[-1][1] is None:
+                cut = min(cut, blocks[-1][0])
+            out.append(_emit(self.buffer[:cut]))
+            self.buffer = self.buffer[cut:]
+            break
+        return ''.join(out)
+
+    def finish(self):
+        """Flush whatever is left once the model is done."""
+        text = self.buffer
+        if self.block is not None:
+            # An unterminated block stays in the text, as it does in the non-streaming path.
+            text = DIAGRAM_MARKERS[self.block][0] + text
+        self.buffer = ''
+        self.block = None
+        return _emit(text)
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
@@ -0,0 +1,121 @@
+from aicalc.mathparse import parse_math, has_unhandled_notation
+from collections import OrderedDict
+import re
+import threading
+import unicodedata
+
+# Each stage maps question text to a coarser form; the output of the last stage is
+# what /calculate-text hashes into its cache key. The model still sees the original text.
+NORMALIZATION_STAGES = ('whitespace', 'case', 'unicode', 'operators', 'canonical')
+SEEN_FORMS_PER_STAGE = 10000
+
+_SUPERSCRIPTS = str.maketrans('⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁽⁾ⁿˣ', '0123456789+-()nx')
+_SUPERSCRIPT_RUN = re.compile(r'[⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁽⁾ⁿˣ]+')
+_UNICODE_SYMBOLS = {
+    '−': '-', '–': '-', '—': '-', '‐': '-',
+    '×': '*', '·': '*', '⋅': '*', '∗': '*',
+    '÷': '/', '∕': '/',
+    '√': 'sqrt ', 'π': 'pi',
+    '≤': '<=', '≥': '>=', '≠': '!=',
+    '“': '"', '”': '"', '‘': "'", '’': "'",
+}
+_WHITESPACE = re.compile(r'\s+')
+_OPERATOR_SPACING = re.compile(r'\s*([-+*/^=<>!(),;:])\s*')
+# Not "!": "5!" is a factorial, not an exclamation.
+_TRAILING_PUNCTUATION = re.compile(r'[?.]+$')
+_DOUBLE_STAR = re.compile(r'\*\*')
+_INTENT_PHRASES = (
+    ('find the derivative of', 'diff'), ('derivative of', 'diff'), ('differentiate', 'diff'),
+    ('find the integral of', 'integrate'), ('integral of', 'integrate'), ('integrate', 'integrate'),
+    ('what is', 'evaluate'), ('evaluate', 'evaluate'), ('calculate', 'evaluate'), ('compute', 'evaluate'),
+    ('simplify', 'simplify'), ('factorise', 'factor'), ('factorize', 'factor'), ('factor', 'factor'),
+    ('expand', 'expand'), ('solve for x', 'solve'), ('solve', 'solve'), ('find x', 'solve'),
+)
+_INTENT_PATTERN = re.compile(r'\b(' + '|'.join(re.escape(p) for p, _ in _INTENT_PHRASES) + r')\b')
+_INTENTS = dict(_INTENT_PHRASES)
+_SEPARATORS = re.compile(r'^[\s,;:]+|[\s,;:]+$')
+
+def normalize_whitespace(text):
+    return _WHITESPACE.sub(' ', text).strip()
+
+def normalize_case(text):
+    return text.lower()
+
+def normalize_unicode(text):
+    text = _SUPERSCRIPT_RUN.sub(lambda m: '^' + m.group(0).translate(_SUPERSCRIPTS), text)
+    for symbol, replacement in _UNICODE_SYMBOLS.items():
+        text = text.replace(symbol, replacement)
+    return unicodedata.normalize('NFKC', text)
+
+def normalize_operators(text):
+    text = _DOUBLE_STAR.sub('^', text)
+    text = _OPERATOR_SPACING.sub(r'\1', text)
+    return _TRAILING_PUNCTUATION.sub('', text).strip()
+
+def canonicalize_math(text):
+    """Replace "intent + expression" questions with intent:sympy-form, else return text unchanged."""
+    if has_unhandled_notation(text):
+        return text
+    intents = _INTENT_PATTERN.findall(text)
+    if len(intents) > 1:
+        return text
+    intent = _INTENTS[intents[0]] if intents else 'evaluate'
+    expression = _SEPARATORS.sub('', _INTENT_PATTERN.sub(' ', text))
+    # Always the unevaluated form: "2+2" and "4", or "simplify 2x+3x" and "simplify 5x",
+    # are different questions with different worked solutions.
+    expr = parse_math(expression, evaluate=False)
+    if expr is None:
+        return text
+    return f"{intent}:{expr}"
+
+_STAGE_FUNCTIONS = (
+    normalize_whitespace,
+    normalize_case,
+    normalize_unicode,
+    normalize_operators,
+    canonicalize_math,
+)
+
+class NormalizationStats:
+    """Counts, per stage, requests whose form was new before the stage but already seen after it."""
+
+    def __init__(self, stages=NORMALIZATION_STAGES, max_forms=SEEN_FORMS_PER_STAGE):
+        self.stages = stages
+        self.max_forms = max_forms
+        self.requests = 0
+        self.collapsed = {stage: 0 for stage in stages}
+        self._seen = [OrderedDict() for _ in range(len(stages) + 1)]
+        self._lock = threading.Lock()
+
+    def record(self, forms):
+        with self._lock:
+            self.requests += 1
+            for i, stage in enumerate(self.stages):
+                if forms[i] not in self._seen[i] and forms[i + 1] in self._seen[i + 1]:
+                    self.collapsed[stage] += 1
+            for seen, form in zip(self._seen, forms):
+                seen[form] = None
+                seen.move_to_end(form)
+                if len(seen) > self.max_forms:
+                    seen.popitem(last=False)
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'collapsed_by_stage': dict(self.collapsed),
+            'collapsed_total': sum(self.collapsed.values()),
+        }
+
+normalization_stats = NormalizationStats()
+
+def normalize_question(text, record=True):
+    """Run the normalization pipeline and return the text to key the cache on."""
+    forms = [text]
+    for stage in _STAGE_FUNCTIONS:
+        forms.append(stage(forms[-1]))
+    if record:
+        normalization_stats.record(forms)
+    return forms[-1]
+
+def get_text_key_stats():
+    return normalization_stats.as_dict()
@@ -13,12 +13,11 @@ from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import logging
-from aicalc.config import logger
+from aicalc.config import logger, REDIS_URL
 from aicalc.ai_providers import initialize_ai_model, api_backend
 from aicalc.cache import response_cache
-from aicalc.cleanup import cleanup_worker, CLEANUP_INTERVAL, MAX_FILE_AGE, MAX_FILES_COUNT
-from aicalc.routes import routes
-import threading
+from aicalc.cleanup import start_cleanup_worker
+from aicalc.routes import routes, diagram_status, diagram_blob, calculate_batch, metrics
 
 # Load environment variables
 load_dotenv()
@@ -32,7 +31,9 @@ if CORS_ALLOWED_ORIGINS:
 else:
     CORS(app)
 
-REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
+# RATELIMIT_ENABLED=false lifts the per-IP limits, e.g. for load tests from a single host.
+app.config['RATELIMIT_ENABLED'] = os.getenv('RATELIMIT_ENABLED', 'true').lower() == 'true'
+
 rate_limits = {
     "vertex": ["500 per day", "100 per hour", "30 per minute"],
     "gemini": ["200 per day", "50 per hour", "15 per minute"]
@@ -43,6 +44,13 @@ limiter = Limiter(
     storage_uri=REDIS_URL,
     default_limits=rate_limits.get(api_backend, rate_limits["gemini"])
 )
+# Clients poll diagram status while a render is in flight, then fetch the image; neither should use up their quota.
+limiter.exempt(diagram_status)
+limiter.exempt(diagram_blob)
+limiter.exempt(metrics)
+# A batch counts once against its own, smaller limit instead of once per item against the default ones.
+BATCH_RATE_LIMIT = os.getenv('BATCH_RATE_LIMIT', '100 per day; 20 per hour; 5 per minute')
+app.view_functions['routes.calculate_batch'] = limiter.limit(BATCH_RATE_LIMIT)(calculate_batch)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 logger = logging.getLogger(__name__)
@@ -54,9 +62,8 @@ except Exception as e:
     logger.error(f"Failed to initialize AI: {e}")
     exit(1)
 
-cleanup_thread = threading.Thread(target=cleanup_worker, daemon=True)
-cleanup_thread.start()
-logger.info(f"Started cleanup worker thread (interval: {CLEANUP_INTERVAL/3600:.1f}h, max age: {MAX_FILE_AGE/3600:.1f}h)")
+# Started by the first request in each worker, not here, so nothing runs in a preloading master.
+app.before_request(start_cleanup_worker)
 
 if __name__ == '__main__':
     if not os.path.exists('static'):
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+ASGI entry point for the AI Calculator
+- /calculate and /calculate-text run on the event loop with async provider clients,
+  so one process can hold hundreds of in-flight model calls
+- Every other route is served by the Flask app in app.py
+
+Run with: uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 4
+"""
+import asyncio
+import json
+import os
+import time
+from asgiref.wsgi import WsgiToAsgi
+from limits import parse_many
+from limits.storage import storage_from_string
+from limits.strategies import FixedWindowRateLimiter
+from app import app as flask_app, rate_limits, CORS_ALLOWED_ORIGINS
+from aicalc.config import logger, REDIS_URL
+from aicalc import ai_providers
+from aicalc.ai_providers import agenerate_ai_response, aclose_providers, DeadlineExceeded, REQUEST_DEADLINE
+from aicalc.circuit_breaker import CircuitOpenError
+from aicalc.cache import get_cache_key, cache_response
+from aicalc.image_keys import image_hash, remember_image_hash, ImageRejected
+from aicalc.image_ingest import decode_upload, prepare_image
+from aicalc.text_keys import normalize_question
+from aicalc.local_solver import solve_locally
+from aicalc.singleflight import async_single_flight
+from aicalc.prompts import IMAGE_PROMPT, text_prompt
+from aicalc.metrics import REQUEST_SECONDS, timed
+from aicalc.admission import aadmitted, text_priority, PRIORITY_IMAGE
+from aicalc.cleanup import start_cleanup_worker
+from aicalc.routes import build_ai_result, get_cached_solution
+
+MAX_BODY_BYTES = int(os.getenv('MAX_BODY_BYTES', 16 * 1024 * 1024))
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+# Same per-IP limits Flask-Limiter applies to the WSGI routes, in their own namespace.
+rate_limiter = FixedWindowRateLimiter(storage_from_string(REDIS_URL))
+request_limits = parse_many('; '.join(rate_limits.get(ai_providers.api_backend, rate_limits["gemini"])))
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+def _rate_limited(client_ip):
+    try:
+        return not all(rate_limiter.hit(limit, 'asgi', client_ip) for limit in request_limits)
+    except Exception as e:
+        logger.warning(f"Rate limit storage unavailable, allowing request: {e}")
+        return False
+
+async def calculate(data, deadline):
+    try:
+        img = await asyncio.to_thread(decode_upload, data.get('image'))
+    except ImageRejected as e:
+        raise HTTPError(400, str(e))
+    img_hash = await asyncio.to_thread(image_hash, img)
+    cache_key = get_cache_key(image_hash=img_hash)
+    cached_result = await asyncio.to_thread(get_cached_solution, cache_key)
+    if cached_result:
+        logger.info("Returning cached result for image")
+        return cached_result
+
+    async def compute():
+        trace = {}
+        image = await asyncio.to_thread(prepare_image, img)
+        async with aadmitted(PRIORITY_IMAGE, IMAGE_PROMPT, image):
+            with timed('model'):
+                response_text = await agenerate_ai_response(IMAGE_PROMPT, image, deadline=deadline, trace=trace)
+        result = await asyncio.to_thread(build_ai_result, response_text, '', trace, cache_key)
+        await asyncio.to_thread(cache_response, cache_key, result)
+        remember_image_hash(img_hash)
+        return result
+    return await async_single_flight.do(cache_key, compute)
+
+async def calculate_text(data, deadline):
+    question_text = data.get('question')
+    if not question_text or not question_text.strip():
+        raise HTTPError(400, 'No question provided.')
+    cache_key = get_cache_key(text_data=normalize_question(question_text))
+    cached_result = await asyncio.to_thread(get_cached_solution, cache_key)
+    if cached_result:
+        logger.info("Returning cached result for text")
+        return cached_result
+    local_result = await asyncio.to_thread(solve_locally, question_text)
+    if local_result:
+        await asyncio.to_thread(cache_response, cache_key, local_result)
+        return local_result
+
+    async def compute():
+        trace = {}
+        prompt = text_prompt(question_text)
+        async with aadmitted(text_priority(question_text), prompt):
+            with timed('model'):
+                response_text = await agenerate_ai_response(prompt, deadline=deadline, trace=trace)
+        result = await asyncio.to_thread(build_ai_result, response_text, ' for text question', trace, cache_key)
+        await asyncio.to_thread(cache_response, cache_key, result)
+        return result
+    return await async_single_flight.do(cache_key, compute)
+
+HANDLERS = {
+    '/calculate': calculate,
+    '/calculate-text': calculate_text,
+}
+
+def _cors_headers(scope):
+    if not CORS_ALLOWED_ORIGINS:
+        return [(b'access-control-allow-origin', b'*')]
+    origin = dict(scope['headers']).get(b'origin', b'').decode()
+    if origin in CORS_ALLOWED_ORIGINS:
+        return [(b'access-control-allow-origin', origin.encode()), (b'vary', b'Origin')]
+    return []
+
+async def _send_json(send, scope, status, payload, extra_headers=()):
+    body = json.dumps(payload).encode()
+    headers = [
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(body)).encode()),
+    ] + _cors_headers(scope) + list(extra_headers)
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def _read_body(receive):
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise HTTPError(400, 'Client disconnected.')
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            raise HTTPError(413, 'Request body too large.')
+        chunks.append(chunk)
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+def _timed_send(send, endpoint):
+    # Same endpoint names as the Flask routes, so both servers feed one histogram.
+    start = time.perf_counter()
+    async def timed_send(message):
+        if message['type'] == 'http.response.start':
+            REQUEST_SECONDS.labels(endpoint, message['status']).observe(time.perf_counter() - start)
+        await send(message)
+    return timed_send
+
+async def _handle(scope, receive, send, handler):
+    deadline = time.monotonic() + REQUEST_DEADLINE
+    send = _timed_send(send, f'routes.{handler.__name__}')
+    try:
+        client_ip = scope['client'][0] if scope.get('client') else '127.0.0.1'
+        if await asyncio.to_thread(_rate_limited, client_ip):
+            raise HTTPError(429, 'Rate limit exceeded. Please try again later.')
+        body = await _read_body(receive)
+        content_type = dict(scope['headers']).get(b'content-type', b'').decode()
+        if content_type.startswith('image/'):
+            # Binary upload from the page: the body is the PNG itself.
+            data = {'image': body}
+        else:
+            try:
+                data = json.loads(body or b'{}')
+            except ValueError:
+                raise HTTPError(400, 'Request body is not valid JSON.')
+            if not isinstance(data, dict):
+                raise HTTPError(400, 'Request body must be a JSON object.')
+        result = await handler(data, deadline)
+        await _send_json(send, scope, 200, result)
+    except HTTPError as e:
+        await _send_json(send, scope, e.status, {'success': False, 'error': e.message})
+    except CircuitOpenError as e:
+        logger.warning('AI providers unavailable in %s: %s', scope['path'], str(e))
+        retry_after = str(max(1, int(e.retry_after + 0.5))).encode()
+        await _send_json(send, scope, 503, {
+            'success': False,
+            'error': 'The AI service is temporarily unavailable. Please try again shortly.'
+        }, [(b'retry-after', retry_after)])
+    except DeadlineExceeded as e:
+        logger.error('Deadline exceeded in %s: %s', scope['path'], str(e))
+        await _send_json(send, scope, 504, {
+            'success': False,
+            'error': 'The AI service took too long to respond. Please try again later.'
+        })
+    except Exception as e:
+        logger.error('Error in %s: %s', scope['path'], str(e), exc_info=True)
+        await _send_json(send, scope, 500, {
+            'success': False,
+            'error': 'An internal error occurred. Please try again later.'
+        })
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            start_cleanup_worker()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await aclose_providers()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    handler = HANDLERS.get(scope.get('path'))
+    if scope['type'] == 'http' and scope['method'] == 'POST' and handler is not None:
+        await _handle(scope, receive, send, handler)
+        return
+    await wsgi_app(scope, receive, send)
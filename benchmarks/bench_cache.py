@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the response cache.
+
+Compares insert/lookup latency of the original dict cache, which swept the
+whole table for expired keys on every insert, with the LRU tier in
+aicalc/cache.py at 10k and 100k live entries.
+
+    python benchmarks/bench_cache.py [--sizes 10000 100000] [--ops 2000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aicalc.cache import LRUCache, CACHE_TTL
+
+class LegacyDictCache:
+    """The cache as it was before the LRU tier: a dict swept on every insert."""
+
+    def __init__(self, ttl=CACHE_TTL):
+        self.ttl = ttl
+        self.entries = {}
+
+    def get(self, key):
+        if key in self.entries:
+            cached_data, timestamp = self.entries[key]
+            if time.time() - timestamp < self.ttl:
+                return cached_data
+            del self.entries[key]
+        return None
+
+    def set(self, key, value):
+        self.entries[key] = (value, time.time())
+        current_time = time.time()
+        expired_keys = [k for k, (_, ts) in self.entries.items() if current_time - ts > self.ttl]
+        for k in expired_keys:
+            del self.entries[k]
+
+def measure(fn, keys):
+    start = time.perf_counter()
+    for key in keys:
+        fn(key)
+    return (time.perf_counter() - start) / len(keys) * 1e6
+
+def bench(size, ops):
+    value = {'success': True, 'solution': '<p>x</p>' * 50}
+    legacy = LegacyDictCache()
+    lru = LRUCache(max_entries=size + ops, max_bytes=1 << 40)
+    now = time.time()
+    for i in range(size):
+        # Prefill the legacy dict directly; going through set() would be quadratic.
+        legacy.entries[f"k{i}"] = (value, now)
+        lru.set(f"k{i}", value, 400)
+    insert_keys = [f"n{i}" for i in range(ops)]
+    lookup_keys = [f"k{i * (size // ops or 1) % size}" for i in range(ops)]
+    return {
+        'entries': size,
+        'legacy_insert_us': measure(lambda k: legacy.set(k, value), insert_keys),
+        'lru_insert_us': measure(lambda k: lru.set(k, value, 400), insert_keys),
+        'legacy_lookup_us': measure(legacy.get, lookup_keys),
+        'lru_lookup_us': measure(lru.get, lookup_keys),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--ops', type=int, default=2000)
+    args = parser.parse_args()
+    print(f"{'entries':>8} {'legacy insert':>14} {'lru insert':>11} {'legacy get':>11} {'lru get':>8}  (µs/op)")
+    for size in args.sizes:
+        r = bench(size, args.ops)
+        print(f"{r['entries']:>8} {r['legacy_insert_us']:>14.2f} {r['lru_insert_us']:>11.2f} "
+              f"{r['legacy_lookup_us']:>11.2f} {r['lru_lookup_us']:>8.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for model reply post-processing.
+
+Compares the original clean-up (three fence-stripping re.sub calls, a search per
+diagram kind, then another re.sub, handling only the first diagram block, followed by a
+throwaway json.dumps of the result) with the single-pass aicalc/postprocess.py, which
+also sanitizes the HTML and handles every diagram block, on synthetic replies of
+growing size.
+
+    python benchmarks/bench_postprocess.py [--sizes 4000 64000 1000000] [--rounds 200]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aicalc.postprocess import clean_response
+
+PARAGRAPH = ("<p>Differentiate term by term: \\( \\frac{d}{dx} x^3 = 3x^2 \\) and "
+             "\\( \\frac{d}{dx} \\sin x = \\cos x \\), so \\[ f'(x) = 3x^2 + \\cos x. \\]</p>\n")
+PLOT = "<!--PLOT-START-->\n```python\nx = np.linspace(-3, 3, 200)\nplt.plot(x, x**3 + np.sin(x))\n```\n<!--PLOT-END-->\n"
+TIKZ = "<!--TIKZ-START-->\n\\node[state,initial] (q0) {$q_0$};\n\\node[state] (q1) [right of=q0] {$q_1$};\n<!--TIKZ-END-->\n"
+
+def legacy_process(response_text):
+    """The clean-up as it was in aicalc/routes.py, with diagram submission stubbed out."""
+    cleaned_response = response_text
+    cleaned_response = re.sub(r'^```(?:html|markdown)?\s*', '', cleaned_response)
+    cleaned_response = re.sub(r'\s*```$', '', cleaned_response)
+    cleaned_response = re.sub(r'```\w*\s*|\s*```', '', cleaned_response)
+    for kind, marker in (('plot', 'PLOT'), ('tikz', 'TIKZ')):
+        pattern = re.compile(f'<!--{marker}-START-->(.*?)<!--{marker}-END-->', re.DOTALL)
+        match = pattern.search(cleaned_response)
+        if match:
+            placeholder = f'<div data-diagram-job="{kind}"></div>'
+            cleaned_response = pattern.sub(lambda m: placeholder, cleaned_response)
+            break
+    json.dumps({'solution': cleaned_response})
+    return cleaned_response
+
+def single_pass(response_text):
+    return clean_response(response_text, lambda kind, code: f'<div data-diagram-job="{kind}"></div>')
+
+def make_reply(size):
+    """A fenced HTML reply of about size characters with a diagram block every 4 KB."""
+    parts = ['```html\n']
+    length = 0
+    while length < size:
+        chunk = PARAGRAPH * 20 + (PLOT if len(parts) % 2 else TIKZ)
+        parts.append(chunk)
+        length += len(chunk)
+    parts.append('```')
+    return ''.join(parts)
+
+def measure(fn, text, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn(text)
+    return (time.perf_counter() - start) / rounds * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[4000, 64000, 1000000])
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+    print(f"{'chars':>9} {'blocks':>7} {'legacy':>10} {'single pass':>12}  (µs/reply)")
+    for size in args.sizes:
+        reply = make_reply(size)
+        rounds = max(1, args.rounds * 4000 // len(reply))
+        blocks = reply.count('-START-->')
+        print(f"{len(reply):>9} {blocks:>7} {measure(legacy_process, reply, rounds):>10.1f} "
+              f"{measure(single_pass, reply, rounds):>12.1f}")
+
+if __name__ == '__main__':
+    main()
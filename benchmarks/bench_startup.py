@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Startup time and per-worker memory of the app, with and without SDK preloading.
+
+First times `import app` in fresh interpreters, with the provider SDKs imported on first
+use (the default) and up front (PRELOAD_SDKS=true). Then boots gunicorn in three modes
+and reports the time until the server first answers, and the RSS and PSS of each worker:
+
+    eager    every worker imports the app and the SDKs itself (GUNICORN_PRELOAD=false)
+    lazy     every worker imports the app; the SDKs wait for the first model call
+    preload  the master imports the app and the SDKs once and forks the workers
+
+PSS divides pages shared with other processes among them, so it shows what each worker
+costs once the master's copy-on-write pages are shared. A dummy GEMINI_API_KEY is used
+and no model is called, so lazy workers have not loaded the SDK yet when measured.
+
+    python benchmarks/bench_startup.py [--repeat 5] [--workers 4] [--modes eager lazy preload]
+        [--output startup.json]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from load_test import _children, _rss_mb
+
+STARTUP_TIMEOUT = 60
+MODES = {
+    'eager': {'GUNICORN_PRELOAD': 'false', 'PRELOAD_SDKS': 'true'},
+    'lazy': {'GUNICORN_PRELOAD': 'false', 'PRELOAD_SDKS': 'false'},
+    'preload': {'GUNICORN_PRELOAD': 'true', 'PRELOAD_SDKS': 'true'},
+}
+
+def base_env(state_dir):
+    env = dict(os.environ)
+    env.update({
+        'GEMINI_API_KEY': 'benchmark-dummy-key',
+        'REDIS_URL': 'memory://',
+        'CACHE_BACKEND': 'memory',
+        'CACHE_PERSIST_PATH': os.path.join(state_dir, 'cache.sqlite'),
+        'ARTIFACT_INDEX_PATH': os.path.join(state_dir, 'artifacts.sqlite'),
+        'PROMETHEUS_MULTIPROC_DIR': os.path.join(state_dir, 'metrics'),
+    })
+    # Vertex credentials in the environment would change which SDK is measured.
+    env.pop('GOOGLE_APPLICATION_CREDENTIALS', None)
+    env.pop('AI_PROVIDER', None)
+    return env
+
+def time_import(env, repeat):
+    """Median wall time of `import app` in a fresh interpreter."""
+    os.makedirs(env['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import app'], cwd=ROOT, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return round(statistics.median(timings), 3)
+
+def _pss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+def _answers(base_url):
+    try:
+        with urllib.request.urlopen(f"{base_url}/metrics", timeout=2) as response:
+            response.read()
+        return True
+    except Exception:
+        return False
+
+def boot(mode, env, workers, port, state_dir):
+    env = dict(env, **MODES[mode])
+    shutil.rmtree(env['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+    log = open(os.path.join(state_dir, f"gunicorn-{mode}.log"), 'w')
+    start = time.perf_counter()
+    server = subprocess.Popen(['gunicorn', '-w', str(workers), '-b', f"127.0.0.1:{port}", 'app:app'],
+                              cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while True:
+            if server.poll() is not None:
+                sys.exit(f"gunicorn exited with code {server.returncode}; see {log.name}")
+            if time.monotonic() > deadline:
+                sys.exit(f"gunicorn did not answer within {STARTUP_TIMEOUT}s; see {log.name}")
+            if _answers(base_url):
+                break
+            time.sleep(0.1)
+        ready = time.perf_counter() - start
+        # Workers booting in parallel may still be importing after the first one answers.
+        time.sleep(2)
+        pids = _children(server.pid)
+        return {
+            'mode': mode,
+            'ready_seconds': round(ready, 2),
+            'master_rss_mb': _rss_mb(server.pid),
+            'workers': [{'pid': pid, 'rss_mb': _rss_mb(pid), 'pss_mb': _pss_mb(pid)} for pid in pids],
+            'mean_worker_rss_mb': round(statistics.mean(_rss_mb(pid) for pid in pids), 1),
+            'total_pss_mb': round(sum(_pss_mb(pid) or 0 for pid in pids + [server.pid]), 1),
+        }
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='imports to time per setting')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=5078)
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=list(MODES))
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args()
+
+    state_dir = tempfile.mkdtemp(prefix='aicalc-startup-')
+    env = base_env(state_dir)
+    try:
+        results = {
+            'import_seconds': {
+                'lazy': time_import(dict(env, PRELOAD_SDKS='false'), args.repeat),
+                'preload_sdks': time_import(dict(env, PRELOAD_SDKS='true'), args.repeat),
+            },
+            'gunicorn': [],
+        }
+        print(f"import app: {results['import_seconds']['lazy']:.2f}s lazy, "
+              f"{results['import_seconds']['preload_sdks']:.2f}s with PRELOAD_SDKS (median of {args.repeat})")
+        for mode in args.modes:
+            result = boot(mode, env, args.workers, args.port, state_dir)
+            results['gunicorn'].append(result)
+            pss = ', '.join(f"{w['pss_mb']:.0f}" for w in result['workers'] if w['pss_mb'] is not None)
+            print(f"{mode:>8}: ready in {result['ready_seconds']:.2f}s, master {result['master_rss_mb']:.0f} MB, "
+                  f"workers {result['mean_worker_rss_mb']:.0f} MB RSS on average (PSS {pss or 'n/a'}), "
+                  f"{result['total_pss_mb']:.0f} MB PSS in total")
+    finally:
+        shutil.rmtree(state_dir, ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nWrote {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Benchmark for TikZ rendering.
+
+Renders a corpus of typical automata and tree diagrams with a cold pdflatex run
+(full preamble every time) and with the precompiled preamble format file from
+aicalc/diagrams.py, and reports per-diagram latency for both paths.
+
+Needs pdflatex and pdftoppm (or ImageMagick) on PATH.
+
+    python benchmarks/bench_tikz.py [--rounds 3]
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aicalc import diagrams
+
+CORPUS = {
+    'dfa': r"""
+\node[state,initial] (q0) {$q_0$};
+\node[state] (q1) [right of=q0] {$q_1$};
+\node[state,accepting] (q2) [right of=q1] {$q_2$};
+\path[->] (q0) edge node {a} (q1)
+          (q1) edge node {b} (q2)
+          (q1) edge [loop above] node {a} ()
+          (q2) edge [bend left] node {a,b} (q0);
+""",
+    'nfa': r"""
+\node[state,initial] (s) {$s$};
+\node[state] (p) [above right of=s] {$p$};
+\node[state] (q) [below right of=s] {$q$};
+\node[state,accepting] (f) [below right of=p] {$f$};
+\path[->] (s) edge node {$\epsilon$} (p)
+          (s) edge node [swap] {$\epsilon$} (q)
+          (p) edge node {0} (f)
+          (q) edge node [swap] {1} (f)
+          (p) edge [loop above] node {0,1} ();
+""",
+    'binary tree': r"""
+\node {8}
+  child {node {3}
+    child {node {1}}
+    child {node {6} child {node {4}} child {node {7}}}}
+  child {node {10}
+    child[missing]
+    child {node {14} child {node {13}} child[missing]}};
+""",
+    'graph': r"""
+\node[circle,draw] (a) at (0,0) {A};
+\node[circle,draw] (b) at (2,1) {B};
+\node[circle,draw] (c) at (2,-1) {C};
+\node[circle,draw] (d) at (4,0) {D};
+\draw[->] (a) -- node {4} (b);
+\draw[->] (a) -- node [swap] {2} (c);
+\draw[->] (c) -- node [swap] {5} (b);
+\draw[->] (b) -- node {10} (d);
+\draw[->] (c) -- node [swap] {3} (d);
+""",
+}
+
+def render_all(rounds):
+    timings = []
+    for _ in range(rounds):
+        for name, code in CORPUS.items():
+            start = time.perf_counter()
+            if not diagrams.generate_tikz_diagram(code, f"{name.replace(' ', '_')}.png"):
+                raise RuntimeError(f"Rendering {name} failed")
+            timings.append(time.perf_counter() - start)
+    return timings
+
+def summarize(label, timings):
+    ordered = sorted(timings)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    print(f"{label:>6} {statistics.mean(timings) * 1000:>10.0f} {statistics.median(timings) * 1000:>10.0f} {p95 * 1000:>10.0f}")
+    return statistics.mean(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+    if shutil.which('pdflatex') is None:
+        sys.exit("pdflatex not found on PATH")
+    with tempfile.TemporaryDirectory() as work_dir:
+        # generate_tikz_diagram writes under static/generated relative to the working directory.
+        os.chdir(work_dir)
+        diagrams.TIKZ_FORMAT_DIR = os.path.join(work_dir, 'formats')
+        start = time.perf_counter()
+        if diagrams.tikz_format() is None:
+            sys.exit("Could not build the TikZ format file")
+        print(f"format build: {time.perf_counter() - start:.1f}s (once per host)")
+        print(f"{'path':>6} {'mean ms':>10} {'median ms':>10} {'p95 ms':>10}  ({len(CORPUS)} diagrams x {args.rounds})")
+        diagrams.TIKZ_WARM_FORMAT = False
+        cold = summarize('cold', render_all(args.rounds))
+        diagrams.TIKZ_WARM_FORMAT = True
+        warm = summarize('warm', render_all(args.rounds))
+        print(f"speedup: {cold / warm:.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+Load test for the web app under gunicorn with a simulated AI provider.
+
+Starts gunicorn on app:app with AI_PROVIDER=stub, so no model quota is spent. The
+stub's latency distribution, error and 429 rates and canned replies (by default
+benchmarks/stub_responses.json, which includes PLOT and TIKZ blocks) are set from
+the command line. The test then drives /calculate (binary PNG drawings), /calculate-text
+and /health from a pool of client threads at each requested concurrency. For each
+level it reports requests per second, latency percentiles per endpoint, the memory of
+every gunicorn worker and per-stage costs (model, post-processing, diagram renders,
+pdflatex) taken from /metrics. Caches, metrics and diagrams (DIAGRAM_STORAGE=memory)
+start empty on every run. Each level uses its own set of questions and drawings;
+--distinct sets how many there are, which controls the cache hit ratio.
+
+--output writes the results as JSON, and --compare prints the change against an
+earlier run, so two commits can be measured the same way:
+
+    python benchmarks/load_test.py [--workers 4] [--concurrency 4 16 64] [--duration 20]
+        [--mix calculate=1,calculate-text=3,health=1] [--distinct 200]
+        [--latency 0.5] [--latency-dist lognormal] [--error-rate 0.02] [--rate-limit-rate 0]
+        [--output results.json] [--compare baseline.json] [--url http://host:port]
+"""
+import argparse
+import io
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from PIL import Image, ImageDraw
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_RESPONSES = os.path.join(ROOT, 'benchmarks', 'stub_responses.json')
+REQUEST_TIMEOUT = 120
+STARTUP_TIMEOUT = 60
+STAGES = ('decode', 'prepare', 'encode', 'image_hash', 'cache_lookup', 'model', 'postprocess',
+          'render_plot', 'render_tikz', 'pdflatex', 'tikz_rasterize', 'png_optimize')
+STAGE_SAMPLE = re.compile(r'^aicalc_stage_seconds_(sum|count)\{stage="(\w+)"\} (\S+)$', re.MULTILINE)
+
+def drawing(seed):
+    """A PNG of a few random strokes, white on black like the canvas; distinct seeds hash apart."""
+    rng = random.Random(seed)
+    img = Image.new('RGB', (320, 240), 'black')
+    draw = ImageDraw.Draw(img)
+    for _ in range(rng.randint(3, 6)):
+        points = [(rng.randint(10, 310), rng.randint(10, 230)) for _ in range(rng.randint(2, 5))]
+        draw.line(points, fill='white', width=6)
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def question(seed):
+    # Worded so the local sympy solver passes it on to the (stub) model.
+    return f"Explain step by step how to approach worked example {seed} on convergent series"
+
+class Workload:
+    def __init__(self, base_url, mix, distinct, level):
+        self.base_url = base_url
+        self.endpoints = list(mix)
+        self.weights = [mix[name] for name in self.endpoints]
+        self.distinct = distinct
+        self.level = level
+        self._drawings = {}
+        self._lock = threading.Lock()
+
+    def _drawing(self, i):
+        with self._lock:
+            if i not in self._drawings:
+                self._drawings[i] = drawing(f"{self.level}-{i}")
+            return self._drawings[i]
+
+    def request(self, rng):
+        name = rng.choices(self.endpoints, self.weights)[0]
+        i = rng.randrange(self.distinct)
+        if name == 'calculate':
+            return name, urllib.request.Request(f"{self.base_url}/calculate", data=self._drawing(i),
+                                                headers={'Content-Type': 'image/png'})
+        if name == 'calculate-text':
+            body = json.dumps({'question': question(f"{self.level}-{i}")}).encode()
+            return name, urllib.request.Request(f"{self.base_url}/calculate-text", data=body,
+                                                headers={'Content-Type': 'application/json'})
+        return name, urllib.request.Request(f"{self.base_url}/health")
+
+def send(req):
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        status = e.code
+    except Exception:
+        status = 0
+    return status, time.perf_counter() - start
+
+def drive(workload, concurrency, duration, seed):
+    """Run concurrency client threads for duration seconds; returns [(endpoint, status, seconds)]."""
+    samples = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(n):
+        rng = random.Random(f"{seed}-{workload.level}-{n}")
+        local = []
+        while time.monotonic() < deadline:
+            name, req = workload.request(rng)
+            status, seconds = send(req)
+            local.append((name, status, seconds))
+        with lock:
+            samples.extend(local)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def summarize(samples, elapsed):
+    endpoints = {}
+    for name in sorted({name for name, _, _ in samples}):
+        rows = [(status, seconds) for n, status, seconds in samples if n == name]
+        latencies = sorted(seconds for _, seconds in rows)
+        statuses = {}
+        for status, _ in rows:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        endpoints[name] = {
+            'requests': len(rows),
+            'rps': round(len(rows) / elapsed, 2),
+            'errors': sum(1 for status, _ in rows if status != 200),
+            'statuses': statuses,
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 2),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p90_ms': round(percentile(latencies, 0.90) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'max_ms': round(latencies[-1] * 1000, 2),
+        }
+    return endpoints
+
+def scrape_stages(base_url):
+    """{stage: (seconds, count)} from /metrics, summed over workers."""
+    try:
+        with urllib.request.urlopen(f"{base_url}/metrics", timeout=10) as response:
+            text = response.read().decode()
+    except Exception:
+        return {}
+    stages = {}
+    for field, stage, value in STAGE_SAMPLE.findall(text):
+        seconds, count = stages.get(stage, (0.0, 0.0))
+        if field == 'sum':
+            seconds += float(value)
+        else:
+            count += float(value)
+        stages[stage] = (seconds, count)
+    return stages
+
+def stage_costs(before, after):
+    costs = {}
+    for stage in STAGES:
+        seconds = after.get(stage, (0, 0))[0] - before.get(stage, (0, 0))[0]
+        count = after.get(stage, (0, 0))[1] - before.get(stage, (0, 0))[1]
+        if count:
+            costs[stage] = {'count': int(count), 'mean_ms': round(seconds / count * 1000, 2)}
+    return costs
+
+def _proc_status(pid):
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                fields[key] = value.strip()
+    except OSError:
+        pass
+    return fields
+
+def _children(pid):
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The parent pid is the second field after the parenthesised command name.
+                if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                    children.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    return children
+
+def _rss_mb(pid, field='VmRSS'):
+    value = _proc_status(pid).get(field, '0 kB').split()[0]
+    return round(int(value) / 1024, 1)
+
+def worker_memory(master_pid):
+    """RSS and peak RSS of each gunicorn worker, plus the helper processes it started (plot workers)."""
+    if master_pid is None or not os.path.isdir('/proc'):
+        return None
+    workers = []
+    for pid in _children(master_pid):
+        helpers = _children(pid)
+        workers.append({
+            'pid': pid,
+            'rss_mb': _rss_mb(pid),
+            'peak_rss_mb': _rss_mb(pid, 'VmHWM'),
+            'helpers': len(helpers),
+            'helpers_rss_mb': round(sum(_rss_mb(helper) for helper in helpers), 1),
+        })
+    return {
+        'master_rss_mb': _rss_mb(master_pid),
+        'workers': workers,
+        'mean_worker_rss_mb': round(sum(w['rss_mb'] for w in workers) / len(workers), 1) if workers else None,
+    }
+
+def start_server(args, state_dir):
+    env = dict(os.environ)
+    env.update({
+        'AI_PROVIDER': 'stub',
+        'STUB_LATENCY': str(args.latency),
+        'STUB_LATENCY_DIST': args.latency_dist,
+        'STUB_ERROR_RATE': str(args.error_rate),
+        'STUB_RATE_LIMIT_RATE': str(args.rate_limit_rate),
+        'STUB_RESPONSES_FILE': args.responses,
+        'STUB_SEED': str(args.seed),
+        'RATELIMIT_ENABLED': 'false',
+        # Fresh caches and metrics for every run, so runs on different commits compare.
+        'CACHE_PERSIST_PATH': os.path.join(state_dir, 'cache.sqlite'),
+        'ARTIFACT_INDEX_PATH': os.path.join(state_dir, 'artifacts.sqlite'),
+        'PROMETHEUS_MULTIPROC_DIR': os.path.join(state_dir, 'metrics'),
+    })
+    env.setdefault('REDIS_URL', 'memory://')
+    # Diagrams already rendered to static/generated by an earlier run would be reused.
+    env.setdefault('DIAGRAM_STORAGE', 'memory')
+    log = open(os.path.join(state_dir, 'gunicorn.log'), 'w')
+    server = subprocess.Popen(['gunicorn', '-w', str(args.workers), '-b', f"127.0.0.1:{args.port}", 'app:app'],
+                              cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{args.port}"
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            sys.exit(f"gunicorn exited with code {server.returncode}; see {log.name}")
+        try:
+            with urllib.request.urlopen(f"{base_url}/health", timeout=2):
+                return server, base_url
+        except Exception:
+            time.sleep(0.5)
+    server.terminate()
+    sys.exit(f"gunicorn did not answer within {STARTUP_TIMEOUT}s; see {log.name}")
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('calculate', 'calculate-text', 'health'):
+            raise argparse.ArgumentTypeError(f"unknown endpoint {name!r}")
+        mix[name] = float(weight or 1)
+    return mix
+
+def print_level(level):
+    print(f"\nconcurrency {level['concurrency']}: {level['rps']:.1f} req/s over {level['seconds']:.1f}s")
+    print(f"  {'endpoint':<16}{'reqs':>7}{'req/s':>9}{'errors':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, e in level['endpoints'].items():
+        print(f"  {name:<16}{e['requests']:>7}{e['rps']:>9.1f}{e['errors']:>8}{e['p50_ms']:>10.1f}"
+              f"{e['p90_ms']:>10.1f}{e['p99_ms']:>10.1f}{e['max_ms']:>10.1f}")
+    if level['stages']:
+        print('  stages: ' + ', '.join(f"{stage} {c['mean_ms']:.1f} ms x{c['count']}"
+                                       for stage, c in level['stages'].items()))
+    memory = level['memory']
+    if memory and memory['workers']:
+        print(f"  memory: " + ', '.join(f"worker {w['rss_mb']:.0f} MB (peak {w['peak_rss_mb']:.0f}, "
+                                        f"+{w['helpers_rss_mb']:.0f} MB in {w['helpers']} helpers)"
+                                        for w in memory['workers']))
+
+def _change(old, new):
+    if not old or new is None:
+        return '      n/a'
+    return f"{(new - old) / old * 100:>+8.1f}%"
+
+def compare(baseline, results):
+    print(f"\nChange against {baseline.get('commit') or 'baseline'} (positive req/s is better, positive latency is worse):")
+    old_levels = {level['concurrency']: level for level in baseline['levels']}
+    for level in results['levels']:
+        old = old_levels.get(level['concurrency'])
+        if old is None:
+            continue
+        print(f"  concurrency {level['concurrency']}: req/s {_change(old['rps'], level['rps'])}")
+        for name, e in level['endpoints'].items():
+            o = old['endpoints'].get(name)
+            if o:
+                print(f"    {name:<16} req/s {_change(o['rps'], e['rps'])}  p50 {_change(o['p50_ms'], e['p50_ms'])}  "
+                      f"p99 {_change(o['p99_ms'], e['p99_ms'])}  errors {o['errors'] / o['requests']:.1%} -> "
+                      f"{e['errors'] / e['requests']:.1%}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=5077)
+    parser.add_argument('--url', help='drive an already running server instead of starting gunicorn')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[4, 16, 64])
+    parser.add_argument('--duration', type=float, default=20, help='seconds per concurrency level')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds of load before the first level')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('calculate=1,calculate-text=3,health=1'))
+    parser.add_argument('--distinct', type=int, default=200, help='distinct questions and drawings per level')
+    parser.add_argument('--latency', type=float, default=0.5, help='stub latency (mean or median) in seconds')
+    parser.add_argument('--latency-dist', choices=['fixed', 'uniform', 'exponential', 'lognormal'], default='lognormal')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--responses', default=DEFAULT_RESPONSES, help='JSON list of canned replies')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    state_dir = tempfile.mkdtemp(prefix='aicalc-load-')
+    server = None
+    if args.url:
+        base_url = args.url.rstrip('/')
+    else:
+        server, base_url = start_server(args, state_dir)
+    master_pid = server.pid if server else None
+    results = {
+        'commit': git_commit(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'port')},
+        'levels': [],
+    }
+    try:
+        if args.warmup:
+            drive(Workload(base_url, args.mix, args.distinct, 'warmup'), min(args.concurrency), args.warmup, args.seed)
+        for concurrency in args.concurrency:
+            workload = Workload(base_url, args.mix, args.distinct, f"c{concurrency}")
+            before = scrape_stages(base_url)
+            start = time.perf_counter()
+            samples = drive(workload, concurrency, args.duration, args.seed)
+            elapsed = time.perf_counter() - start
+            level = {
+                'concurrency': concurrency,
+                'seconds': round(elapsed, 2),
+                'requests': len(samples),
+                'rps': round(len(samples) / elapsed, 2),
+                'endpoints': summarize(samples, elapsed),
+                'stages': stage_costs(before, scrape_stages(base_url)),
+                'memory': worker_memory(master_pid),
+            }
+            results['levels'].append(level)
+            print_level(level)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+        shutil.rmtree(state_dir, ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nWrote {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+# Read by gunicorn from the working directory. It gives the workers a shared
+# PROMETHEUS_MULTIPROC_DIR so /metrics reports the whole server, not just the worker
+# that answers the scrape. Set the variable yourself to keep the files elsewhere.
+#
+# The app is loaded once in the master and forked into the workers (GUNICORN_PRELOAD,
+# on by default), with the AI SDKs imported up front (PRELOAD_SDKS), so the workers
+# share those pages copy-on-write and start serving without importing anything.
+import os
+import shutil
+import tempfile
+
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'aicalc-metrics'))
+
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+if preload_app:
+    os.environ.setdefault('PRELOAD_SDKS', 'true')
+    # A preloaded app creates its metric files before on_starting runs.
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+def on_starting(server):
+    # Samples from a previous run would otherwise be merged into this one. The master's
+    # own files go too; the workers write theirs under their own pids.
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -78,15 +78,50 @@ document.addEventListener("DOMContentLoaded", function () {
     }
   }
 
-  // Image processing function
-  function processImage(imageDataUrl) {
-    resultBox.innerHTML = "<p>Processing your equation...</p>";
-    resultContainer.style.display = "flex";
-    
-    fetch("/calculate", {
+  function typesetResult() {
+    if (window.MathJax) { try { MathJax.typeset(); } catch (err) { console.error("MathJax error:", err); } }
+  }
+
+  // Polls a diagram that was still rendering when the solution arrived and swaps it in
+  function pollDiagram(jobId, attempt = 0) {
+    const placeholder = () => resultBox.querySelector(`[data-diagram-job="${jobId}"]`);
+    if (!placeholder()) return;
+    const retry = () => {
+      if (attempt < 60) setTimeout(() => pollDiagram(jobId, attempt + 1), Math.min(500 * (attempt + 1), 3000));
+    };
+    fetch(`/diagram/${jobId}`)
+      .then((response) => response.json())
+      .then((job) => {
+        if (job.html && placeholder()) placeholder().outerHTML = job.html;
+        else retry();
+      })
+      .catch(retry);
+  }
+
+  function showSolution(data) {
+    if (data.success) {
+      resultBox.innerHTML = data.solution || "Solution processed successfully but was empty.";
+      typesetResult();
+      (data.diagram_jobs || []).forEach((jobId) => pollDiagram(jobId));
+    } else {
+      resultBox.innerHTML = `<p>Error: ${data.error || "Unknown error occurred"}</p>`;
+    }
+  }
+
+  // A Blob payload is the prepared drawing, sent as the raw request body; anything
+  // else goes as JSON.
+  function requestBody(payload) {
+    if (payload instanceof Blob) return { type: payload.type, body: payload };
+    return { type: "application/json", body: JSON.stringify(payload) };
+  }
+
+  // Buffered request to the JSON endpoint, for browsers without streaming fetch bodies
+  function requestSolution(url, payload) {
+    const { type, body } = requestBody(payload);
+    return fetch(url, {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ image: imageDataUrl }),
+      headers: { "Content-Type": type },
+      body: body,
     })
       .then((response) => {
         if (!response.ok) throw new Error(`Server responded with status: ${response.status}`);
@@ -97,14 +132,122 @@ document.addEventListener("DOMContentLoaded", function () {
         try { data = JSON.parse(text); } catch (e) { throw new Error("Failed to parse server response as JSON."); }
         return data;
       })
-      .then((data) => {
-        if (data.success) {
-          resultBox.innerHTML = data.solution || "Solution processed successfully but was empty.";
-          if (window.MathJax) { try { MathJax.typeset(); } catch (err) { console.error("MathJax error:", err); } }
-        } else {
-          resultBox.innerHTML = `<p>Error: ${data.error || "Unknown error occurred"}</p>`;
+      .then(showSolution);
+  }
+
+  // Streams the solution from the SSE endpoint and renders it as it arrives.
+  // Events: delta (HTML to append), diagram (replaces the placeholder), done, error.
+  function streamSolution(url, payload) {
+    if (!window.ReadableStream || !window.TextDecoder) {
+      return requestSolution(url.replace("-stream", ""), payload);
+    }
+    let html = "";
+    const handlers = {
+      delta: (data) => {
+        html += data.html;
+        resultBox.innerHTML = html;
+      },
+      diagram: (data) => {
+        const pending = new RegExp(`<div class="math-diagram-container diagram-pending" data-diagram-job="${data.id}">[\\s\\S]*?</div>`, "g");
+        html = html.replace(pending, data.html);
+        resultBox.innerHTML = html;
+      },
+      done: showSolution,
+      error: showSolution,
+    };
+    const { type, body } = requestBody(payload);
+    return fetch(url, {
+      method: "POST",
+      headers: { "Content-Type": type, "Accept": "text/event-stream" },
+      body: body,
+    }).then((response) => {
+      if (!response.ok) throw new Error(`Server responded with status: ${response.status}`);
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      function read() {
+        return reader.read().then(({ done, value }) => {
+          buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+          let end;
+          while ((end = buffer.indexOf("\n\n")) >= 0) {
+            const message = buffer.slice(0, end);
+            buffer = buffer.slice(end + 2);
+            let event = "message";
+            let data = "";
+            message.split("\n").forEach((line) => {
+              if (line.startsWith("event: ")) event = line.slice(7);
+              else if (line.startsWith("data: ")) data += line.slice(6);
+            });
+            if (handlers[event] && data) handlers[event](JSON.parse(data));
+          }
+          if (!done) return read();
+        });
+      }
+      return read();
+    });
+  }
+
+  // Uploads are cropped to the strokes and scaled down before they leave the browser;
+  // the server does the same again, so this only has to be cheap, not exact.
+  const MAX_UPLOAD_SIDE = 1024;
+  const UPLOAD_MARGIN = 24;
+  const INK_DIFFERENCE = 48;
+
+  // Bounding box of the pixels that differ from the corner (background) colour, or null.
+  function findInk(imageData) {
+    const { data, width, height } = imageData;
+    const bgLuma = (data[0] * 299 + data[1] * 587 + data[2] * 114) / 1000;
+    let left = width, top = height, right = -1, bottom = -1;
+    for (let y = 0; y < height; y++) {
+      let row = y * width * 4;
+      for (let x = 0; x < width; x++, row += 4) {
+        const luma = (data[row] * 299 + data[row + 1] * 587 + data[row + 2] * 114) / 1000;
+        if (Math.abs(luma - bgLuma) > INK_DIFFERENCE) {
+          if (x < left) left = x;
+          if (x > right) right = x;
+          if (y < top) top = y;
+          if (y > bottom) bottom = y;
         }
-      })
+      }
+    }
+    if (right < 0) return null;
+    return {
+      x: Math.max(left - UPLOAD_MARGIN, 0),
+      y: Math.max(top - UPLOAD_MARGIN, 0),
+      width: Math.min(right + UPLOAD_MARGIN, width - 1) - Math.max(left - UPLOAD_MARGIN, 0) + 1,
+      height: Math.min(bottom + UPLOAD_MARGIN, height - 1) - Math.max(top - UPLOAD_MARGIN, 0) + 1,
+    };
+  }
+
+  // Crop a canvas or loaded <img> to its ink, downscale it and encode it as a PNG Blob.
+  function prepareUpload(source) {
+    let sourceCanvas = source;
+    if (!(source instanceof HTMLCanvasElement)) {
+      sourceCanvas = document.createElement("canvas");
+      sourceCanvas.width = source.naturalWidth;
+      sourceCanvas.height = source.naturalHeight;
+      sourceCanvas.getContext("2d").drawImage(source, 0, 0);
+    }
+    const sourceCtx = sourceCanvas.getContext("2d");
+    const box = findInk(sourceCtx.getImageData(0, 0, sourceCanvas.width, sourceCanvas.height))
+      || { x: 0, y: 0, width: sourceCanvas.width, height: sourceCanvas.height };
+    const scale = Math.min(1, MAX_UPLOAD_SIDE / Math.max(box.width, box.height));
+    const output = document.createElement("canvas");
+    output.width = Math.max(1, Math.round(box.width * scale));
+    output.height = Math.max(1, Math.round(box.height * scale));
+    output.getContext("2d").drawImage(sourceCanvas, box.x, box.y, box.width, box.height, 0, 0, output.width, output.height);
+    return new Promise((resolve, reject) => {
+      output.toBlob((blob) => (blob ? resolve(blob) : reject(new Error("Could not encode the image."))), "image/png");
+    });
+  }
+
+  // Image processing function; source is the drawing canvas or a loaded <img>
+  function processImage(source) {
+    resultBox.innerHTML = "<p>Processing your equation...</p>";
+    resultContainer.style.display = "flex";
+    
+    prepareUpload(source)
+      .then((blob) => streamSolution("/calculate-stream", blob))
       .catch((error) => {
         resultBox.innerHTML = `<p>Error: ${error.message}</p><p>Please try again or try with a simpler equation.</p>`;
       });
@@ -120,28 +263,7 @@ document.addEventListener("DOMContentLoaded", function () {
     resultBox.innerHTML = "<p>Processing your question...</p>";
     resultContainer.style.display = "flex";
     
-    fetch("/calculate-text", {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ question: questionText }),
-    })
-      .then((response) => {
-        if (!response.ok) throw new Error(`Server responded with status: ${response.status}`);
-        return response.text();
-      })
-      .then((text) => {
-        let data;
-        try { data = JSON.parse(text); } catch (e) { throw new Error("Failed to parse server response as JSON."); }
-        return data;
-      })
-      .then((data) => {
-        if (data.success) {
-          resultBox.innerHTML = data.solution || "Solution processed successfully but was empty.";
-          if (window.MathJax) { try { MathJax.typeset(); } catch (err) { console.error("MathJax error:", err); } }
-        } else {
-          resultBox.innerHTML = `<p>Error: ${data.error || "Unknown error occurred"}</p>`;
-        }
-      })
+    streamSolution("/calculate-text-stream", { question: questionText })
       .catch((error) => {
         resultBox.innerHTML = `<p>Error: ${error.message}</p><p>Please try again or try with a simpler question.</p>`;
       });
@@ -607,35 +729,7 @@ document.addEventListener("DOMContentLoaded", function () {
         alert('Canvas not available. Please try refreshing the page.');
         return;
       }
-      // Get canvas data
-      const imageData = canvas.toDataURL("image/png");
-      resultBox.innerHTML = "<p>Processing your equation...</p>";
-      resultContainer.style.display = "flex";
-      fetch("/calculate", {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ image: imageData }),
-      })
-        .then((response) => {
-          if (!response.ok) throw new Error(`Server responded with status: ${response.status}`);
-          return response.text();
-        })
-        .then((text) => {
-          let data;
-          try { data = JSON.parse(text); } catch (e) { throw new Error("Failed to parse server response as JSON."); }
-          return data;
-        })
-        .then((data) => {
-          if (data.success) {
-            resultBox.innerHTML = data.solution || "Solution processed successfully but was empty.";
-            if (window.MathJax) { try { MathJax.typeset(); } catch (err) { console.error("MathJax error:", err); } }
-          } else {
-            resultBox.innerHTML = `<p>Error: ${data.error || "Unknown error occurred"}</p>`;
-          }
-        })
-        .catch((error) => {
-          resultBox.innerHTML = `<p>Error: ${error.message}</p><p>Please try again or try with a simpler equation.</p>`;
-        });
+      processImage(canvas);
     }
   });
 
@@ -688,7 +782,7 @@ document.addEventListener("DOMContentLoaded", function () {
   });
 
   processUploadedImage.addEventListener('click', () => {
-    processImage(uploadedImage.src);
+    processImage(uploadedImage);
   });
 
   clearUploadedImage.addEventListener('click', () => {
@@ -703,7 +797,8 @@ document.addEventListener("DOMContentLoaded", function () {
   captureButton.addEventListener('click', capturePhoto);
 
   processCapturedImage.addEventListener('click', () => {
-    processImage(capturedImage.src);
+    // The captured frame is still on the camera canvas at full resolution.
+    processImage(cameraCanvas);
   });
 
   clearCapturedImage.addEventListener('click', () => {
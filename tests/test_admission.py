@@ -0,0 +1,94 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aicalc import admission as admission_module
+from aicalc.admission import (AdmissionController, AdmissionRejected, QuotaBuckets, PRIORITY_SHORT_TEXT,
+                              PRIORITY_TEXT, PRIORITY_IMAGE)
+
+class SlowBuckets(QuotaBuckets):
+    """Unlimited buckets whose take() blocks until released, like a Redis that stopped answering."""
+
+    def __init__(self):
+        super().__init__(rpm=0, tpm=0)
+        self.taking = threading.Event()
+        self.release = threading.Event()
+
+    def take(self, tokens):
+        self.taking.set()
+        self.release.wait(5)
+        return 0.0
+
+def _controller(buckets=None, limit=1):
+    controller = AdmissionController(buckets or QuotaBuckets(rpm=0, tpm=0), enabled=True)
+    controller.limit = float(limit)
+    return controller
+
+def test_waiting_requests_start_in_priority_order():
+    controller = _controller()
+    first = controller.acquire(PRIORITY_IMAGE, 10)
+    order = []
+
+    def wait_for_slot(priority):
+        ticket = controller.acquire(priority, 10)
+        order.append(priority)
+        controller.release(ticket)
+
+    threads = []
+    for priority in (PRIORITY_IMAGE, PRIORITY_TEXT, PRIORITY_SHORT_TEXT):
+        threads.append(threading.Thread(target=wait_for_slot, args=(priority,)))
+        threads[-1].start()
+        time.sleep(0.05)
+    controller.release(first)
+    for thread in threads:
+        thread.join(5)
+    assert order == [PRIORITY_SHORT_TEXT, PRIORITY_TEXT, PRIORITY_IMAGE]
+
+def test_full_queue_is_refused(monkeypatch):
+    monkeypatch.setattr(admission_module, 'ADMISSION_MAX_QUEUE', 0)
+    with pytest.raises(AdmissionRejected):
+        _controller().acquire(PRIORITY_TEXT, 10)
+
+def test_slow_buckets_do_not_hold_the_lock():
+    buckets = SlowBuckets()
+    controller = _controller(buckets, limit=4)
+    thread = threading.Thread(target=controller.acquire, args=(PRIORITY_TEXT, 10))
+    thread.start()
+    assert buckets.taking.wait(5)
+    # While one caller is stuck taking tokens, the others can still read the stats and
+    # release their slots without waiting for it.
+    acquired = controller._cond.acquire(timeout=1)
+    assert acquired
+    controller._cond.release()
+    start = time.monotonic()
+    controller.as_dict()
+    assert time.monotonic() - start < 0.5
+    buckets.release.set()
+    thread.join(5)
+    assert controller.in_flight == 1
+
+def test_quota_error_halves_the_limit():
+    controller = _controller(limit=8)
+    ticket = controller.acquire(PRIORITY_TEXT, 10)
+    error = Exception('429 Resource exhausted')
+    error.status_code = 429
+    controller.release(ticket, error)
+    assert controller.limit == 4
+    assert controller.in_flight == 0
+
+def test_retry_backoff_is_not_counted_as_latency(monkeypatch):
+    controller = _controller(limit=4)
+    monkeypatch.setattr(admission_module, 'admission', controller)
+    samples = []
+    adapt = controller._adapt
+    monkeypatch.setattr(controller, '_adapt', lambda latency: samples.append(latency) or adapt(latency))
+    with admission_module.admitted(PRIORITY_TEXT, 'what is 2+2'):
+        with admission_module.retry_backoff():
+            time.sleep(0.3)
+        time.sleep(0.02)
+    assert len(samples) == 1 and samples[0] < 0.2
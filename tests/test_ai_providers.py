@@ -0,0 +1,28 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# The providers module refuses to load without a model provider configured.
+os.environ.setdefault('AI_PROVIDER', 'stub')
+
+from aicalc import ai_providers
+
+def test_sync_and_async_calls_default_to_the_request_deadline(monkeypatch):
+    monkeypatch.setattr(ai_providers, 'ROUTING_MODE', 'fallback')
+    deadlines = []
+
+    def fallback(prompt, image, trace, deadline, providers):
+        deadlines.append(deadline - time.monotonic())
+        return 'answer'
+
+    async def afallback(prompt, image, trace, deadline, providers):
+        return fallback(prompt, image, trace, deadline, providers)
+
+    monkeypatch.setattr(ai_providers, '_fallback_generate', fallback)
+    monkeypatch.setattr(ai_providers, '_afallback_generate', afallback)
+    assert ai_providers.generate_ai_response('2+2') == 'answer'
+    assert asyncio.run(ai_providers.agenerate_ai_response('2+2')) == 'answer'
+    for remaining in deadlines:
+        assert ai_providers.REQUEST_DEADLINE - 1 < remaining <= ai_providers.REQUEST_DEADLINE
@@ -0,0 +1,43 @@
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# The app refuses to start without a model provider configured.
+os.environ.setdefault('AI_PROVIDER', 'stub')
+
+import asgi
+
+def _post(body, content_type=b'application/json'):
+    scope = {'type': 'http', 'method': 'POST', 'path': '/calculate-text', 'client': ('127.0.0.1', 1),
+             'headers': [(b'content-type', content_type)]}
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    async def handler(data, deadline):
+        return {'success': True, 'question': data.get('question')}
+
+    asyncio.run(asgi._handle(scope, receive, send, handler))
+    body = b''.join(m.get('body', b'') for m in sent if m['type'] == 'http.response.body')
+    return sent[0]['status'], json.loads(body)
+
+@pytest.fixture(autouse=True)
+def no_rate_limit(monkeypatch):
+    monkeypatch.setattr(asgi, '_rate_limited', lambda client_ip: False)
+
+@pytest.mark.parametrize('body', [b'{"question": ', b'\xff\xfe', b'[1, 2]', b'"2+2"'])
+def test_malformed_json_body_is_a_client_error(body):
+    status, payload = _post(body)
+    assert status == 400 and not payload['success']
+
+def test_json_body_reaches_the_handler():
+    assert _post(b'{"question": "2+2"}') == (200, {'success': True, 'question': '2+2'})
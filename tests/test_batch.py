@@ -0,0 +1,23 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aicalc.batch import pack_questions, split_answers
+
+def test_packed_prompt_numbers_the_questions():
+    prompt = pack_questions(['2+2', 'integrate x'])
+    assert 'You will be given 2 separate questions' in prompt
+    assert prompt.endswith('Question 1: 2+2\nQuestion 2: integrate x')
+
+def test_answers_are_split_in_question_order():
+    reply = '<!--ANSWER-2-->\nsecond\n<!--ANSWER-1-->\nfirst\n'
+    assert split_answers(reply, 2) == ['first', 'second']
+
+def test_missing_empty_or_stray_answers_come_back_as_none():
+    reply = 'preamble <!--ANSWER-1--> one <!--ANSWER-3-->  <!--ANSWER-7--> seven'
+    assert split_answers(reply, 3) == ['one', None, None]
+    assert split_answers('no markers at all', 2) == [None, None]
+
+def test_first_copy_of_a_repeated_marker_wins():
+    assert split_answers('<!--ANSWER-1-->a<!--ANSWER-1-->b', 1) == ['a']
@@ -0,0 +1,95 @@
+import json
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aicalc.cache import LRUCache, MemorySharedCache, PersistentCache, TieredCache
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, 'time', clock)
+    return clock
+
+def test_lru_evicts_least_recently_used_entry():
+    cache = LRUCache(max_entries=2, max_bytes=1000)
+    cache.set('a', 1, 10)
+    cache.set('b', 2, 10)
+    assert cache.get('a') == 1
+    cache.set('c', 3, 10)
+    assert 'b' not in cache and cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+def test_lru_is_bounded_by_size():
+    cache = LRUCache(max_entries=10, max_bytes=25)
+    cache.set('a', 1, 10)
+    cache.set('b', 2, 10)
+    cache.set('c', 3, 10)
+    assert 'a' not in cache and len(cache) == 2
+    cache.set('big', 4, 26)
+    assert 'big' not in cache and len(cache) == 2
+    cache.set('b', 5, 20)
+    assert cache.get('b') == 5 and len(cache) == 1 and cache.stats()['bytes'] == 20
+
+def test_lru_entries_expire_after_ttl(clock):
+    cache = LRUCache(max_entries=10, max_bytes=1000, ttl=60)
+    cache.set('a', 1, 10)
+    clock.now += 30
+    cache.set('b', 2, 10)
+    clock.now += 31
+    assert cache.get('a') is None and cache.get('b') == 2
+    clock.now += 30
+    cache.set('c', 3, 10)
+    assert len(cache) == 1 and cache.stats()['expirations'] == 2
+
+def test_memory_shared_tier_expires_entries(clock):
+    shared = MemorySharedCache(ttl=60)
+    shared.set('a', 'x')
+    clock.now += 59
+    assert shared.get('a') == 'x'
+    clock.now += 1
+    assert shared.get('a') is None
+
+def test_tiered_cache_promotes_shared_hits_to_the_local_tier():
+    shared = MemorySharedCache()
+    writer, reader = TieredCache(LRUCache(), shared), TieredCache(LRUCache(), shared)
+    writer.set('key', {'solution': 'x = 2'})
+    assert 'key' not in reader
+    assert reader.get('key') == {'solution': 'x = 2'}
+    assert 'key' in reader
+    shared.clear()
+    assert reader.get('key') == {'solution': 'x = 2'}
+
+def test_tiered_cache_survives_a_restart_through_the_disk_tier(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    TieredCache(LRUCache(), MemorySharedCache(), PersistentCache(path)).set('key', {'solution': 'x = 2'})
+    shared = MemorySharedCache()
+    restarted = TieredCache(LRUCache(), shared, PersistentCache(path))
+    assert restarted.get('key') == {'solution': 'x = 2'}
+    # Read from disk once, then from the shared tier it was copied to.
+    assert json.loads(shared.get('key')) == {'solution': 'x = 2'}
+
+def test_results_waiting_for_diagrams_are_not_written_to_disk(tmp_path):
+    persistent = PersistentCache(str(tmp_path / 'cache.sqlite'))
+    cache = TieredCache(LRUCache(), persistent=persistent)
+    cache.set('key', {'solution': 'x', 'diagram_jobs': ['job1']})
+    assert persistent.get('key') is None
+    cache.set('key', {'solution': 'x', 'diagram_url': '/d.png'})
+    assert json.loads(persistent.get('key')) == {'solution': 'x', 'diagram_url': '/d.png'}
+
+def test_unreadable_shared_entry_is_dropped():
+    shared = MemorySharedCache()
+    shared.set('key', '{not json')
+    assert TieredCache(LRUCache(), shared).get('key') is None
+    assert shared.get('key') is None
@@ -0,0 +1,90 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aicalc import circuit_breaker
+from aicalc.circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class RateLimitError(Exception):
+    pass
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, 'time', clock)
+    monkeypatch.setattr(circuit_breaker, 'BREAKER_ENABLED', True)
+    monkeypatch.setattr(circuit_breaker, 'BREAKER_MIN_CALLS', 4)
+    monkeypatch.setattr(circuit_breaker, 'BREAKER_ERROR_RATE', 0.5)
+    monkeypatch.setattr(circuit_breaker, 'BREAKER_OPEN_SECONDS', 30)
+    return clock
+
+def _opened(clock):
+    breaker = CircuitBreaker('test')
+    for error in (None, None, RuntimeError('a'), RuntimeError('b')):
+        breaker.record(0.1, error)
+    return breaker
+
+def test_breaker_opens_once_the_error_rate_is_reached(clock):
+    breaker = CircuitBreaker('test')
+    for error in (None, None, RuntimeError('a')):
+        breaker.record(0.1, error)
+    assert breaker.state() == CLOSED
+    breaker.record(0.1, RuntimeError('b'))
+    assert breaker.state() == OPEN
+    assert breaker.allow() is None and breaker.retry_after() == 30
+
+def test_slow_calls_count_as_bad(clock):
+    breaker = CircuitBreaker('test')
+    for _ in range(4):
+        breaker.record(circuit_breaker.BREAKER_SLOW_CALL + 1)
+    assert breaker.state() == OPEN
+
+def test_quota_error_opens_at_once(clock):
+    breaker = CircuitBreaker('test')
+    breaker.record(0.1, RateLimitError('slow down'))
+    assert breaker.state() == OPEN
+
+def test_old_failures_leave_the_window(clock):
+    breaker = CircuitBreaker('test')
+    for _ in range(3):
+        breaker.record(0.1, RuntimeError('a'))
+    clock.now += circuit_breaker.BREAKER_WINDOW + circuit_breaker.BREAKER_BUCKET
+    breaker.record(0.1, RuntimeError('b'))
+    assert breaker.state() == CLOSED
+
+def test_half_open_admits_one_probe_that_closes_the_breaker(clock):
+    breaker = _opened(clock)
+    clock.now += 30
+    assert breaker.state() == HALF_OPEN
+    probe = breaker.allow()
+    assert probe.probe and breaker.allow() is None
+    # An ordinary call finishing meanwhile does not decide the state.
+    breaker.record(0.1)
+    assert breaker.state() == HALF_OPEN
+    breaker.record(0.1, token=probe)
+    assert breaker.state() == CLOSED and not breaker.allow().probe
+
+def test_failed_probe_opens_the_breaker_again(clock):
+    breaker = _opened(clock)
+    clock.now += 30
+    breaker.record(0.1, RuntimeError('still down'), token=breaker.allow())
+    assert breaker.state() == OPEN
+    clock.now += 29
+    assert breaker.allow() is None
+
+def test_released_probe_lets_another_call_probe(clock):
+    breaker = _opened(clock)
+    clock.now += 30
+    breaker.release(breaker.allow())
+    assert breaker.allow().probe
@@ -0,0 +1,51 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aicalc import cache, diagram_jobs
+from aicalc.cache import LRUCache, TieredCache
+from aicalc.diagram_jobs import LocalDiagramQueue, pending_diagram_html
+
+class SlowReads(TieredCache):
+    """Reads take a while, so completions that are not serialized overlap."""
+
+    def get(self, key):
+        value = super().get(key)
+        time.sleep(0.05)
+        return value
+
+@pytest.fixture
+def queue(monkeypatch):
+    results = SlowReads(LRUCache())
+    monkeypatch.setattr(cache, 'response_cache', results)
+    monkeypatch.setattr(diagram_jobs, 'response_cache', results)
+    queue = LocalDiagramQueue()
+    monkeypatch.setattr(diagram_jobs, 'diagram_queue', queue)
+    return queue
+
+def _job(job_id):
+    return {'id': job_id, 'kind': 'plot', 'code': '', 'context': '', 'cache_key': 'key',
+            'status': 'pending', 'url': None, 'submitted_at': time.time()}
+
+def test_diagrams_finishing_together_both_reach_the_cached_solution(queue):
+    jobs = [_job('job1'), _job('job2')]
+    for job in jobs:
+        queue.save(job)
+    cache.response_cache.set('key', {
+        'solution': ''.join(pending_diagram_html(job['id']) for job in jobs),
+        'has_diagram': True, 'diagram_url': None, 'diagram_jobs': ['job1', 'job2']})
+    threads = [threading.Thread(target=diagram_jobs._complete, args=(queue, job, f"{job['id']}.png", 0.1))
+               for job in jobs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result = cache.response_cache.get('key')
+    assert 'diagram_jobs' not in result
+    assert 'diagram-pending' not in result['solution']
+    assert sorted(result['diagram_urls']) == ['/static/generated/job1.png', '/static/generated/job2.png']
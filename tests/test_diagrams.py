@@ -0,0 +1,107 @@
+import os
+import stat
+import sys
+import textwrap
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aicalc import diagrams
+from aicalc.blob_store import MemoryBlobStore
+
+# Stand-ins for pdflatex and pdftoppm. A format file records the TeX version that built
+# it and only loads in that version; a picture containing BADCODE never compiles.
+FAKE_PDFLATEX = '''\
+    #!{python}
+    import os, sys
+    version = os.environ.get('FAKE_TEX_VERSION', 'pdfTeX 1')
+    args = sys.argv[1:]
+    if args == ['--version']:
+        print(version)
+        sys.exit(0)
+    out_dir = args[args.index('-output-directory') + 1]
+    with open(os.path.join(os.environ.get('FAKE_TEX_LOG'), 'calls'), 'a') as log:
+        log.write(' '.join(a for a in args if a.startswith(('-ini', '-fmt'))) or 'cold')
+        log.write('\\n')
+    if '-ini' in args:
+        name = next(a for a in args if a.startswith('-jobname=')).split('=', 1)[1]
+        with open(os.path.join(out_dir, name + '.fmt'), 'w') as f:
+            f.write(version)
+        sys.exit(0)
+    tex = args[-1]
+    fmt = next((a.split('=', 1)[1] for a in args if a.startswith('-fmt=')), None)
+    if fmt:
+        path = os.path.join(os.environ['TEXFORMATS'].rstrip(os.pathsep), fmt + '.fmt')
+        if not os.path.exists(path) or open(path).read() != version:
+            sys.exit(1)
+    if 'BADCODE' in open(tex).read():
+        sys.exit(1)
+    open(os.path.join(out_dir, os.path.basename(tex)[:-4] + '.pdf'), 'w').write('pdf')
+'''
+FAKE_PDFTOPPM = '''\
+    #!{python}
+    import sys
+    open(sys.argv[-1] + '.png', 'wb').write(b'png')
+'''
+
+@pytest.fixture
+def tex(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    for name, script in (('pdflatex', FAKE_PDFLATEX), ('pdftoppm', FAKE_PDFTOPPM)):
+        path = bin_dir / name
+        path.write_text(textwrap.dedent(script).format(python=sys.executable))
+        path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv('FAKE_TEX_LOG', str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(diagrams, 'TIKZ_FORMAT_DIR', str(tmp_path / 'formats'))
+    monkeypatch.setattr(diagrams, 'TIKZ_WARM_FORMAT', True)
+    monkeypatch.setattr(diagrams, '_tikz_format', None)
+
+    def calls():
+        path = tmp_path / 'calls'
+        lines = path.read_text().splitlines() if path.exists() else []
+        path.unlink(missing_ok=True)
+        return lines
+    return calls
+
+def test_warm_render_uses_the_format_file(tex):
+    assert diagrams.generate_tikz_diagram(r'\node {a};', 'a.png') == 'tikz/a.png'
+    name = diagrams.tikz_format()
+    assert tex() == ['-ini', f'-fmt={name}', f'-fmt={name}']
+
+def test_tex_upgrade_builds_a_new_format_file(tex, monkeypatch):
+    old = diagrams.tikz_format()
+    monkeypatch.setenv('FAKE_TEX_VERSION', 'pdfTeX 2')
+    monkeypatch.setattr(diagrams, '_tikz_format', None)
+    assert diagrams.tikz_format() != old
+
+def test_damaged_format_file_falls_back_to_cold_and_is_dropped(tex):
+    name = diagrams.tikz_format()
+    tex()
+    with open(os.path.join(diagrams.TIKZ_FORMAT_DIR, name + '.fmt'), 'w') as f:
+        f.write('truncated')
+    assert diagrams.generate_tikz_diagram(r'\node {a};', 'a.png') == 'tikz/a.png'
+    assert tex() == [f'-fmt={name}', 'cold']
+    assert diagrams.tikz_format() is None
+    assert not os.path.exists(os.path.join(diagrams.TIKZ_FORMAT_DIR, name + '.fmt'))
+    assert diagrams.generate_tikz_diagram(r'\node {b};', 'b.png') == 'tikz/b.png'
+    assert tex() == ['cold']
+
+def test_picture_that_does_not_compile_keeps_the_format_file(tex):
+    name = diagrams.tikz_format()
+    tex()
+    assert diagrams.generate_tikz_diagram(r'\node {BADCODE};', 'a.png') is None
+    assert tex() == [f'-fmt={name}', 'cold']
+    assert diagrams.tikz_format() == name
+
+def test_blob_store_renders_never_touch_static_generated(tex, tmp_path, monkeypatch):
+    store = MemoryBlobStore()
+    monkeypatch.setattr(diagrams, 'blob_store', store)
+    monkeypatch.setattr(diagrams, 'DIAGRAM_OPTIMIZE', False)
+    compiled_image = diagrams.render_diagram_file('tikz', r'\node {a};')
+    assert compiled_image == diagrams.diagram_filename('tikz', r'\node {a};')
+    assert store.get(os.path.basename(compiled_image)) == b'png'
+    assert not (tmp_path / 'static').exists()
@@ -0,0 +1,63 @@
+import os
+import random
+import sys
+
+import pytest
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aicalc.image_keys import decode_image_data, ImageRejected, image_hash, normalize_image, perceptual_hash, HammingIndex, CANONICAL_SIZE
+
+def _drawing(width, height, offset=0, specks=0, ink='white', background=(0, 0, 0, 0)):
+    """An x and a circle drawn at the same place relative to the canvas, whatever its size."""
+    img = Image.new('RGBA', (width, height), background)
+    draw = ImageDraw.Draw(img)
+    sx, sy = width / 1200, height / 800
+    stroke = max(1, int(4 * sx))
+    draw.line((300 * sx + offset, 300 * sy, 500 * sx + offset, 500 * sy), fill=ink, width=stroke)
+    draw.line((500 * sx + offset, 300 * sy, 300 * sx + offset, 500 * sy), fill=ink, width=stroke)
+    draw.ellipse((600 * sx + offset, 300 * sy, 800 * sx + offset, 500 * sy), outline=ink, width=stroke)
+    rng = random.Random(1)
+    for _ in range(specks):
+        draw.point((rng.randrange(width), rng.randrange(height)), fill=ink)
+    return img
+
+def _distance(a, b):
+    return bin(perceptual_hash(normalize_image(a)) ^ perceptual_hash(normalize_image(b))).count('1')
+
+def test_same_drawing_moved_on_the_canvas_has_the_same_key():
+    assert image_hash(_drawing(1200, 800)) == image_hash(_drawing(1200, 800, offset=150))
+
+def test_scaled_or_speckled_drawing_stays_close():
+    base = _drawing(1200, 800)
+    assert _distance(base, _drawing(3000, 2000)) <= 24
+    assert _distance(base, _drawing(2400, 1600, specks=50)) <= 24
+    assert _distance(base, _drawing(1200, 800, specks=20)) <= 8
+
+def test_dark_ink_on_paper_matches_light_ink_on_black():
+    paper = _drawing(1200, 800, ink='black', background='white')
+    assert _distance(_drawing(1200, 800), paper) <= 8
+
+def test_different_drawings_are_far_apart():
+    other = Image.new('RGBA', (1200, 800), (0, 0, 0, 0))
+    ImageDraw.Draw(other).rectangle((300, 300, 900, 350), outline='white', width=4)
+    assert _distance(_drawing(1200, 800), other) > 40
+
+def test_normalized_thumbnail_size():
+    assert normalize_image(_drawing(3840, 2160)).size == (CANONICAL_SIZE, CANONICAL_SIZE)
+    assert normalize_image(Image.new('RGB', (10, 10))).size == (CANONICAL_SIZE, CANONICAL_SIZE)
+
+def test_hamming_index_finds_near_hashes_and_evicts_oldest():
+    index = HammingIndex(max_distance=2, bits=16, max_entries=2)
+    index.add(0b1111)
+    assert index.nearest(0b1100) == 0b1111
+    assert index.nearest(0b0000) is None
+    index.add(0xff00)
+    index.add(0x00ff)
+    assert index.nearest(0b1111) is None
+
+@pytest.mark.parametrize('image_data', ['data:image/png;base64', 'data:', 'not base64!', 'aGVsbG8='])
+def test_malformed_image_data_is_rejected(image_data):
+    with pytest.raises(ImageRejected):
+        decode_image_data(image_data)
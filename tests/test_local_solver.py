@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aicalc.local_solver import solve_locally
+
+@pytest.mark.parametrize('question, answer', [
+    ('what is 2 + 2', '4'),
+    ('2^100', '1267650600228229401496703205376'),
+    ('ln(e^2)', '2'),
+    ('solve x^2 = 4', 'x = -2, \\quad x = 2'),
+])
+def test_simple_questions_are_answered_locally(question, answer):
+    result = solve_locally(question)
+    assert result['engine'] == 'local'
+    assert f"<strong>Answer:</strong> \\( {answer} \\)" in result['solution']
+
+@pytest.mark.parametrize('question', [
+    'what is log 100',
+    'derivative of log x',
+    'what is 10^1000',
+    'what is 1/3^200',
+    '(2^1000)^1000',
+    'solve x = 10^100',
+    'derivative of 10^100 x^2',
+])
+def test_ambiguous_or_huge_questions_go_to_the_model(question):
+    assert solve_locally(question) is None
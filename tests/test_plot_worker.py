@@ -0,0 +1,37 @@
+import io
+import os
+import sys
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aicalc.plot_worker import render
+
+def _pixel_range(png):
+    return Image.open(io.BytesIO(png)).convert('L').getextrema()
+
+@pytest.mark.parametrize('imports', [
+    '',
+    'import matplotlib.pyplot as plt\n',
+    'from matplotlib import pyplot as plt\n',
+    'import matplotlib\nimport matplotlib.pyplot\nplt = matplotlib.pyplot\n',
+])
+def test_pyplot_imports_draw_on_the_job_figure(imports):
+    png = render(imports + 'import numpy as np\nx = np.linspace(0, 1, 10)\nplt.plot(x, x ** 2)\nplt.show()\n')
+    assert _pixel_range(png)[0] < 128
+
+def test_from_pyplot_import_and_networkx_import():
+    code = ('from matplotlib.pyplot import plot, title\nimport networkx as nx\n'
+            'plot([0, 1], [1, 0])\ntitle("t")\nnx.draw(nx.path_graph(3))\n')
+    assert _pixel_range(render(code))[0] < 128
+
+def test_axes_creates_axes():
+    png = render('ax = plt.axes()\nax.plot([0, 1], [0, 1])\nplt.axes([0.6, 0.6, 0.3, 0.3]).plot([0, 1], [1, 0])\n')
+    assert _pixel_range(png)[0] < 128
+
+@pytest.mark.parametrize('code', ['x = 1', 'plt.title("nothing plotted")', 'plt.figure(); plt.show()'])
+def test_empty_figure_is_rejected(code):
+    with pytest.raises(ValueError):
+        render(code)
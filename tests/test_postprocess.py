@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aicalc.postprocess import clean_response, sanitize_html
+from aicalc.streaming import StreamCleaner
+
+def _placeholder(kind, code):
+    return f"[{kind}:{code}]"
+
+def _stream(text, size):
+    cleaner = StreamCleaner(_placeholder)
+    return ''.join(cleaner.feed(text[i:i + size]) for i in range(0, len(text), size)) + cleaner.finish()
+
+@pytest.mark.parametrize('payload, expected', [
+    ('<svg/onload=alert(1)>', '<svg>'),
+    ('<img/src="x"/onerror="alert(1)">', '<img/src="x">'),
+    ('<img src=x onerror=alert(1)>', '<img src=x>'),
+    ('<a href="&#106;avascript:alert(1)">x</a>', '<a href="#">x</a>'),
+    ('<a href=&#x6A;&#x61;vascript:alert(1)>x</a>', '<a href="#">x</a>'),
+    ('<a href="jav&#x09;ascript:alert(1)">x</a>', '<a href="#">x</a>'),
+    ('<a href="java&Tab;script&colon;alert(1)">x</a>', '<a href="#">x</a>'),
+    ('<a href=" JavaScript:alert(1)">x</a>', '<a href="#">x</a>'),
+    ('<a xlink:href="vbscript:msgbox(1)">x</a>', '<a xlink:href="#">x</a>'),
+    ('<iframe/src="data:text/html,<b>">', ''),
+    ('<a title="<" onclick="alert(1)">x</a>', '<a title="<">x</a>'),
+    ('<a title="x>y" onclick=alert(1)>x</a>', '<a title="x>y">x</a>'),
+    ('<script/src="x.js"></script>ok', 'ok'),
+])
+def test_script_payloads_are_neutralized(payload, expected):
+    assert sanitize_html(payload) == expected
+    assert clean_response(payload, _placeholder) == expected
+    for size in (1, 3, 7):
+        assert _stream(payload, size) == expected
+
+@pytest.mark.parametrize('markup', [
+    '<span style="color: red">x: y</span>',
+    '<a href="https://example.com/a?b=1&amp;c=2">link</a>',
+    '<a href="javascript-guide.html">guide</a>',
+    '<p class="note">1 &lt; 2 &amp; 3 &gt; 2</p><br/>',
+    'x <y and y> z',
+])
+def test_safe_markup_is_left_alone(markup):
+    assert sanitize_html(markup) == markup
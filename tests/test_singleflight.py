@@ -0,0 +1,67 @@
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aicalc.cache import LRUCache, MemorySharedCache, TieredCache
+from aicalc.diagram_jobs import pending_diagram_html, without_diagram_jobs
+from aicalc.singleflight import AsyncSingleFlight
+
+def test_cancelled_leader_hands_the_call_to_a_follower():
+    calls = []
+
+    async def fn():
+        calls.append(len(calls))
+        await asyncio.sleep(0.05)
+        return {'answer': len(calls)}
+
+    async def main():
+        flight = AsyncSingleFlight(timeout=5)
+        leader = asyncio.create_task(flight.do('key', fn))
+        await asyncio.sleep(0.01)
+        followers = [asyncio.create_task(flight.do('key', fn)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await asyncio.gather(*followers)
+
+    assert asyncio.run(main()) == [{'answer': 2}] * 3
+    assert len(calls) == 2
+
+def test_leader_error_reaches_the_followers():
+    async def fn():
+        await asyncio.sleep(0.01)
+        raise RuntimeError('model down')
+
+    async def main():
+        flight = AsyncSingleFlight(timeout=5)
+        return await asyncio.gather(*(flight.do('key', fn) for _ in range(3)), return_exceptions=True)
+
+    assert [str(e) for e in asyncio.run(main())] == ['model down'] * 3
+
+def _pending_result(job_id):
+    return {'solution': f'<p>x = 2</p>{pending_diagram_html(job_id)}', 'has_diagram': True,
+            'diagram_jobs': [job_id], 'diagram_url': None}
+
+def test_text_reaches_other_workers_while_a_local_diagram_renders():
+    shared = MemorySharedCache()
+    here, there = TieredCache(LRUCache(), shared), TieredCache(LRUCache(), shared)
+    here.shareable_pending = there.shareable_pending = without_diagram_jobs
+    here.set('key', _pending_result('job1'))
+    assert here.get('key')['diagram_jobs'] == ['job1']
+    seen = there.get('key')
+    assert seen['solution'] == '<p>x = 2</p>' and 'diagram_jobs' not in seen
+    assert not seen['has_diagram'] and seen['diagrams_pending']
+    # Once the diagram is in, the other worker serves the whole result.
+    here.set('key', {'solution': '<p>x = 2</p><img src="/d.png">', 'has_diagram': True, 'diagram_url': '/d.png'})
+    assert there.get('key')['diagram_url'] == '/d.png'
+
+def test_pending_result_is_shared_as_is_with_a_shared_queue():
+    shared = MemorySharedCache()
+    TieredCache(LRUCache(), shared).set('key', _pending_result('job1'))
+    assert json.loads(shared.get('key'))['diagram_jobs'] == ['job1']
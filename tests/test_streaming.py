@@ -0,0 +1,40 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aicalc.postprocess import clean_response
+from aicalc.streaming import StreamCleaner
+
+def _placeholder(kind, code):
+    return f"[{kind}:{code}]"
+
+def _stream(chunks):
+    cleaner = StreamCleaner(_placeholder)
+    return ''.join(cleaner.feed(chunk) for chunk in chunks) + cleaner.finish()
+
+def _splits(text):
+    """The text cut in two at every position, then into chunks of every size up to 8."""
+    for i in range(len(text) + 1):
+        yield [text[:i], text[i:]]
+    for size in range(1, 9):
+        yield [text[i:i + size] for i in range(0, len(text), size)]
+
+def test_script_block_split_across_chunks_is_dropped_with_its_content():
+    reply = '<p>Answer: 4</p><script>alert(1)</script><p>Done</p>'
+    for chunks in _splits(reply):
+        out = _stream(chunks)
+        assert 'alert(1)' not in out, chunks
+        assert out == clean_response(reply, _placeholder) == '<p>Answer: 4</p><p>Done</p>'
+
+def test_style_block_with_mixed_case_tags_is_dropped():
+    reply = 'x = 2<STYLE type="text/css">body { display: none }</Style >\n<p>ok</p>'
+    for chunks in _splits(reply):
+        out = _stream(chunks)
+        assert 'display' not in out, chunks
+        assert out == clean_response(reply, _placeholder)
+
+def test_diagram_marker_inside_script_block_is_not_rendered():
+    reply = 'a<script>var s = "<!--PLOT-START-->x<!--PLOT-END-->";</script>b<!--PLOT-START-->y = x<!--PLOT-END-->c'
+    for chunks in _splits(reply):
+        assert _stream(chunks) == clean_response(reply, _placeholder) == 'ab[plot:y = x]c', chunks
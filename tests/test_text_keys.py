@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aicalc.text_keys import normalize_question
+
+def _key(text):
+    return normalize_question(text, record=False)
+
+@pytest.mark.parametrize('first, second', [
+    ('what is 1,00,000 / 4', 'what is 1,000,000 / 4'),
+    ('what is 1,000 * 2', 'what is 1,0 * 2'),
+    ('1,5 * 2,05', '1,05 * 2,5'),
+    ('what is 2 by 3', 'what is 2*b*y*3'),
+    ('what is 2 + 2', 'what is 4'),
+    ('simplify 2x + 3x', 'simplify 5x'),
+    ('what is 0.1 + 0.2', 'what is 0.3'),
+    ('d/dx x^2', 'd*x*x^2'),
+    ('what is 5!', 'what is 5'),
+    ('what is 2 times 3', 'what is 2*t*i*m*e*s*3'),
+    ('what is log 100', 'what is ln 100'),
+])
+def test_different_questions_get_different_keys(first, second):
+    assert _key(first) != _key(second)
+
+@pytest.mark.parametrize('first, second', [
+    ('What is 2 + 2?', 'what is 2+2'),
+    ('what is 2 ** 3', 'what is 2^3'),
+    ('what is 3 × 4', 'what is 3*4'),
+    ('Solve  2x + 1 = 5', 'solve 2x+1=5'),
+    ('x²+1', 'x^2+1'),
+])
+def test_rewritten_questions_share_a_key(first, second):
+    assert _key(first) == _key(second)
+
+def test_commas_and_words_are_not_parsed_as_math():
+    assert _key('what is 1,000,000 / 4') == 'what is 1,000,000/4'
+    assert _key('what is 2 by 3') == 'what is 2 by 3'